@@ -44,10 +44,20 @@ def main(default_conf=None):
             help='Archive log file')
         parser.add_option('--tail', action='store_true',
             help='Tail log file')
+        parser.add_option('-f', '--follow', action='store_true',
+            help='Follow new log lines')
         parser.add_option('--limit', type='int',
             help='Limit log lines')
         parser.add_option('--natural', action='store_true',
             help='Natural log sort')
+        parser.add_option('--since', type='string',
+            help='Show log lines since time')
+        parser.add_option('--until', type='string',
+            help='Show log lines before time')
+        parser.add_option('--level', type='string',
+            help='Minimum log level')
+        parser.add_option('--host', type='string',
+            help='Show log lines from host name')
     elif cmd == 'set':
         parser.disable_interspersed_args()
 
@@ -291,14 +301,26 @@ def main(default_conf=None):
                 archive_path = './'
             print 'Log archived to: ' + log_view.archive_log(archive_path,
                 options.natural, options.limit)
-        elif options.tail:
-            for msg in log_view.tail_log_lines():
+        elif options.tail or options.follow:
+            setup.setup_cache()
+            lines = log_view.follow_log_lines(
+                level=options.level,
+                host=options.host,
+                limit=options.limit,
+            )
+            for msg in lines:
                 print msg
         else:
-            print log_view.get_log_lines(
+            lines = log_view.iter_log_lines(
+                since=logger.parse_log_time(options.since),
+                until=logger.parse_log_time(options.until),
+                level=options.level,
+                host=options.host,
                 natural=options.natural,
                 limit=options.limit,
             )
+            for msg in lines:
+                print msg
 
         sys.exit(0)
     elif cmd == 'clear-logs':
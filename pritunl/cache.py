@@ -1,15 +1,27 @@
+from pritunl.constants import *
 from pritunl.helpers import *
 from pritunl import settings
 from pritunl import utils
 from pritunl import logger
+from pritunl import expiry
 
 import time
 import json
 import redis
+import threading
+import itertools
+import collections
 
 _set = set
 _client = None
 has_cache = False
+_pubsub = None
+_sub_lock = threading.Lock()
+_sub_channels = {}
+_sub_counter = itertools.count()
+_sub_thread = None
+_sub_commands = collections.deque()
+_sub_wake = threading.Event()
 
 def init():
     global _client
@@ -77,25 +89,25 @@ def publish(channels, message, extra=None, cap=50, ttl=300):
     if isinstance(channels, str):
         channels = [channels]
 
-    for channel in channels:
-        doc = {
-            '_id': utils.ObjectId(),
-            'message': message,
-            'timestamp': utils.now(),
-        }
-        if extra:
-            for key, val in extra.items():
-                doc[key] = val
+    doc = {
+        '_id': utils.ObjectId(),
+        'message': message,
+        'timestamp': utils.now(),
+    }
+    if extra:
+        for key, val in extra.items():
+            doc[key] = val
 
-        doc = json.dumps(doc, default=utils.json_default)
+    doc = json.dumps(doc, default=utils.json_default)
 
-        pipe = _client.pipeline()
+    pipe = _client.pipeline(transaction=False)
+    for channel in channels:
         pipe.lpush(channel, doc)
         pipe.ltrim(channel, 0, cap)
         if ttl:
             pipe.expire(channel, ttl)
         pipe.publish(channel, doc)
-        pipe.execute()
+    pipe.execute()
 
 def get_cursor_id(channel):
     msg = _client.lindex(channel, 0)
@@ -103,6 +115,194 @@ def get_cursor_id(channel):
         doc = json.loads(msg, object_hook=utils.json_object_hook_handler)
         return doc['_id']
 
+def _sub_command(command, channel_name):
+    # Must be called with _sub_lock held, the pubsub connection is only
+    # used from the subscriber thread
+    done = threading.Event()
+    _sub_commands.append((command, channel_name, done))
+    _sub_wake.set()
+    return done
+
+def _sub_run_commands():
+    _sub_lock.acquire()
+    try:
+        commands = list(_sub_commands)
+        _sub_commands.clear()
+        has_channels = bool(_sub_channels)
+    finally:
+        _sub_lock.release()
+
+    try:
+        for command, channel_name, _ in commands:
+            if command == 'subscribe':
+                _pubsub.subscribe(channel_name)
+            else:
+                _pubsub.unsubscribe(channel_name)
+    finally:
+        for _, _, done in commands:
+            done.set()
+
+    return has_channels
+
+def _sub_reconnect():
+    global _pubsub
+
+    _sub_lock.acquire()
+    try:
+        for _, _, done in _sub_commands:
+            done.set()
+        _sub_commands.clear()
+        channel_names = _sub_channels.keys()
+    finally:
+        _sub_lock.release()
+
+    try:
+        _pubsub.close()
+    except:
+        pass
+
+    _pubsub = _client.pubsub()
+    if channel_names:
+        _pubsub.subscribe(*channel_names)
+
+def _subscriber_thread():
+    while True:
+        try:
+            if not _sub_run_commands():
+                _sub_wake.wait(1)
+                _sub_wake.clear()
+                continue
+
+            msg = _pubsub.get_message(timeout=CACHE_SUB_POLL)
+            if not msg or msg['type'] != 'message':
+                continue
+
+            doc = json.loads(msg['data'],
+                object_hook=utils.json_object_hook_handler)
+            doc['channel'] = msg['channel']
+            msg_id = next(_sub_counter)
+
+            _sub_lock.acquire()
+            try:
+                channel = _sub_channels.get(msg['channel'])
+                if channel:
+                    channel['msgs'].append((msg_id, doc))
+                    subs = channel['subs'].copy()
+                else:
+                    subs = None
+            finally:
+                _sub_lock.release()
+
+            if subs:
+                for event in subs:
+                    event.set()
+        except:
+            logger.exception('Error in cache subscriber', 'cache')
+            time.sleep(1)
+
+            try:
+                _sub_reconnect()
+            except:
+                logger.exception('Error reconnecting cache subscriber',
+                    'cache')
+
+def _sub_add(channels, event):
+    global _pubsub
+    global _sub_thread
+
+    cursors = {}
+    subscribed = []
+
+    _sub_lock.acquire()
+    try:
+        if not _pubsub:
+            _pubsub = _client.pubsub()
+
+        for channel_name in channels:
+            channel = _sub_channels.get(channel_name)
+            if not channel:
+                channel = {
+                    'subs': _set(),
+                    'msgs': collections.deque(maxlen=CACHE_SUB_BUFFER),
+                    'timer': None,
+                }
+                _sub_channels[channel_name] = channel
+                subscribed.append(_sub_command('subscribe', channel_name))
+
+            expiry.cancel(channel['timer'])
+            channel['timer'] = None
+            channel['subs'].add(event)
+
+            if channel['msgs']:
+                cursors[channel_name] = channel['msgs'][-1][0]
+            else:
+                cursors[channel_name] = -1
+
+        if not _sub_thread:
+            _sub_thread = threading.Thread(target=_subscriber_thread)
+            _sub_thread.daemon = True
+            _sub_thread.start()
+    finally:
+        _sub_lock.release()
+
+    # Wait for new channels to be subscribed to avoid missing messages
+    # published after returning
+    for done in subscribed:
+        done.wait(CACHE_SUB_WAIT)
+
+    return cursors
+
+def _sub_remove(channels, event):
+    _sub_lock.acquire()
+    try:
+        for channel_name in channels:
+            channel = _sub_channels.get(channel_name)
+            if not channel:
+                continue
+
+            channel['subs'].discard(event)
+            if not channel['subs'] and not channel['timer']:
+                channel['timer'] = expiry.schedule(CACHE_SUB_TTL,
+                    _sub_expire, channel_name)
+    finally:
+        _sub_lock.release()
+
+def _sub_expire(channel_name):
+    _sub_lock.acquire()
+    try:
+        channel = _sub_channels.get(channel_name)
+        if not channel or channel['subs']:
+            return
+        _sub_channels.pop(channel_name)
+        _sub_command('unsubscribe', channel_name)
+    finally:
+        _sub_lock.release()
+
+def _sub_get(cursors):
+    docs = []
+
+    _sub_lock.acquire()
+    try:
+        for channel_name, cursor in cursors.items():
+            channel = _sub_channels.get(channel_name)
+            if not channel:
+                continue
+
+            msgs = channel['msgs']
+            if not msgs or msgs[-1][0] <= cursor:
+                continue
+
+            for msg_id, doc in reversed(msgs):
+                if msg_id <= cursor:
+                    break
+                docs.append((msg_id, doc))
+            cursors[channel_name] = msgs[-1][0]
+    finally:
+        _sub_lock.release()
+
+    docs.sort(key=lambda x: x[0])
+    return [doc.copy() for _, doc in docs]
+
 @interrupter_generator
 def subscribe(channels, cursor_id=None, timeout=None, yield_delay=None,
         yield_app_server=False):
@@ -114,15 +314,14 @@ def subscribe(channels, cursor_id=None, timeout=None, yield_delay=None,
 
     duplicates = None
     yield_stop = False
-    pubsub = _client.pubsub()
+    event = threading.Event()
 
-    try:
-        if isinstance(channels, str):
-            channels = [channels]
+    if isinstance(channels, str):
+        channels = [channels]
 
-        for channel in channels:
-            pubsub.subscribe(channel)
+    cursors = _sub_add(channels, event)
 
+    try:
         yield
 
         if cursor_id:
@@ -155,25 +354,26 @@ def subscribe(channels, cursor_id=None, timeout=None, yield_delay=None,
         yield
 
         while True:
-            msg = pubsub.get_message(timeout=get_timeout)
-            if msg and msg['type'] == 'message':
-                yield
+            if event.wait(get_timeout):
+                event.clear()
+                yielded = False
 
-                doc = json.loads(msg['data'],
-                    object_hook=utils.json_object_hook_handler)
-                doc['channel'] = msg['channel']
-                if duplicates:
-                    if doc['_id'] in duplicates:
-                        continue
-                    else:
-                        duplicates = None
+                for doc in _sub_get(cursors):
+                    yield
 
-                yield doc
+                    if duplicates:
+                        if doc['_id'] in duplicates:
+                            continue
+                        else:
+                            duplicates = None
+
+                    yielded = True
+                    yield doc
 
                 if yield_stop:
                     return
 
-                if yield_delay:
+                if yielded and yield_delay:
                     get_timeout = yield_delay
                     yield_stop = True
                     continue
@@ -183,4 +383,4 @@ def subscribe(channels, cursor_id=None, timeout=None, yield_delay=None,
                     time.time() - start_time >= timeout):
                 return
     finally:
-        pubsub.close()
+        _sub_remove(channels, event)
@@ -1,77 +1,205 @@
-import collections
+import threading
 import re
 
-_keys = collections.defaultdict(
-    lambda: collections.defaultdict(lambda: collections.Counter()))
-_values = collections.defaultdict(
-    lambda: collections.defaultdict(lambda: set()))
+_tries = {}
+_lock = threading.Lock()
+
+class _Node(object):
+    # Children are kept in a tuple and values are kept as a single value
+    # until a second value is added to reduce the memory of leaf nodes
+    __slots__ = ('label', 'children', 'values')
+
+    def __init__(self, label, value=None):
+        self.label = label
+        self.children = ()
+        self.values = value
+
+    def get_child(self, char):
+        for child in self.children:
+            if child.label[0] == char:
+                return child
+
+    def set_child(self, child):
+        char = child.label[0]
+        self.children = tuple(x for x in self.children
+            if x.label[0] != char) + (child,)
+
+    def remove_child(self, char):
+        self.children = tuple(x for x in self.children
+            if x.label[0] != char)
+
+    def add_value(self, value):
+        if self.values is None:
+            self.values = value
+        elif isinstance(self.values, set):
+            self.values.add(value)
+        elif self.values != value:
+            self.values = set((self.values, value))
+
+    def remove_value(self, value):
+        if isinstance(self.values, set):
+            self.values.discard(value)
+            if len(self.values) == 1:
+                self.values = self.values.pop()
+        elif self.values == value:
+            self.values = None
+
+    def update_values(self, values):
+        if isinstance(self.values, set):
+            values.update(self.values)
+        elif self.values is not None:
+            values.add(self.values)
+
+def split_search_terms(search):
+    search = search.lower()
+    terms = [x for x in re.split('[^a-z0-9]', search) if x]
+    if not terms and search.strip():
+        terms = [search.strip()]
+    return terms
 
 class CacheTrie(object):
-    __slots__ = ('name', 'key')
+    # Radix tree of lowercased keys, each node holds the edge label from
+    # its parent and the values of keys ending at the node. Nodes with a
+    # single child and no values are merged into the child.
+    __slots__ = ('name',)
 
-    def __init__(self, name, key=''):
+    def __init__(self, name):
         self.name = name
-        self.key = key
 
     def clear_cache(self):
-        _keys.pop(self.name, None)
-        _values.pop(self.name, None)
+        _lock.acquire()
+        try:
+            _tries.pop(self.name, None)
+        finally:
+            _lock.release()
+
+    def _add_key(self, key, value):
+        node = _tries.get(self.name)
+        if node is None:
+            node = _Node('')
+            _tries[self.name] = node
+
+        while key:
+            child = node.get_child(key[0])
+            if child is None:
+                node.set_child(_Node(key, value))
+                return
+
+            label = child.label
+            if key.startswith(label):
+                key = key[len(label):]
+                node = child
+                continue
+
+            i = 1
+            n = min(len(label), len(key))
+            while i < n and label[i] == key[i]:
+                i += 1
+
+            parent = _Node(label[:i])
+            node.set_child(parent)
+            child.label = label[i:]
+            parent.children = (child,)
+
+            key = key[i:]
+            node = parent
+
+        node.add_value(value)
+
+    def _remove_key(self, key, value):
+        node = _tries.get(self.name)
+        if node is None:
+            return
+
+        path = []
+        while key:
+            child = node.get_child(key[0])
+            if child is None or not key.startswith(child.label):
+                return
+            path.append(node)
+            key = key[len(child.label):]
+            node = child
+
+        node.remove_value(value)
+
+        while path and node.values is None:
+            parent = path.pop()
+            if not node.children:
+                parent.remove_child(node.label[0])
+                node = parent
+                continue
+
+            if len(node.children) == 1:
+                child = node.children[0]
+                child.label = node.label + child.label
+                parent.set_child(child)
+            break
 
     def add_key(self, key, value):
-        keys = _keys[self.name]
-        cur_key = self.key
-        new_key = cur_key
-        for char in key.lower():
-            new_key += char
-            keys[cur_key][new_key] += 1
-            cur_key = new_key
-        _values[self.name][cur_key].add(value)
+        _lock.acquire()
+        try:
+            self._add_key(key.lower(), value)
+        finally:
+            _lock.release()
 
     def add_key_terms(self, key, value):
-        for term in re.split('[^a-z0-9]', key.lower()):
-            self.add_key(term, value)
-        self.add_key(key, value)
+        _lock.acquire()
+        try:
+            for term in set(split_search_terms(key)):
+                self._add_key(term, value)
+        finally:
+            _lock.release()
 
     def remove_key(self, key, value):
-        keys = _keys[self.name]
-        values = _values[self.name]
-        cur_key = self.key
-        new_key = cur_key
-        for char in key.lower():
-            new_key += char
-            keys[cur_key][new_key] -= 1
-            if not keys[cur_key][new_key]:
-                keys[cur_key].pop(new_key, None)
-                if not keys[cur_key]:
-                    keys.pop(cur_key, None)
-            cur_key = new_key
+        _lock.acquire()
         try:
-            values[cur_key].remove(value)
-        except KeyError:
-            pass
-        if not values[cur_key]:
-            values.pop(cur_key, None)
+            self._remove_key(key.lower(), value)
+        finally:
+            _lock.release()
 
     def remove_key_terms(self, key, value):
-        for term in re.split('[^a-z0-9]', key.lower()):
-            self.remove_key(term, value)
-        self.remove_key(key, value)
-
-    def chain(self, node_values):
-        name = self.name
-        key = self.key
-        keys = _keys[name]
-        values = _values[name]
-        if key in keys:
-            for node_key in keys[key]:
-                CacheTrie(name, node_key).chain(node_values)
-        if key in values:
-            node_values.update(values[key])
-        return node_values
-
-    def get_prefix(self, prefix):
-        return CacheTrie(self.name, prefix.lower()).chain(set())
-
-    def iter_prefix(self, prefix):
-        for value in CacheTrie(self.name, prefix.lower()).chain(set()):
+        _lock.acquire()
+        try:
+            for term in set(split_search_terms(key)):
+                self._remove_key(term, value)
+        finally:
+            _lock.release()
+
+    def get_prefix(self, prefix, limit=None):
+        prefix = prefix.lower()
+        values = set()
+
+        _lock.acquire()
+        try:
+            node = _tries.get(self.name)
+            while node is not None and prefix:
+                child = node.get_child(prefix[0])
+                if child is None:
+                    node = None
+                elif child.label.startswith(prefix):
+                    prefix = ''
+                    node = child
+                elif prefix.startswith(child.label):
+                    prefix = prefix[len(child.label):]
+                    node = child
+                else:
+                    node = None
+
+            if node is None:
+                return values
+
+            stack = [node]
+            while stack:
+                node = stack.pop()
+                node.update_values(values)
+                if limit and len(values) >= limit:
+                    break
+                stack.extend(node.children)
+        finally:
+            _lock.release()
+
+        return values
+
+    def iter_prefix(self, prefix, limit=None):
+        for value in self.get_prefix(prefix, limit=limit):
             yield value
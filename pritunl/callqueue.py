@@ -2,6 +2,8 @@ from pritunl.helpers import *
 from pritunl import logger
 
 import threading
+import collections
+import time
 import Queue
 
 class CallQueue(object):
@@ -44,3 +46,139 @@ class CallQueue(object):
 
     def close(self):
         self._close = True
+
+class KeyedCallQueue(object):
+    # Calls with the same key run in the order queued and never
+    # concurrently, calls with different keys run on any free thread
+    def __init__(self, checker=None, maxsize=0):
+        if checker is None:
+            self._check = check_global_interrupt
+        else:
+            self._check = checker
+        self._close = False
+        self._maxsize = maxsize
+        self._size = 0
+        self._queue = collections.deque()
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._not_empty = threading.Condition(self._lock)
+        self._not_full = threading.Condition(self._lock)
+        self._count = 0
+        self._wait_total = 0.0
+        self._wait_max = 0.0
+        self._run_total = 0.0
+        self._run_max = 0.0
+
+    def put(self, key, func, *args, **kwargs):
+        self._lock.acquire()
+        try:
+            while self._maxsize and self._size >= self._maxsize:
+                self._not_full.wait()
+            self._size += 1
+            self._queue.append((key, time.time(), func, args, kwargs))
+            self._not_empty.notify()
+        finally:
+            self._lock.release()
+
+    def size(self):
+        return self._size
+
+    def get_stats(self):
+        self._lock.acquire()
+        try:
+            count = self._count
+            stats = {
+                'depth': self._size,
+                'count': count,
+                'wait_avg': self._wait_total / count if count else 0.0,
+                'wait_max': self._wait_max,
+                'run_avg': self._run_total / count if count else 0.0,
+                'run_max': self._run_max,
+            }
+            self._count = 0
+            self._wait_total = 0.0
+            self._wait_max = 0.0
+            self._run_total = 0.0
+            self._run_max = 0.0
+        finally:
+            self._lock.release()
+
+        return stats
+
+    def _get(self, timeout):
+        self._lock.acquire()
+        try:
+            end_time = time.time() + timeout
+            while True:
+                while not self._queue:
+                    remaining = end_time - time.time()
+                    if remaining <= 0:
+                        return
+                    self._not_empty.wait(remaining)
+
+                call = self._queue.popleft()
+                key = call[0]
+                if key in self._pending:
+                    self._pending[key].append(call)
+                    continue
+
+                self._pending[key] = collections.deque()
+                return call
+        finally:
+            self._lock.release()
+
+    def _next(self, key):
+        self._lock.acquire()
+        try:
+            pending = self._pending[key]
+            if pending:
+                return pending.popleft()
+            del self._pending[key]
+        finally:
+            self._lock.release()
+
+    def _call(self, call):
+        key, timestamp, func, args, kwargs = call
+        start = time.time()
+
+        try:
+            func(*args, **kwargs)
+        except:
+            logger.exception('Error in queued called', 'callqueue')
+
+        end = time.time()
+        wait = start - timestamp
+        run = end - start
+
+        self._lock.acquire()
+        try:
+            self._size -= 1
+            self._not_full.notify()
+            self._count += 1
+            self._wait_total += wait
+            self._wait_max = max(self._wait_max, wait)
+            self._run_total += run
+            self._run_max = max(self._run_max, run)
+        finally:
+            self._lock.release()
+
+    def _thread(self):
+        while True:
+            call = self._get(0.5)
+            queued = call is not None
+
+            while call:
+                self._call(call)
+                call = self._next(call[0])
+
+            if self._check() or (not queued and self._close):
+                return
+
+    def start(self, threads=1):
+        for _ in xrange(threads):
+            thread = threading.Thread(target=self._thread)
+            thread.daemon = True
+            thread.start()
+
+    def close(self):
+        self._close = True
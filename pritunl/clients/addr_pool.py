@@ -0,0 +1,95 @@
+from pritunl import ipaddress
+
+import threading
+import bisect
+
+class AddrPool(object):
+    # Free addresses are stored as sorted non-overlapping integer ranges
+    # so memory is proportional to the number of free ranges rather than
+    # the number of addresses in the network
+    def __init__(self, network, network_start=None, network_end=None):
+        self._lock = threading.Lock()
+        self._starts = []
+        self._ends = []
+
+        network = ipaddress.IPv4Network(network)
+        self.prefixlen = network.prefixlen
+
+        # Skip the network address, gateway address, broadcast address and
+        # the last host address to match the previous pool layout
+        self.first = int(network.network) + 2
+        self.last = int(network.broadcast) - 2
+
+        if network_start:
+            self.first = max(self.first,
+                int(ipaddress.IPv4Address(network_start)))
+        if network_end:
+            self.last = min(self.last,
+                int(ipaddress.IPv4Address(network_end)))
+
+        if self.first <= self.last:
+            self._starts.append(self.first)
+            self._ends.append(self.last)
+
+    def __len__(self):
+        self._lock.acquire()
+        try:
+            count = 0
+            for i in xrange(len(self._starts)):
+                count += self._ends[i] - self._starts[i] + 1
+            return count
+        finally:
+            self._lock.release()
+
+    def range_count(self):
+        return len(self._starts)
+
+    def get(self):
+        self._lock.acquire()
+        try:
+            if not self._starts:
+                return
+
+            addr = self._ends[-1]
+            if addr == self._starts[-1]:
+                self._starts.pop()
+                self._ends.pop()
+            else:
+                self._ends[-1] = addr - 1
+        finally:
+            self._lock.release()
+
+        return str(ipaddress.IPv4Address(addr))
+
+    def put(self, addr):
+        addr = int(ipaddress.IPv4Address(addr.split('/')[0]))
+        if addr < self.first or addr > self.last:
+            return False
+
+        self._lock.acquire()
+        try:
+            starts = self._starts
+            ends = self._ends
+            index = bisect.bisect_right(starts, addr)
+
+            if index and ends[index - 1] >= addr:
+                return False
+
+            merge_prev = index and ends[index - 1] == addr - 1
+            merge_next = index < len(starts) and starts[index] == addr + 1
+
+            if merge_prev and merge_next:
+                ends[index - 1] = ends[index]
+                starts.pop(index)
+                ends.pop(index)
+            elif merge_prev:
+                ends[index - 1] = addr
+            elif merge_next:
+                starts[index] = addr
+            else:
+                starts.insert(index, addr)
+                ends.insert(index, addr)
+        finally:
+            self._lock.release()
+
+        return True
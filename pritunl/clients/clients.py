@@ -1,3 +1,6 @@
+from pritunl.clients.addr_pool import AddrPool
+from pritunl.clients.pool_lease import PoolLease
+
 from pritunl.constants import *
 from pritunl.helpers import *
 from pritunl import utils
@@ -39,7 +42,7 @@ class Clients(object):
         self.iroutes_thread = {}
         self.iroutes_lock = threading.RLock()
         self.iroutes_index = collections.defaultdict(set)
-        self.call_queue = callqueue.CallQueue(
+        self.call_queue = callqueue.KeyedCallQueue(
             self.instance.is_interrupted, 512)
         self.clients_call_queue = callqueue.CallQueue(
             self.instance.is_interrupted)
@@ -49,20 +52,19 @@ class Clients(object):
 
         self.clients = docdb.DocDb(
             'user_id',
-            'mac_addr',
             'virt_address',
+            ('user_id', 'mac_addr'),
+            readonly=True,
         )
         self.clients_queue = collections.deque()
 
-        skip = True
-        self.ip_pool = []
         self.ip_network = ipaddress.IPv4Network(self.server.network)
-        for ip_addr in self.ip_network.iterhosts():
-            if skip:
-                skip = False
-                continue
-            self.ip_pool.append(str(ip_addr))
-        self.ip_pool.pop()
+        self.ip_pool = AddrPool(
+            self.server.network,
+            self.server.network_start,
+            self.server.network_end,
+        )
+        self.pool_lease = PoolLease(self.server, self.instance.id)
 
     @cached_static_property
     def collection(cls):
@@ -89,12 +91,8 @@ class Clients(object):
         return settings.local.host.local_addr6
 
     def get_org(self, org_id):
-        org = self.obj_cache.get(org_id)
-        if not org:
-            org = self.server.get_org(org_id, fields=['_id', 'name'])
-            if org:
-                self.obj_cache.set(org_id, org)
-        return org
+        return self.obj_cache.load(org_id, self.server.get_org,
+            org_id, fields=['_id', 'name'])
 
     def generate_client_conf(self, platform, client_id, virt_address,
             user, reauth):
@@ -441,65 +439,14 @@ class Clients(object):
 
         if not virt_address:
             if self.server.replicating and self.server.multi_device:
-                doc = self.pool_collection.find_and_modify({
-                    'server_id': self.server.id,
-                    'user_id': None,
-                }, {
-                    'server_id': self.server.id,
-                    'user_id': user_id,
-                    'mac_addr': mac_addr,
-                    'client_id': doc_id,
-                    'timestamp': utils.now(),
-                }, new=True)
-
-                if doc:
+                addr = self.pool_lease.get(user_id, mac_addr, doc_id)
+                if addr:
                     address_dynamic = True
-                    virt_address = utils.long_to_ip(doc['_id']) + subnet
-                else:
-                    doc = self.server_collection.find_one({
-                        '_id': self.server.id,
-                    }, {
-                        'pool_cursor': True,
-                    })
-                    last_addr = doc.get('pool_cursor')
-
-                    if last_addr:
-                        last_addr = ipaddress.IPv4Address(
-                            utils.long_to_ip(last_addr))
-
-                    network = ipaddress.IPv4Network(self.server.network)
-                    ip_pool = utils.get_ip_pool_reverse(network, last_addr)
-
-                    if ip_pool:
-                        for ip_addr in ip_pool:
-                            try:
-                                self.pool_collection.insert({
-                                    '_id': long(ip_addr._ip),
-                                    'server_id': self.server.id,
-                                    'user_id': user_id,
-                                    'mac_addr': mac_addr,
-                                    'client_id': doc_id,
-                                    'timestamp': utils.now(),
-                                })
-                                virt_address = str(ip_addr) + subnet
-                                address_dynamic = True
-                                break
-                            except pymongo.errors.DuplicateKeyError:
-                                continue
-
-                        if virt_address:
-                            self.server_collection.update({
-                                '_id': self.server.id,
-                                'status': ONLINE,
-                            }, {'$set': {
-                                'pool_cursor': utils.ip_to_long(
-                                    virt_address.split('/')[0]),
-                            }})
+                    virt_address = utils.long_to_ip(addr) + subnet
             else:
                 while True:
-                    try:
-                        ip_addr = self.ip_pool.pop()
-                    except IndexError:
+                    ip_addr = self.ip_pool.get()
+                    if not ip_addr:
                         break
                     ip_addr += subnet
 
@@ -604,7 +551,7 @@ class Clients(object):
                         dns_server = virt_address
                     dns_servers.append(dns_server)
 
-            rules, rules6 = self.generate_iptables_rules(
+            rules, rules6, entries = self.generate_iptables_rules(
                 user, virt_address, virt_address6)
 
             self.clients.insert({
@@ -627,6 +574,7 @@ class Clients(object):
                 'address_dynamic': address_dynamic,
                 'iptables_rules': rules,
                 'ip6tables_rules': rules6,
+                'ipset_entries': entries,
             })
 
             if user.type == CERT_CLIENT:
@@ -780,7 +728,9 @@ class Clients(object):
                 'Error parsing client connect')
 
     def connect(self, client_data, reauth=False):
-        self.call_queue.put(self._connect, client_data, reauth)
+        self.call_queue.put(
+            client_data.get('user_id') or client_data.get('client_id'),
+            self._connect, client_data, reauth)
 
     def on_port_forwarding(self, org_id, user_id):
         client = self.clients.find({'user_id': user_id})
@@ -800,7 +750,7 @@ class Clients(object):
         if not usr:
             return
 
-        rules, rules6 = self.generate_iptables_rules(
+        rules, rules6, entries = self.generate_iptables_rules(
             usr,
             client['virt_address'],
             client['virt_address6'],
@@ -809,24 +759,32 @@ class Clients(object):
         self.clear_iptables_rules(
             client['iptables_rules'],
             client['ip6tables_rules'],
+            client['ipset_entries'],
         )
 
         if not self.clients.update_id(client['id'], {
                     'iptables_rules': rules,
                     'ip6tables_rules': rules6,
+                    'ipset_entries': entries,
                 }):
             return
 
-        self.set_iptables_rules(rules, rules6)
+        self.set_iptables_rules(rules, rules6, entries)
 
     def generate_iptables_rules(self, usr, virt_address, virt_address6):
         rules = []
         rules6 = []
+        entries = []
+        ipset = self.instance.iptables.ipset
 
         client_addr = virt_address.split('/')[0]
         client_addr6 = virt_address6.split('/')[0]
 
-        if usr.client_to_client:
+        if usr.client_to_client and ipset:
+            entries.append(['cc', client_addr, False])
+            if self.server.ipv6:
+                entries.append(['cc', client_addr6, True])
+        elif usr.client_to_client:
             for chain in ('INPUT', 'OUTPUT', 'FORWARD'):
                 rules.append([
                     chain,
@@ -874,7 +832,7 @@ class Clients(object):
                 ])
 
         if not usr.port_forwarding:
-            return rules, rules6
+            return rules, rules6, entries
 
         forward_base_args = [
             'FORWARD',
@@ -902,17 +860,22 @@ class Clients(object):
             '--comment', 'pritunl-%s' % self.server.id,
         ]
 
-        forward2_base_rule = [
-            'FORWARD',
-            '-s', client_addr,
-            '-i', self.instance.interface,
-            '-m', 'conntrack',
-            '--ctstate','RELATED,ESTABLISHED',
-            '-j', 'ACCEPT',
-        ] + extra_args
-        rules.append(forward2_base_rule)
-        if self.server.ipv6:
-            rules6.append(forward2_base_rule)
+        if ipset:
+            entries.append(['pe', client_addr, False])
+            if self.server.ipv6:
+                entries.append(['pe', client_addr6, True])
+        else:
+            forward2_base_rule = [
+                'FORWARD',
+                '-s', client_addr,
+                '-i', self.instance.interface,
+                '-m', 'conntrack',
+                '--ctstate','RELATED,ESTABLISHED',
+                '-j', 'ACCEPT',
+            ] + extra_args
+            rules.append(forward2_base_rule)
+            if self.server.ipv6:
+                rules6.append(forward2_base_rule)
 
         for data in usr.port_forwarding:
             proto = data.get('protocol')
@@ -974,6 +937,15 @@ class Clients(object):
                     rules6.append(rule)
 
 
+                if ipset:
+                    forward_port = (port or dport).replace(':', '-')
+                    entries.append(['pf', '%s,%s:%s' % (
+                        client_addr, proto, forward_port), False])
+                    if self.server.ipv6:
+                        entries.append(['pf', '%s,%s:%s' % (
+                            client_addr6, proto, forward_port), True])
+                    continue
+
                 rule = forward_base_args + [
                     '-p', proto,
                     '-m', proto,
@@ -983,22 +955,24 @@ class Clients(object):
                 if self.server.ipv6:
                     rules6.append(rule)
 
-        return rules, rules6
+        return rules, rules6, entries
 
-    def set_iptables_rules(self, rules, rules6):
-        if rules or rules6:
+    def set_iptables_rules(self, rules, rules6, entries):
+        if rules or rules6 or entries:
             self.instance.enable_iptables_tun_nat()
             for rule in rules:
                 self.instance.iptables.add_rule(rule)
             for rule6 in rules6:
                 self.instance.iptables.add_rule6(rule6)
+            self.instance.iptables.add_set_entries(entries)
 
-    def clear_iptables_rules(self, rules, rules6):
-        if rules or rules6:
+    def clear_iptables_rules(self, rules, rules6, entries):
+        if rules or rules6 or entries:
             for rule in rules:
                 self.instance.iptables.remove_rule(rule)
             for rule6 in rules6:
                 self.instance.iptables.remove_rule6(rule6)
+            self.instance.iptables.remove_set_entries(entries)
 
     def _connected(self, client_id):
         client = self.clients.find_id(client_id)
@@ -1011,11 +985,13 @@ class Clients(object):
         self.set_iptables_rules(
             client['iptables_rules'],
             client['ip6tables_rules'],
+            client['ipset_entries'],
         )
 
         timestamp = utils.now()
         doc = {
             '_id': client['doc_id'],
+            'org_id': client['org_id'],
             'user_id': client['user_id'],
             'server_id': self.server.id,
             'host_id': settings.local.host_id,
@@ -1078,7 +1054,9 @@ class Clients(object):
         self.send_event()
 
     def connected(self, client_id):
-        self.call_queue.put(self._connected, client_id)
+        client = self.clients.find_id(client_id)
+        self.call_queue.put(client['user_id'] if client else client_id,
+            self._connected, client_id)
 
     def _disconnected(self, client):
         org_id = client['org_id']
@@ -1144,7 +1122,7 @@ class Clients(object):
                 'virt_address': None,
             })
             if updated:
-                self.ip_pool.append(virt_address.split('/')[0])
+                self.ip_pool.put(virt_address)
 
         self.clients.remove_id(client_id)
         host.global_clients.remove({
@@ -1156,6 +1134,7 @@ class Clients(object):
         self.clear_iptables_rules(
             client['iptables_rules'],
             client['ip6tables_rules'],
+            client['ipset_entries'],
         )
 
         doc_id = client.get('doc_id')
@@ -1171,16 +1150,7 @@ class Clients(object):
 
         if self.server.multi_device and self.server.replicating:
             if client['address_dynamic']:
-                self.pool_collection.update({
-                    'server_id': self.server.id,
-                    'user_id': client.get('user_id'),
-                    'client_id': doc_id,
-                }, {'$set': {
-                    'user_id': None,
-                    'mac_addr': None,
-                    'client_id': None,
-                    'timestamp': None,
-                }})
+                self.pool_lease.put(client.get('user_id'), doc_id)
             else:
                 self.pool_collection.remove({
                     'server_id': self.server.id,
@@ -1188,7 +1158,7 @@ class Clients(object):
                     'client_id': doc_id,
                 })
 
-        self.call_queue.put(self._disconnected, client)
+        self.call_queue.put(client['user_id'], self._disconnected, client)
 
     def disconnect_user(self, user_id):
         for client in self.clients.find({'user_id': user_id}):
@@ -1282,82 +1252,118 @@ class Clients(object):
                 self.instance_com.client_kill(client_id)
                 break
 
+    def ping_flush(self, clients):
+        doc_ids = []
+        client_ids = {}
+        for client in clients:
+            doc_ids.append(client['doc_id'])
+            client_ids[client['doc_id']] = client['id']
+
+        response = self.collection.update_many({
+            '_id': {'$in': doc_ids},
+        }, {'$set': {
+            'timestamp': utils.now(),
+        }})
+
+        lost_doc_ids = set()
+        if response.matched_count != len(doc_ids):
+            found_doc_ids = set(self.collection.find({
+                '_id': {'$in': doc_ids},
+            }, {
+                '_id': True,
+            }).distinct('_id'))
+            lost_doc_ids = set(doc_ids) - found_doc_ids
+
+        if self.server.multi_device and self.server.replicating:
+            self.pool_collection.update_many({
+                'server_id': self.server.id,
+                'client_id': {'$in': doc_ids},
+            }, {'$set': {
+                'timestamp': utils.now(),
+            }})
+
+        timestamp = time.time()
+        for doc_id in doc_ids:
+            client_id = client_ids[doc_id]
+
+            if doc_id in lost_doc_ids:
+                logger.error('Client lost unexpectedly', 'server',
+                    server_id=self.server.id,
+                    instance_id=self.instance.id,
+                )
+                self.instance_com.client_kill(client_id)
+                continue
+
+            if self.clients.update_id(client_id, {
+                        'timestamp': timestamp,
+                    }):
+                self.clients_queue.append(client_id)
+
     @interrupter
     def ping_thread(self):
         try:
             while True:
                 try:
-                    try:
-                        client_id = self.clients_queue.popleft()
-                    except IndexError:
-                        if self.interrupter_sleep(10):
-                            return
-                        continue
-
-                    client = self.clients.find_id(client_id)
-                    if not client:
-                        continue
-
-                    diff = settings.vpn.client_ttl - 150 - \
-                           (time.time() - client['timestamp'])
-
-                    if diff > settings.vpn.client_ttl:
-                        logger.error('Client ping time diff out of range',
-                            'server',
-                            time_diff=diff,
-                            server_id=self.server.id,
-                            instance_id=self.instance.id,
-                        )
-                        if self.interrupter_sleep(10):
-                            return
-                    elif diff > 1:
-                        if self.interrupter_sleep(diff):
-                            return
+                    batch_size = settings.vpn.client_ping_batch_size
+                    flush_interval = settings.vpn.client_ping_flush_interval
+                    clients = []
 
-                    if self.instance.sock_interrupt:
-                        return
+                    while len(clients) < batch_size:
+                        try:
+                            client_id = self.clients_queue.popleft()
+                        except IndexError:
+                            break
 
-                    try:
-                        updated = self.clients.update_id(client_id, {
-                            'timestamp': time.time(),
-                        })
-                        if not updated:
+                        client = self.clients.find_id(client_id)
+                        if not client:
                             continue
 
-                        response = self.collection.update({
-                            '_id': client['doc_id'],
-                        }, {'$set': {
-                            'timestamp': utils.now(),
-                        }})
-                        if not response['updatedExisting']:
-                            logger.error('Client lost unexpectedly', 'server',
+                        diff = settings.vpn.client_ttl - 150 - \
+                               (time.time() - client['timestamp'])
+
+                        if diff > settings.vpn.client_ttl:
+                            logger.error('Client ping time diff out of range',
+                                'server',
+                                time_diff=diff,
                                 server_id=self.server.id,
                                 instance_id=self.instance.id,
                             )
-                            self.instance_com.client_kill(client_id)
-                            continue
+                        elif diff > flush_interval:
+                            self.clients_queue.appendleft(client_id)
+                            break
+
+                        clients.append(client)
 
-                        if self.server.multi_device and \
-                                self.server.replicating:
-                            self.pool_collection.update({
-                                '_id': client['doc_id'],
-                            }, {'$set': {
-                                'timestamp': utils.now(),
-                            }})
-                    except:
-                        self.clients_queue.append(client_id)
-                        logger.exception('Failed to update client', 'server',
-                            server_id=self.server.id,
-                            instance_id=self.instance.id,
-                        )
-                        yield interrupter_sleep(1)
-                        continue
-
-                    self.clients_queue.append(client_id)
-
-                    yield
                     if self.instance.sock_interrupt:
                         return
+
+                    if clients:
+                        try:
+                            self.ping_flush(clients)
+                        except:
+                            self.clients_queue.extendleft(
+                                reversed([x['id'] for x in clients]))
+                            logger.exception('Failed to update clients',
+                                'server',
+                                server_id=self.server.id,
+                                instance_id=self.instance.id,
+                                client_count=len(clients),
+                            )
+                            yield interrupter_sleep(1)
+                            continue
+
+                        yield
+                        if self.instance.sock_interrupt:
+                            return
+
+                        if len(clients) >= batch_size:
+                            continue
+
+                    if self.server.multi_device and self.server.replicating:
+                        self.pool_lease.renew()
+
+                    if self.interrupter_sleep(flush_interval):
+                        return
                 except GeneratorExit:
                     raise
                 except:
@@ -1384,6 +1390,16 @@ class Clients(object):
                     server_id=self.server.id,
                 )
 
+            if self.server.multi_device and self.server.replicating:
+                try:
+                    self.pool_lease.release()
+                except:
+                    logger.exception('Error releasing address pool lease',
+                        'server',
+                        server_id=self.server.id,
+                        instance_id=self.instance.id,
+                    )
+
     def on_client(self, state, server_id, virt_address, virt_address6,
             host_address, host_address6):
         if server_id != self.server.id:
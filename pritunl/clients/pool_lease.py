@@ -0,0 +1,228 @@
+from pritunl.helpers import *
+from pritunl import settings
+from pritunl import utils
+from pritunl import ipaddress
+from pritunl import mongo
+from pritunl import logger
+
+import threading
+import itertools
+import datetime
+import collections
+import time
+import pymongo
+
+class PoolLease(object):
+    # Reserves blocks of clients_pool documents for one server instance
+    # so dynamic addresses on replicated multi device servers can be
+    # assigned from a local free list. Leased documents have user_id set
+    # to None and lease_id set to the instance id, the lease is kept
+    # alive by renewing the document timestamps and a lease that is not
+    # renewed within pool_lease_ttl can be taken by another instance.
+    def __init__(self, server, lease_id):
+        self.server = server
+        self.lease_id = lease_id
+        self._lock = threading.Lock()
+        self._addrs = collections.deque()
+        self._renew_time = time.time()
+
+    @cached_static_property
+    def pool_collection(cls):
+        return mongo.get_collection('clients_pool')
+
+    @cached_static_property
+    def server_collection(cls):
+        return mongo.get_collection('servers')
+
+    def __len__(self):
+        return len(self._addrs)
+
+    def _lease_free(self, count):
+        now = utils.now()
+        spec = {
+            'server_id': self.server.id,
+            'user_id': None,
+            '$or': [
+                {'lease_id': None},
+                {'timestamp': {'$lt': now - datetime.timedelta(
+                    seconds=settings.vpn.pool_lease_ttl)}},
+            ],
+        }
+
+        doc_ids = [doc['_id'] for doc in self.pool_collection.find(
+            spec, {'_id': True}).limit(count)]
+        if not doc_ids:
+            return []
+
+        spec['_id'] = {'$in': doc_ids}
+        self.pool_collection.update_many(spec, {'$set': {
+            'lease_id': self.lease_id,
+            'timestamp': now,
+        }})
+
+        return [doc['_id'] for doc in self.pool_collection.find({
+            '_id': {'$in': doc_ids},
+            'server_id': self.server.id,
+            'user_id': None,
+            'lease_id': self.lease_id,
+        }, {'_id': True})]
+
+    def _lease_block(self, count):
+        network = ipaddress.IPv4Network(self.server.network)
+
+        for _ in xrange(3):
+            doc = self.server_collection.find_one({
+                '_id': self.server.id,
+            }, {
+                'pool_cursor': True,
+            })
+            if not doc:
+                return []
+            cursor = doc.get('pool_cursor')
+
+            last_addr = None
+            if cursor:
+                last_addr = ipaddress.IPv4Address(utils.long_to_ip(cursor))
+
+            ip_pool = utils.get_ip_pool_reverse(network, last_addr)
+            if not ip_pool:
+                return []
+
+            block = [long(ip_addr._ip) for ip_addr in
+                itertools.islice(ip_pool, count)]
+            if not block:
+                return []
+
+            response = self.server_collection.update({
+                '_id': self.server.id,
+                'pool_cursor': cursor,
+            }, {'$set': {
+                'pool_cursor': block[-1],
+            }})
+            if response['updatedExisting']:
+                break
+        else:
+            return []
+
+        now = utils.now()
+        docs = [{
+            '_id': addr,
+            'server_id': self.server.id,
+            'user_id': None,
+            'mac_addr': None,
+            'client_id': None,
+            'lease_id': self.lease_id,
+            'timestamp': now,
+        } for addr in block]
+
+        try:
+            self.pool_collection.insert_many(docs, ordered=False)
+        except pymongo.errors.BulkWriteError as error:
+            failed = set(
+                x['index'] for x in error.details.get('writeErrors', []))
+            block = [x for i, x in enumerate(block) if i not in failed]
+
+        return block
+
+    def _refill(self):
+        count = settings.vpn.pool_lease_size
+
+        addrs = self._lease_free(count)
+        if len(addrs) < count:
+            addrs += self._lease_block(count - len(addrs))
+
+        self._addrs.extend(addrs)
+        return len(addrs)
+
+    def get(self, user_id, mac_addr, client_id):
+        while True:
+            self._lock.acquire()
+            try:
+                if not self._addrs and not self._refill():
+                    return
+                addr = self._addrs.popleft()
+            finally:
+                self._lock.release()
+
+            response = self.pool_collection.update({
+                '_id': addr,
+                'server_id': self.server.id,
+                'user_id': None,
+                'lease_id': self.lease_id,
+            }, {
+                '$set': {
+                    'user_id': user_id,
+                    'mac_addr': mac_addr,
+                    'client_id': client_id,
+                    'timestamp': utils.now(),
+                },
+                '$unset': {
+                    'lease_id': '',
+                },
+            })
+
+            if response['updatedExisting']:
+                return addr
+
+    def put(self, user_id, client_id):
+        doc = self.pool_collection.find_and_modify({
+            'server_id': self.server.id,
+            'user_id': user_id,
+            'client_id': client_id,
+        }, {'$set': {
+            'user_id': None,
+            'mac_addr': None,
+            'client_id': None,
+            'lease_id': self.lease_id,
+            'timestamp': utils.now(),
+        }}, new=True)
+
+        if doc:
+            self._lock.acquire()
+            try:
+                self._addrs.append(doc['_id'])
+            finally:
+                self._lock.release()
+
+    def renew(self):
+        cur_time = time.time()
+        if cur_time - self._renew_time < \
+                settings.vpn.pool_lease_ttl / 3:
+            return
+        self._renew_time = cur_time
+
+        response = self.pool_collection.update_many({
+            'server_id': self.server.id,
+            'user_id': None,
+            'lease_id': self.lease_id,
+        }, {'$set': {
+            'timestamp': utils.now(),
+        }})
+
+        if response.matched_count < len(self._addrs):
+            logger.warning('Address pool lease lost', 'clients',
+                server_id=self.server.id,
+                lease_id=self.lease_id,
+                leased=len(self._addrs),
+                renewed=response.matched_count,
+            )
+
+    def release(self):
+        self._lock.acquire()
+        try:
+            self._addrs.clear()
+        finally:
+            self._lock.release()
+
+        self.pool_collection.update_many({
+            'server_id': self.server.id,
+            'user_id': None,
+            'lease_id': self.lease_id,
+        }, {
+            '$set': {
+                'timestamp': None,
+            },
+            '$unset': {
+                'lease_id': '',
+            },
+        })
@@ -448,17 +448,36 @@ SUB_RESPONSE_TIMEOUT = 10
 CLIENT_CONF_VER = 1
 MONGO_MESSAGES_SIZE = 100000
 MONGO_MESSAGES_MAX = 2048
+MONGO_SUB_BUFFER = 2048
+CACHE_SUB_BUFFER = 512
+CACHE_SUB_TTL = 30
+CACHE_SUB_POLL = 0.2
+CACHE_SUB_WAIT = 3
 MONGO_CONNECT_TIMEOUT = 15000
 MONGO_SOCKET_TIMEOUT = 30000
 AUTH_SIG_STRING_MAX_LEN = 10240
-SOCKET_BUFFER = 1024
+SOCKET_BUFFER = 16384
 SERVER_OUTPUT_DELAY = 1.5
 SERVER_EVENT_DELAY = 2
+EVENT_BATCH_TICK = 0.025
+LISTENER_FLOOD_SIZE = 50
+LISTENER_LATENCY_BUCKETS = (0.01, 0.05, 0.25, 1, 5)
+LOG_RATE_WINDOW = 60
+LOG_RATE_LIMIT = 10
+LOG_RATE_MAX_KEYS = 10000
 IP_REGEX = r'\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3}'
 VALID_DH_PARAM_BITS = (1024, 1536, 2048, 3072, 4096)
 AUTH_SERVER = 'https://auth.pritunl.com'
 ONELOGIN_URL = 'https://api.onelogin.com'
 NTP_SERVER = 'ntp.ubuntu.com'
+CLIENT_ENV_KEYS = {
+    'IV_HWADDR': 'mac_addr',
+    'untrusted_ip': 'remote_ip',
+    'UV_ID': 'device_id',
+    'UV_NAME': 'device_name',
+    'UV_PLATFORM': 'platform',
+    'password': 'password',
+}
 STATIC_FILE_EXTENSIONS = {
     '.css',
     '.eot',
@@ -515,6 +534,7 @@ DBCONF_NAME = 'dbconf.html'
 UPGRADE_NAME = 'upgrade.html'
 CONF_TEMP_EXT = '.tmp'
 LOG_ARCHIVE_NAME = 'pritunl_log'
+LOG_LEVELS = ('DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL')
 SHUT_DOWN = 'shut_down'
 
 CERT_CA = 'ca'
@@ -3,127 +3,200 @@ import collections
 import bson
 import copy
 
+class DocView(object):
+    __slots__ = ('_doc',)
+
+    def __init__(self, doc):
+        self._doc = doc
+
+    def __getitem__(self, key):
+        return self._doc[key]
+
+    def __setitem__(self, key, val):
+        raise TypeError('Doc view is read only')
+
+    def __delitem__(self, key):
+        raise TypeError('Doc view is read only')
+
+    def __contains__(self, key):
+        return key in self._doc
+
+    def __iter__(self):
+        return iter(self._doc)
+
+    def __len__(self):
+        return len(self._doc)
+
+    def __eq__(self, other):
+        if isinstance(other, DocView):
+            other = other._doc
+        return self._doc == other
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def __repr__(self):
+        return 'DocView(%r)' % self._doc
+
+    def get(self, key, default=None):
+        return self._doc.get(key, default)
+
+    def keys(self):
+        return self._doc.keys()
+
+    def values(self):
+        return self._doc.values()
+
+    def items(self):
+        return self._doc.items()
+
+    def iteritems(self):
+        return self._doc.iteritems()
+
+    def copy(self):
+        return copy.deepcopy(self._doc)
+
 class DocDb(object):
-    def __init__(self, *indexes):
+    # Stored documents are never modified in place, updates replace the
+    # document with a modified copy. This allows reads to run without the
+    # write lock and allows readonly mode to return views of the stored
+    # documents without copying them. Each index has its own lock so
+    # lookups on different indexes do not contend.
+    def __init__(self, *indexes, **kwargs):
+        self._readonly = kwargs.get('readonly', False)
         self._indexes = set()
         self._index = {}
+        self._index_locks = {}
+        self._compound_indexes = []
         self._lock = threading.RLock()
         self._docs = {}
 
         for ind in indexes:
             self._indexes.add(ind)
             self._index[ind] = collections.defaultdict(set)
+            self._index_locks[ind] = threading.Lock()
+            if isinstance(ind, tuple):
+                self._compound_indexes.append(ind)
+
+        self._compound_indexes.sort(key=len, reverse=True)
+
+    def _index_val(self, doc, index_key):
+        if isinstance(index_key, tuple):
+            vals = tuple(doc.get(key) for key in index_key)
+            if None in vals:
+                return None
+            return vals
+        return doc.get(index_key)
+
+    def _index_add(self, index_key, val, doc_id):
+        index_lock = self._index_locks[index_key]
+        index_lock.acquire()
+        try:
+            self._index[index_key][val].add(doc_id)
+        finally:
+            index_lock.release()
+
+    def _index_remove(self, index_key, val, doc_id):
+        index_lock = self._index_locks[index_key]
+        index_lock.acquire()
+        try:
+            index = self._index[index_key]
+            val_index = index.get(val)
+            if val_index is None:
+                return
+            val_index.discard(doc_id)
+            if len(val_index) == 0:
+                index.pop(val)
+        finally:
+            index_lock.release()
+
+    def _index_get(self, index_key, val):
+        index_lock = self._index_locks[index_key]
+        index_lock.acquire()
+        try:
+            val_index = self._index[index_key].get(val)
+            if val_index is None:
+                return set()
+            return set(val_index)
+        finally:
+            index_lock.release()
+
+    def _output(self, doc):
+        if self._readonly:
+            return DocView(doc)
+        return copy.deepcopy(doc)
+
+    def _match(self, doc, query):
+        for key, val in query.items():
+            if doc.get(key) != val:
+                return False
+        return True
 
     def _find(self, query, slow=False, only_id=False):
         if 'id' in query:
             doc_id = query['id']
-            if only_id:
-                self._lock.acquire()
-                try:
-                    if doc_id in self._docs:
-                        return [doc_id]
-                    return []
-                finally:
-                    self._lock.release()
-            else:
-                doc = self.find_id(doc_id)
-                if doc:
-                    return [doc]
+            doc = self._docs.get(doc_id)
+            if doc is None or not self._match(doc, query):
                 return []
+            if only_id:
+                return [doc_id]
+            return [self._output(doc)]
 
-        need = len(query)
-        possible = {}
-        found = []
+        possible = None
+        indexed = set()
 
-        self._lock.acquire()
-        try:
-            index_count = 0
-            for index_key in self._index.keys():
-                val = query.get(index_key, None)
+        for index_key in self._compound_indexes:
+            if any(key in indexed for key in index_key):
+                continue
+            val = self._index_val(query, index_key)
+            if val is None:
+                continue
 
-                if val is not None:
-                    query.pop(index_key, None)
-                    index_count += 1
-                    index = self._index[index_key]
-                    if val in index:
-                        for doc_id in index[val]:
-                            matched = possible.get(doc_id, 0) + 1
-                            possible[doc_id] = matched
-                            if matched == need:
-                                if only_id:
-                                    found.append(doc_id)
-                                else:
-                                    doc = copy.deepcopy(self._docs[doc_id])
-                                    doc['id'] = doc_id
-                                    found.append(doc)
-
-            if not index_count:
-                if not slow:
-                    raise IndexError('Non indexed query')
-
-                for doc_id, doc in self._docs.items():
-                    match = True
-                    for key, val in query.items():
-                        if doc[key] != val:
-                            match = False
-                            break
-                    if match:
-                        if only_id:
-                            found.append(doc_id)
-                        else:
-                            doc = copy.deepcopy(doc)
-                            doc['id'] = doc_id
-                            found.append(doc)
-            elif index_count != need:
-                for doc_id, matched in possible.items():
-                    if matched != index_count:
-                        continue
-                    doc = self._docs[doc_id]
-                    match = True
-                    for key, val in query.items():
-                        if doc[key] != val:
-                            match = False
-                            break
-                    if match:
-                        if only_id:
-                            found.append(doc_id)
-                        else:
-                            doc = copy.deepcopy(doc)
-                            doc['id'] = doc_id
-                            found.append(doc)
-        finally:
-            self._lock.release()
+            doc_ids = self._index_get(index_key, val)
+            possible = doc_ids if possible is None else possible & doc_ids
+            indexed.update(index_key)
 
-        return found
+        for key, val in query.items():
+            if val is None or key in indexed or key not in self._indexes:
+                continue
 
-    def find_all(self):
-        found = []
+            doc_ids = self._index_get(key, val)
+            possible = doc_ids if possible is None else possible & doc_ids
+            indexed.add(key)
 
-        for doc_id, doc in self._docs.items():
-            doc = copy.deepcopy(doc)
-            doc['id'] = doc_id
-            found.append(doc)
+        if possible is None:
+            if not slow:
+                raise IndexError('Non indexed query')
+            possible = self._docs.keys()
+
+        found = []
+        for doc_id in possible:
+            doc = self._docs.get(doc_id)
+            if doc is None or not self._match(doc, query):
+                continue
+            if only_id:
+                found.append(doc_id)
+            else:
+                found.append(self._output(doc))
 
         return found
 
+    def find_all(self):
+        return [self._output(doc) for doc in self._docs.values()]
+
     def find(self, query, slow=False):
         return self._find(query, slow)
 
     def find_id(self, doc_id):
-        self._lock.acquire()
-        try:
-            doc = self._docs.get(doc_id)
-            if doc:
-                doc = copy.deepcopy(doc)
-                doc['id'] = doc_id
-                return doc
-        finally:
-            self._lock.release()
+        doc = self._docs.get(doc_id)
+        if doc:
+            return self._output(doc)
 
     def insert(self, doc, upsert=False):
         orig_doc = doc
         doc = copy.deepcopy(doc)
         doc_id = doc.pop('id', bson.ObjectId())
+        doc['id'] = doc_id
         orig_doc['id'] = doc_id
 
         self._lock.acquire()
@@ -133,10 +206,10 @@ class DocDb(object):
             elif doc_id in self._docs:
                 raise KeyError('Doc id already exists')
 
-            for index_key, index in self._index.items():
-                val = doc.get(index_key)
+            for index_key in self._indexes:
+                val = self._index_val(doc, index_key)
                 if val is not None:
-                    index[val].add(doc_id)
+                    self._index_add(index_key, val, doc_id)
 
             self._docs[doc_id] = doc
         finally:
@@ -146,43 +219,31 @@ class DocDb(object):
 
     def _update(self, doc_ids, update):
         for doc_id in doc_ids:
-            doc = self._docs[doc_id]
-
-            for key, val in update.items():
-                if key in self._indexes:
-                    index = self._index[key]
-
-                    cur_val = doc.get(key)
-                    if cur_val is not None:
-                        val_index = index[cur_val]
-                        val_index.remove(doc_id)
-                        if len(val_index) == 0:
-                            index.pop(cur_val)
-
-                    if val is not None:
-                        index[val].add(doc_id)
+            cur_doc = self._docs[doc_id]
+            doc = cur_doc.copy()
+            doc.update(update)
+
+            for index_key in self._indexes:
+                cur_val = self._index_val(cur_doc, index_key)
+                val = self._index_val(doc, index_key)
+                if cur_val == val:
+                    continue
+
+                if cur_val is not None:
+                    self._index_remove(index_key, cur_val, doc_id)
+                if val is not None:
+                    self._index_add(index_key, val, doc_id)
 
-                doc[key] = val
+            self._docs[doc_id] = doc
 
     def count(self, query, slow=False):
-        self._lock.acquire()
-        try:
-            if not query:
-                return len(self._docs)
-            doc_ids = self._find(query, slow, True)
-        finally:
-            self._lock.release()
-
-        return len(doc_ids)
+        if not query:
+            return len(self._docs)
+        return len(self._find(query, slow, True))
 
     def count_id(self, doc_id):
-        self._lock.acquire()
-        try:
-            if doc_id in self._docs:
-                return 1
-        finally:
-            self._lock.release()
-
+        if doc_id in self._docs:
+            return 1
         return 0
 
     def update(self, query, update, slow=False):
@@ -210,13 +271,10 @@ class DocDb(object):
         for doc_id in doc_ids:
             doc = self._docs.pop(doc_id)
 
-            for index_key, index in self._index.items():
-                val = doc.get(index_key)
+            for index_key in self._indexes:
+                val = self._index_val(doc, index_key)
                 if val is not None:
-                    val_index = index[val]
-                    val_index.remove(doc_id)
-                    if len(val_index) == 0:
-                        index.pop(val)
+                    self._index_remove(index_key, val, doc_id)
 
     def remove(self, query, slow=False):
         self._lock.acquire()
@@ -236,3 +294,5 @@ class DocDb(object):
             self._remove([doc_id])
         finally:
             self._lock.release()
+
+        return True
@@ -15,6 +15,14 @@ class Event(object):
 
         messenger.publish('events', (type, resource_id))
 
+def publish_events(events):
+    # Multiple events are sent as one message containing a list of
+    # (type, resource_id) pairs
+    if len(events) == 1:
+        messenger.publish('events', events[0])
+    else:
+        messenger.publish('events', events)
+
 def get_events(cursor=None, yield_app_server=False):
     events = []
     events_dict = {}
@@ -24,21 +32,29 @@ def get_events(cursor=None, yield_app_server=False):
 
     for event in messenger.subscribe('events', cursor_id=cursor,
             timeout=10, yield_delay=0.02, yield_app_server=yield_app_server):
-        event_type, resource_id = event.pop('message')
-        if (event_type, resource_id) in events_dict:
-            old_event = events_dict[(event_type, resource_id)]
-            old_event['id'] = event['_id']
-            old_event['timestamp'] = time.mktime(
-                event['timestamp'].timetuple())
-            continue
-
-        events_dict[(event_type, resource_id)] = event
-        event['id'] = event.pop('_id')
-        event['type'] = event_type
-        event['resource_id'] = resource_id
-        event['timestamp'] = time.mktime(event['timestamp'].timetuple())
-        event.pop('channel')
-
-        events.append(event)
+        message = event['message']
+        if message and isinstance(message[0], (list, tuple)):
+            batch = message
+        else:
+            batch = (message,)
+
+        event_id = event['_id']
+        timestamp = time.mktime(event['timestamp'].timetuple())
+
+        for event_type, resource_id in batch:
+            if (event_type, resource_id) in events_dict:
+                old_event = events_dict[(event_type, resource_id)]
+                old_event['id'] = event_id
+                old_event['timestamp'] = timestamp
+                continue
+
+            evt = {
+                'id': event_id,
+                'type': event_type,
+                'resource_id': resource_id,
+                'timestamp': timestamp,
+            }
+            events_dict[(event_type, resource_id)] = evt
+            events.append(evt)
 
     return events
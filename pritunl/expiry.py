@@ -0,0 +1,99 @@
+import threading
+import heapq
+import itertools
+import time
+
+class ExpiryScheduler(object):
+    # Runs delayed calls from one heap serviced by a single thread. Canceled
+    # entries are left in the heap and skipped when they reach the top, the
+    # heap is rebuilt when canceled entries outnumber active entries.
+    def __init__(self):
+        self._heap = []
+        self._counter = itertools.count()
+        self._canceled = 0
+        self._lock = threading.Lock()
+        self._cond = threading.Condition(self._lock)
+        self._thread = None
+
+    def __len__(self):
+        return len(self._heap) - self._canceled
+
+    def schedule(self, delay, func, *args):
+        entry = [time.time() + delay, next(self._counter), func, args, True]
+
+        self._lock.acquire()
+        try:
+            heapq.heappush(self._heap, entry)
+            if self._heap[0] is entry:
+                self._cond.notify()
+
+            if not self._thread:
+                self._thread = threading.Thread(target=self._run)
+                self._thread.daemon = True
+                self._thread.start()
+        finally:
+            self._lock.release()
+
+        return entry
+
+    def cancel(self, entry):
+        if not entry or not entry[4]:
+            return
+
+        self._lock.acquire()
+        try:
+            if not entry[4]:
+                return
+            entry[4] = False
+            self._canceled += 1
+
+            if self._canceled > 1024 and \
+                    self._canceled > len(self._heap) // 2:
+                self._heap = [x for x in self._heap if x[4]]
+                heapq.heapify(self._heap)
+                self._canceled = 0
+        finally:
+            self._lock.release()
+
+    def _pop_expired(self):
+        self._lock.acquire()
+        try:
+            while True:
+                while self._heap and not self._heap[0][4]:
+                    heapq.heappop(self._heap)
+                    self._canceled -= 1
+
+                if not self._heap:
+                    self._cond.wait()
+                    continue
+
+                timeout = self._heap[0][0] - time.time()
+                if timeout > 0:
+                    self._cond.wait(timeout)
+                    continue
+
+                entry = heapq.heappop(self._heap)
+                entry[4] = False
+                return entry
+        finally:
+            self._lock.release()
+
+    def _run(self):
+        while True:
+            entry = self._pop_expired()
+            try:
+                entry[2](*entry[3])
+            except:
+                from pritunl import logger
+                logger.exception('Error in expiry callback', 'expiry')
+
+_scheduler = ExpiryScheduler()
+
+def schedule(delay, func, *args):
+    return _scheduler.schedule(delay, func, *args)
+
+def cancel(entry):
+    _scheduler.cancel(entry)
+
+def count():
+    return len(_scheduler)
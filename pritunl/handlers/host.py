@@ -30,11 +30,17 @@ def host_get(hst=None):
     hosts = []
     page = flask.request.args.get('page', None)
     page = int(page) if page else page
-
-    for hst in host.iter_hosts_dict(page=page):
-        if settings.app.demo_mode:
-            hst['users_online'] = hst['user_count']
-        hosts.append(hst)
+    page_cursor = flask.request.args.get('next', None)
+    page_state = {}
+
+    try:
+        for hst in host.iter_hosts_dict(page=page, page_cursor=page_cursor,
+                page_state=page_state):
+            if settings.app.demo_mode:
+                hst['users_online'] = hst['user_count']
+            hosts.append(hst)
+    except ValueError:
+        return flask.abort(400)
 
     if page is not None:
         resp = {
@@ -42,6 +48,11 @@ def host_get(hst=None):
             'page_total': host.get_host_page_total(),
             'hosts': hosts,
         }
+    elif page_cursor is not None:
+        resp = {
+            'next': page_state.get('next_page_cursor'),
+            'hosts': hosts,
+        }
     else:
         resp = hosts
 
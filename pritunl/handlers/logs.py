@@ -6,6 +6,9 @@ from pritunl import utils
 from pritunl import auth
 from pritunl import settings
 
+import flask
+import json
+
 @app.app.route('/logs', methods=['GET'])
 @auth.session_auth
 def logs_get():
@@ -15,9 +18,28 @@ def logs_get():
         })
 
     log_view = logger.LogView()
-    return utils.jsonify({
-        'output': log_view.get_log_lines(
+    limit = flask.request.args.get('limit', None)
+
+    try:
+        lines = log_view.iter_log_lines(
+            since=logger.parse_log_time(flask.request.args.get('since')),
+            until=logger.parse_log_time(flask.request.args.get('until')),
+            level=flask.request.args.get('level') or None,
+            host=flask.request.args.get('host') or None,
+            limit=int(limit) if limit else None,
             formatted=False,
-            reverse=True,
-        ).split('\n'),
-    })
+        )
+        first_line = next(lines, None)
+    except ValueError:
+        return flask.abort(400)
+
+    def generate():
+        yield '{"output": ['
+        if first_line is not None:
+            yield json.dumps(first_line)
+            for line in lines:
+                yield ', ' + json.dumps(line)
+        yield ']}'
+
+    return flask.Response(flask.stream_with_context(generate()),
+        mimetype='application/json')
@@ -27,14 +27,20 @@ def org_get(org_id=None):
     orgs = []
     page = flask.request.args.get('page', None)
     page = int(page) if page else page
+    page_cursor = flask.request.args.get('next', None)
+    page_state = {}
 
     if settings.app.demo_mode:
-        resp = utils.demo_get_cache(page)
+        resp = utils.demo_get_cache(page, page_cursor)
         if resp:
             return utils.jsonify(resp)
 
-    for org in organization.iter_orgs(page=page):
-        orgs.append(org.dict())
+    try:
+        for org in organization.iter_orgs(page=page,
+                page_cursor=page_cursor, page_state=page_state):
+            orgs.append(org.dict())
+    except ValueError:
+        return flask.abort(400)
 
     if page is not None:
         resp = {
@@ -42,11 +48,16 @@ def org_get(org_id=None):
             'page_total': organization.get_org_page_total(),
             'organizations': orgs,
         }
+    elif page_cursor is not None:
+        resp = {
+            'next': page_state.get('next_page_cursor'),
+            'organizations': orgs,
+        }
     else:
         resp = orgs
 
     if settings.app.demo_mode:
-        utils.demo_set_cache(resp, page)
+        utils.demo_set_cache(resp, page, page_cursor)
     return utils.jsonify(resp)
 
 @app.app.route('/organization', methods=['POST'])
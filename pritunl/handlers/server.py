@@ -110,14 +110,20 @@ def server_get(server_id=None):
     servers = []
     page = flask.request.args.get('page', None)
     page = int(page) if page else page
+    page_cursor = flask.request.args.get('next', None)
+    page_state = {}
 
     if settings.app.demo_mode:
-        resp = utils.demo_get_cache(page)
+        resp = utils.demo_get_cache(page, page_cursor)
         if resp:
             return utils.jsonify(resp)
 
-    for svr in server.iter_servers_dict(page=page):
-        servers.append(svr)
+    try:
+        for svr in server.iter_servers_dict(page=page,
+                page_cursor=page_cursor, page_state=page_state):
+            servers.append(svr)
+    except ValueError:
+        return flask.abort(400)
 
     if page is not None:
         resp = {
@@ -125,11 +131,16 @@ def server_get(server_id=None):
             'page_total': server.get_server_page_total(),
             'servers': servers,
         }
+    elif page_cursor is not None:
+        resp = {
+            'next': page_state.get('next_page_cursor'),
+            'servers': servers,
+        }
     else:
         resp = servers
 
     if settings.app.demo_mode:
-        utils.demo_set_cache(resp, page)
+        utils.demo_set_cache(resp, page, page_cursor)
     return utils.jsonify(resp)
 
 @app.app.route('/server', methods=['POST'])
@@ -1227,6 +1238,26 @@ def server_bandwidth_get(server_id, period):
         resp = server.bandwidth_get(server_id, period)
     return utils.jsonify(resp)
 
+@app.app.route('/server/<server_id>/bandwidth/<period>/top',
+    methods=['GET'])
+@auth.session_auth
+def server_bandwidth_top_get(server_id, period):
+    if settings.app.demo_mode:
+        return utils.jsonify([])
+
+    if period not in ('1m', '5m', '30m', '2h', '1d'):
+        return flask.abort(404)
+
+    try:
+        limit = int(flask.request.args.get('limit', 10))
+    except ValueError:
+        return flask.abort(400)
+    limit = max(1, min(limit, 100))
+    devices = flask.request.args.get('group') == 'device'
+
+    return utils.jsonify(server.bandwidth_top_get(
+        server_id, period, limit, devices))
+
 @app.app.route('/server/vpcs', methods=['GET'])
 @auth.session_auth
 def server_vpcs_get():
@@ -52,6 +52,7 @@ def user_get(org_id, user_id=None, page=None):
 
     page = flask.request.args.get('page', page)
     page = int(page) if page else page
+    page_cursor = flask.request.args.get('next', None)
     search = flask.request.args.get('search', None)
     limit = int(flask.request.args.get('limit', settings.user.page_count))
     otp_auth = False
@@ -60,7 +61,7 @@ def user_get(org_id, user_id=None, page=None):
     servers = []
 
     if settings.app.demo_mode:
-        resp = utils.demo_get_cache(page, search, limit)
+        resp = utils.demo_get_cache(page, page_cursor, search, limit)
         if resp:
             return utils.jsonify(resp)
 
@@ -94,8 +95,14 @@ def user_get(org_id, user_id=None, page=None):
         'dns_suffix',
         'port_forwarding',
     )
+    if page_cursor:
+        try:
+            utils.get_page_cursor_spec(page_cursor)
+        except ValueError:
+            return flask.abort(400)
+
     for usr in org.iter_users(page=page, search=search,
-            search_limit=limit, fields=fields):
+            search_limit=limit, fields=fields, page_cursor=page_cursor):
         users_id.append(usr.id)
 
         user_dict = usr.dict()
@@ -200,6 +207,12 @@ def user_get(org_id, user_id=None, page=None):
             'server_count': server_count,
             'users': users,
         }
+    elif page_cursor is not None and search is None:
+        resp = {
+            'next': org.next_page_cursor,
+            'server_count': server_count,
+            'users': users,
+        }
     elif search is not None:
         resp = {
             'search': search,
@@ -214,7 +227,7 @@ def user_get(org_id, user_id=None, page=None):
         resp = users
 
     if settings.app.demo_mode and not search:
-        utils.demo_set_cache(resp, page, search, limit)
+        utils.demo_set_cache(resp, page, page_cursor, search, limit)
     return utils.jsonify(resp)
 
 def _create_user(users, org, user_data, remote_addr, pool):
@@ -13,11 +13,13 @@ import collections
 import random
 import socket
 import math
+import pymongo
 
 def get_by_id(id, fields=None):
     return Host(id=id, fields=fields)
 
-def iter_hosts(spec=None, fields=None, page=None):
+def iter_hosts(spec=None, fields=None, page=None, page_cursor=None,
+        page_state=None):
     limit = None
     skip = None
     page_count = settings.app.host_page_count
@@ -31,15 +33,34 @@ def iter_hosts(spec=None, fields=None, page=None):
     if page is not None:
         limit = page_count
         skip = page * page_count if page else 0
+    elif page_cursor is not None:
+        limit = page_count
+        if page_cursor:
+            spec.update(utils.get_page_cursor_spec(page_cursor))
 
-    cursor = Host.collection.find(spec, fields).sort('name')
+    cursor = Host.collection.find(spec, fields).sort([
+        ('name', pymongo.ASCENDING),
+        ('_id', pymongo.ASCENDING),
+    ])
 
     if skip is not None:
         cursor = cursor.skip(page * page_count if page else 0)
     if limit is not None:
-        cursor = cursor.limit(limit)
+        cursor = cursor.limit(limit + 1)
+
+    if page_state is not None:
+        page_state['next_page_cursor'] = None
 
+    count = 0
+    last_doc = None
     for doc in cursor:
+        count += 1
+        if limit is not None and count > limit:
+            if page_state is not None:
+                page_state['next_page_cursor'] = utils.get_page_cursor(
+                    last_doc.get('name'), last_doc['_id'])
+            return
+        last_doc = doc
         yield Host(doc=doc, fields=fields)
 
 def get_host_page_total():
@@ -62,7 +83,7 @@ def get_hosts_online():
         'status': True,
     }).count()
 
-def iter_hosts_dict(page=None):
+def iter_hosts_dict(page=None, page_cursor=None, page_state=None):
     clients_collection = mongo.get_collection('clients')
     server_collection = mongo.get_collection('servers')
 
@@ -87,7 +108,8 @@ def iter_hosts_dict(page=None):
 
     org_user_count = organization.get_user_count(orgs)
 
-    for hst in iter_hosts(page=page):
+    for hst in iter_hosts(page=page, page_cursor=page_cursor,
+            page_state=page_state):
         users_online = len(clients_collection.distinct("user_id", {
             'host_id': hst.id,
             'type': CERT_CLIENT,
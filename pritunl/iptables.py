@@ -1,9 +1,12 @@
 from pritunl import utils
 from pritunl import logger
 from pritunl import settings
+from pritunl import ipaddress
 
 import itertools
 import subprocess
+import collections
+import shlex
 import time
 import threading
 try:
@@ -13,6 +16,25 @@ except:
     LIB_IPTABLES = False
 
 _global_lock = threading.Lock()
+_restore_lock = threading.Lock()
+_restore_queue = collections.deque()
+_restore_event = threading.Event()
+_restore_thread = None
+_restore_available = True
+_ipset_available = None
+_option_aliases = {
+    '--source': '-s',
+    '--destination': '-d',
+    '--in-interface': '-i',
+    '--out-interface': '-o',
+    '--protocol': '-p',
+    '--jump': '-j',
+    '--match': '-m',
+    '--table': '-t',
+}
+_protocol_aliases = {
+    'icmpv6': 'ipv6-icmp',
+}
 
 class Iptables(object):
     def __init__(self):
@@ -42,6 +64,9 @@ class Iptables(object):
         self.ipv6 = False
         self.cleared = False
         self.restrict_routes = False
+        self.ipset = False
+        self._ipset_chains = {}
+        self._ipset_chains6 = {}
 
     def add_route(self, network, nat=False, nat_interface=None):
         if self.cleared:
@@ -78,7 +103,10 @@ class Iptables(object):
         try:
             self._other.append(rule)
             if not self._exists_iptables_rule(rule):
-                self._insert_iptables_rule(rule)
+                if _restore_enabled(rule):
+                    _restore_put(self, '-I', rule, False)
+                else:
+                    self._insert_iptables_rule(rule)
         finally:
             self._lock.release()
 
@@ -90,7 +118,10 @@ class Iptables(object):
         try:
             self._other6.append(rule)
             if not self._exists_iptables_rule(rule, ipv6=True):
-                self._insert_iptables_rule(rule, ipv6=True)
+                if _restore_enabled(rule):
+                    _restore_put(self, '-I', rule, True)
+                else:
+                    self._insert_iptables_rule(rule, ipv6=True)
         finally:
             self._lock.release()
 
@@ -101,7 +132,10 @@ class Iptables(object):
         self._lock.acquire()
         try:
             self._other.remove(rule)
-            self._remove_iptables_rule(rule)
+            if _restore_enabled(rule):
+                _restore_put(self, '-D', rule, False)
+            else:
+                self._remove_iptables_rule(rule)
         except ValueError:
             logger.warning('Lost iptables rule', 'iptables',
                 rule=rule,
@@ -116,7 +150,10 @@ class Iptables(object):
         self._lock.acquire()
         try:
             self._other6.remove(rule)
-            self._remove_iptables_rule(rule, ipv6=True)
+            if _restore_enabled(rule):
+                _restore_put(self, '-D', rule, True)
+            else:
+                self._remove_iptables_rule(rule, ipv6=True)
         except ValueError:
             logger.warning('Lost ip6tables rule', 'iptables',
                 rule=rule,
@@ -963,6 +1000,189 @@ class Iptables(object):
         self._generate_forward()
         self._generate_post_routing()
 
+        if self.ipset:
+            self._generate_ipset()
+
+    def _set_name(self, name, ipv6=False):
+        return 'pr%s%s%s' % (self.id, name, '6' if ipv6 else '')
+
+    def _chain_name(self, name):
+        return '%s%s' % (name, self.id)
+
+    def _generate_ipset_chains(self, network, ipv6=False):
+        client_set = self._set_name('cc', ipv6)
+        forward_set = self._set_name('pf', ipv6)
+        established_set = self._set_name('pe', ipv6)
+
+        return {
+            self._chain_name('PR'): [
+                [
+                    '-d', network,
+                    '-m', 'set',
+                    '--match-set', client_set, 'src',
+                    '-j', 'ACCEPT',
+                ],
+                [
+                    '-s', network,
+                    '-m', 'set',
+                    '--match-set', client_set, 'dst',
+                    '-j', 'ACCEPT',
+                ],
+                [
+                    '-m', 'set',
+                    '--match-set', client_set, 'src',
+                    '-j', 'DROP',
+                ],
+                [
+                    '-m', 'set',
+                    '--match-set', client_set, 'dst',
+                    '-j', 'DROP',
+                ],
+            ],
+            self._chain_name('PF'): [
+                [
+                    '-i', self.virt_interface,
+                    '-m', 'set',
+                    '--match-set', established_set, 'src',
+                    '-m', 'conntrack',
+                    '--ctstate', 'RELATED,ESTABLISHED',
+                    '-j', 'ACCEPT',
+                ],
+                [
+                    '-o', self.virt_interface,
+                    '-m', 'set',
+                    '--match-set', forward_set, 'dst,dst',
+                    '-j', 'ACCEPT',
+                ],
+            ],
+        }
+
+    def _generate_ipset(self):
+        self._ipset_chains = self._generate_ipset_chains(self.virt_network)
+        self._ipset_chains6 = self._generate_ipset_chains(
+            self.virt_network6, ipv6=True)
+
+        client_chain = self._chain_name('PR')
+        forward_chain = self._chain_name('PF')
+
+        for accept in (self._accept, self._accept6):
+            for chain in ('INPUT', 'OUTPUT', 'FORWARD'):
+                accept.append([
+                    chain,
+                    '-j', client_chain,
+                ])
+            accept.append([
+                'FORWARD',
+                '-j', forward_chain,
+            ])
+
+    def _ipset_restore(self, lines):
+        process = subprocess.Popen(
+            ['ipset', 'restore', '-exist'],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+        )
+        stdoutdata, stderrdata = process.communicate(
+            '\n'.join(lines) + '\n')
+        return_code = process.poll()
+
+        if return_code:
+            logger.error('Failed to update ipset', 'iptables',
+                return_code=return_code,
+                stdout=stdoutdata,
+                stderr=stderrdata,
+                lines=lines,
+            )
+            raise subprocess.CalledProcessError(return_code, 'ipset')
+
+    def _upsert_ipset(self, log=False):
+        lines = []
+        for ipv6 in (False, True) if self.ipv6 else (False,):
+            family = 'inet6' if ipv6 else 'inet'
+            lines.append('create %s hash:ip family %s' % (
+                self._set_name('cc', ipv6), family))
+            lines.append('create %s hash:ip family %s' % (
+                self._set_name('pe', ipv6), family))
+            lines.append('create %s hash:ip,port family %s' % (
+                self._set_name('pf', ipv6), family))
+        self._ipset_restore(lines)
+
+        for ipv6 in (False, True) if self.ipv6 else (False,):
+            chains = self._ipset_chains6 if ipv6 else self._ipset_chains
+
+            for chain, chain_rules in chains.items():
+                expected = ['-N %s' % chain] + [
+                    '-A %s %s' % (chain, ' '.join(rule))
+                    for rule in chain_rules]
+
+                process = subprocess.Popen(
+                    ['ip6tables' if ipv6 else 'iptables', '-S', chain],
+                    stdout=subprocess.PIPE,
+                    stderr=subprocess.PIPE,
+                )
+                output, _ = process.communicate()
+                if process.poll():
+                    current = None
+                else:
+                    current = [x.strip() for x in output.splitlines()
+                        if x.strip()]
+
+                if current == expected:
+                    continue
+
+                if log and current is not None:
+                    logger.error(
+                        'Unexpected change of iptables chain, ' +
+                            'rebuilding...',
+                        'instance',
+                        chain=chain,
+                        current=current,
+                    )
+
+                lines = [':%s - [0:0]' % chain] + expected[1:]
+                if not _restore_exec(ipv6, 'filter', lines):
+                    raise ValueError('Failed to create iptables chain')
+
+    def _clear_ipset(self):
+        for ipv6 in (False, True) if self.ipv6 else (False,):
+            chains = self._ipset_chains6 if ipv6 else self._ipset_chains
+            cmd = 'ip6tables' if ipv6 else 'iptables'
+
+            _global_lock.acquire()
+            try:
+                for chain in chains.keys():
+                    for flag in ('-F', '-X'):
+                        try:
+                            utils.check_call_silent([cmd, flag, chain])
+                        except subprocess.CalledProcessError:
+                            pass
+            finally:
+                _global_lock.release()
+
+            for name in ('cc', 'pe', 'pf'):
+                try:
+                    utils.check_call_silent(
+                        ['ipset', 'destroy', self._set_name(name, ipv6)])
+                except subprocess.CalledProcessError:
+                    pass
+
+    def add_set_entries(self, entries):
+        if self.cleared or not entries:
+            return
+
+        self._ipset_restore(['add %s %s' % (
+            self._set_name(name, ipv6), entry)
+            for name, entry, ipv6 in entries])
+
+    def remove_set_entries(self, entries):
+        if self.cleared or not entries:
+            return
+
+        self._ipset_restore(['del %s %s' % (
+            self._set_name(name, ipv6), entry)
+            for name, entry, ipv6 in entries])
+
     def _init_rule(self):
         rule = iptc.Rule()
         # match = iptc.Match(rule, 'comment')
@@ -1177,6 +1397,60 @@ class Iptables(object):
         finally:
             _global_lock.release()
 
+    def _upsert_rules_save(self, log=False):
+        for ipv6 in (False, True) if self.ipv6 else (False,):
+            existing = _save_rules(ipv6, 'pritunl-%s' % self.id)
+            if existing is None:
+                return False
+
+            if ipv6:
+                upsert = [('-I', self._accept6)]
+                if self.restrict_routes:
+                    upsert.append(('-A', self._drop6))
+            else:
+                upsert = [('-I', self._accept)]
+                if self.restrict_routes:
+                    upsert.append(('-A', self._drop))
+
+            batches = collections.OrderedDict()
+            for action, rules in upsert:
+                for rule in rules:
+                    table, chain, args = _split_rule(self._parse_rule(rule))
+
+                    key = _rule_key(table, chain, args)
+                    if existing[key] > 0:
+                        existing[key] -= 1
+                        continue
+
+                    if log:
+                        logger.error(
+                            'Unexpected loss of %s rule, ' % (
+                                'ip6tables' if ipv6 else 'iptables') +
+                                'adding again...',
+                            'instance',
+                            rule=rule,
+                        )
+
+                    batch = batches.get(table)
+                    if batch is None:
+                        batch = ([], [])
+                        batches[table] = batch
+                    batch[0].append((action, rule))
+                    batch[1].append(_restore_line(self, action, rule)[1])
+
+            for table, (batch_rules, lines) in batches.items():
+                if settings.vpn.iptables_restore and _restore_available and \
+                        _restore_exec(ipv6, table, lines):
+                    continue
+
+                for action, rule in batch_rules:
+                    if action == '-I':
+                        self._insert_iptables_rule(rule, ipv6=ipv6)
+                    else:
+                        self._append_iptables_rule(rule, ipv6=ipv6)
+
+        return True
+
     def upsert_rules(self, log=False):
         if self.cleared:
             return
@@ -1202,6 +1476,12 @@ class Iptables(object):
             if not self._accept:
                 return
 
+            if self.ipset:
+                self._upsert_ipset(log=log)
+
+            if not tables and self._upsert_rules_save(log=log):
+                return
+
             for rule in self._accept:
                 if not self._exists_iptables_rule(rule, tables=tables):
                     if log:
@@ -1284,6 +1564,8 @@ class Iptables(object):
 
             self.cleared = True
 
+            restore_flush()
+
             for rule in self._accept + self._other:
                 self._remove_iptables_rule(rule, tables=tables)
 
@@ -1301,6 +1583,9 @@ class Iptables(object):
                         self._remove_iptables_rule(rule, ipv6=True,
                             tables=tables)
 
+            if self.ipset:
+                self._clear_ipset()
+
             self._accept = None
             self._accept6 = None
             self._other = None
@@ -1314,3 +1599,265 @@ class Iptables(object):
             # tables['filter6'].commit()
         finally:
             self._lock.release()
+
+def _restore_enabled(rule):
+    return settings.vpn.iptables_restore and _restore_available and \
+        not isinstance(rule, tuple)
+
+def _restore_put(iptables, action, rule, ipv6):
+    global _restore_thread
+
+    _restore_queue.append((iptables, action, rule, ipv6))
+    _restore_event.set()
+
+    if not _restore_thread:
+        _restore_lock.acquire()
+        try:
+            if not _restore_thread:
+                _restore_thread = threading.Thread(target=_restore_runner)
+                _restore_thread.daemon = True
+                _restore_thread.start()
+        finally:
+            _restore_lock.release()
+
+def _restore_runner():
+    while True:
+        _restore_event.wait()
+        time.sleep(settings.vpn.iptables_restore_delay)
+        _restore_event.clear()
+
+        try:
+            restore_flush()
+        except:
+            logger.exception('Error in iptables restore runner', 'iptables')
+            time.sleep(0.5)
+
+def _restore_coalesce(ops):
+    # An insert followed by a delete of the same rule in the same batch
+    # has no effect and both are dropped
+    pending = collections.defaultdict(list)
+    skip = set()
+
+    for i, (iptables, action, rule, ipv6) in enumerate(ops):
+        key = (id(iptables), ipv6, tuple(rule))
+        if action == '-I':
+            pending[key].append(i)
+        elif pending[key]:
+            skip.add(pending[key].pop())
+            skip.add(i)
+
+    return [op for i, op in enumerate(ops) if i not in skip]
+
+def _split_rule(rule):
+    chain = rule[0]
+    table = 'filter'
+    args = []
+
+    i = 1
+    while i < len(rule):
+        if rule[i] == '-t':
+            table = rule[i + 1]
+            i += 2
+            continue
+        args.append(rule[i])
+        i += 1
+
+    return table, chain, args
+
+def _restore_line(iptables, action, rule):
+    table, chain, args = _split_rule(iptables._parse_rule(rule))
+
+    for i, arg in enumerate(args):
+        if not arg or ' ' in arg or '"' in arg:
+            args[i] = '"%s"' % arg.replace('"', '\\"')
+
+    return table, ' '.join([action, chain] + args)
+
+def _rule_key(table, chain, args):
+    # Rules are compared as sorted option groups since iptables-save
+    # reorders options and normalizes addresses
+    groups = []
+    group = None
+    negate = False
+
+    for arg in args:
+        if arg == '!':
+            negate = True
+            continue
+
+        if arg.startswith('-') and len(arg) > 1 and not arg[1].isdigit():
+            group = [_option_aliases.get(arg, arg)]
+            if negate:
+                group.insert(0, '!')
+                negate = False
+            groups.append(group)
+            continue
+
+        if group is None:
+            continue
+
+        if negate:
+            group.append('!')
+            negate = False
+
+        option = group[1] if group[0] == '!' else group[0]
+        if option in ('-s', '-d'):
+            try:
+                network = ipaddress.IPNetwork(arg).masked()
+            except ValueError:
+                pass
+            else:
+                # iptables-save omits addresses matching any host
+                if network.prefixlen == 0 and group[0] != '!':
+                    groups.remove(group)
+                    group = None
+                    continue
+                arg = str(network)
+        elif option == '-p':
+            arg = _protocol_aliases.get(arg, arg)
+        group.append(arg)
+
+    return table, chain, tuple(sorted(tuple(x) for x in groups))
+
+def _save_rules(ipv6, comment):
+    _global_lock.acquire()
+    try:
+        try:
+            process = subprocess.Popen(
+                ['ip6tables-save' if ipv6 else 'iptables-save'],
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+            )
+        except OSError:
+            return
+
+        stdoutdata, stderrdata = process.communicate()
+        return_code = process.poll()
+    finally:
+        _global_lock.release()
+
+    if return_code:
+        logger.error('Failed to read iptables rules', 'iptables',
+            ipv6=ipv6,
+            return_code=return_code,
+            stderr=stderrdata,
+        )
+        return
+
+    rules = collections.Counter()
+    table = None
+
+    for line in stdoutdata.splitlines():
+        if line.startswith('*'):
+            table = line[1:].strip()
+            continue
+
+        if not line.startswith('-A ') or comment not in line:
+            continue
+
+        try:
+            line = shlex.split(line)
+        except ValueError:
+            continue
+
+        rules[_rule_key(table, line[1], line[2:])] += 1
+
+    return rules
+
+def _restore_exec(ipv6, table, lines):
+    global _restore_available
+
+    data = '*%s\n%s\nCOMMIT\n' % (table, '\n'.join(lines))
+
+    _global_lock.acquire()
+    try:
+        try:
+            process = subprocess.Popen(
+                ['ip6tables-restore' if ipv6 else 'iptables-restore',
+                    '--noflush'],
+                stdin=subprocess.PIPE,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+            )
+        except OSError:
+            _restore_available = False
+            logger.exception('Failed to run iptables-restore, ' +
+                'disabling iptables restore', 'iptables')
+            return False
+
+        stdoutdata, stderrdata = process.communicate(data)
+        return_code = process.poll()
+    finally:
+        _global_lock.release()
+
+    if return_code:
+        logger.error('Failed to apply iptables restore batch, ' +
+            'applying rules individually', 'iptables',
+            ipv6=ipv6,
+            table=table,
+            rule_count=len(lines),
+            return_code=return_code,
+            stdout=stdoutdata,
+            stderr=stderrdata,
+        )
+        return False
+
+    return True
+
+def _restore_fallback(ops):
+    for iptables, action, rule, ipv6 in ops:
+        try:
+            if action == '-I':
+                iptables._insert_iptables_rule_cmd(rule, ipv6)
+            else:
+                iptables._remove_iptables_rule_cmd(rule, ipv6)
+        except:
+            logger.exception('Failed to apply iptables rule', 'iptables',
+                action=action,
+                rule=rule,
+                ipv6=ipv6,
+            )
+
+def restore_flush():
+    _restore_lock.acquire()
+    try:
+        ops = []
+        while True:
+            try:
+                ops.append(_restore_queue.popleft())
+            except IndexError:
+                break
+
+        if not ops:
+            return
+
+        batches = collections.OrderedDict()
+        for op in _restore_coalesce(ops):
+            iptables, action, rule, ipv6 = op
+            table, line = _restore_line(iptables, action, rule)
+
+            batch = batches.get((ipv6, table))
+            if batch is None:
+                batch = ([], [])
+                batches[(ipv6, table)] = batch
+            batch[0].append(op)
+            batch[1].append(line)
+
+        for (ipv6, table), (batch_ops, lines) in batches.items():
+            if not _restore_available or \
+                    not _restore_exec(ipv6, table, lines):
+                _restore_fallback(batch_ops)
+    finally:
+        _restore_lock.release()
+
+def ipset_available():
+    global _ipset_available
+
+    if _ipset_available is None:
+        try:
+            utils.check_call_silent(['ipset', 'version'])
+            _ipset_available = True
+        except (OSError, subprocess.CalledProcessError):
+            _ipset_available = False
+
+    return _ipset_available
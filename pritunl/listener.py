@@ -1,6 +1,70 @@
+from pritunl.constants import *
+
 import collections
+import threading
 
 channels = collections.defaultdict(set)
+_stats_lock = threading.Lock()
+_backlog = collections.defaultdict(int)
+_latency = {}
 
 def add_listener(channel, callback):
     channels[channel].add(callback)
+
+def queued(channel):
+    _stats_lock.acquire()
+    try:
+        _backlog[channel] += 1
+        return _backlog[channel]
+    finally:
+        _stats_lock.release()
+
+def processed(channel, latency):
+    _stats_lock.acquire()
+    try:
+        _backlog[channel] -= 1
+
+        stats = _latency.get(channel)
+        if not stats:
+            stats = [0, 0.0, 0.0, [0] * len(LISTENER_LATENCY_BUCKETS)]
+            _latency[channel] = stats
+
+        stats[0] += 1
+        stats[1] += latency
+        stats[2] = max(stats[2], latency)
+        for i, bucket in enumerate(LISTENER_LATENCY_BUCKETS):
+            if latency <= bucket:
+                stats[3][i] += 1
+                break
+    finally:
+        _stats_lock.release()
+
+def get_stats():
+    _stats_lock.acquire()
+    try:
+        latency = _latency.copy()
+        _latency.clear()
+
+        channels_stats = {}
+        for channel in set(_backlog.keys()) | set(latency.keys()):
+            count, total, max_latency, buckets = latency.get(
+                channel, (0, 0.0, 0.0, [0] * len(LISTENER_LATENCY_BUCKETS)))
+
+            stats = {
+                'backlog': _backlog.get(channel, 0),
+                'count': count,
+                'latency_avg': total / count if count else 0.0,
+                'latency_max': max_latency,
+            }
+
+            cumulative = 0
+            for bucket, bucket_count in zip(
+                    LISTENER_LATENCY_BUCKETS, buckets):
+                cumulative += bucket_count
+                stats['latency_le_%dms' % int(bucket * 1000)] = cumulative
+
+            channels_stats[channel] = stats
+    finally:
+        _stats_lock.release()
+
+    return channels_stats
@@ -10,17 +10,117 @@ from pritunl import utils
 import logging
 import traceback
 import threading
+import linecache
+import time
+import sys
 
 logger = logging.getLogger(APP_NAME)
 log_filter = None
 log_handler = None
 _log_queue = utils.PyQueue()
+_rate_lock = threading.Lock()
+_rate_limits = {}
+_rate_next_sweep = 0
 
 def _logger_thread():
     while True:
         args, kwargs = _log_queue.get()
+        stack = kwargs.pop('stack', None)
+        if stack:
+            kwargs['traceback'] = _format_stack(stack)
         _log(*args, **kwargs)
 
+def _capture_stack(frame):
+    # Only the code location of each frame is stored, source lines are
+    # read and formatted later on the logger thread
+    stack = []
+    while frame is not None:
+        stack.append((frame.f_code, frame.f_lineno))
+        frame = frame.f_back
+    stack.reverse()
+    return stack
+
+def _format_stack(stack):
+    entries = []
+    for code, lineno in stack:
+        filename = code.co_filename
+        line = linecache.getline(filename, lineno).strip()
+        entries.append((filename, lineno, code.co_name, line or None))
+    return traceback.format_list(entries)
+
+def _check_rate_limit(log_level, log_msg, log_type, frame):
+    key = (log_msg, frame.f_code.co_filename, frame.f_lineno)
+    cur_time = time.time()
+
+    _rate_lock.acquire()
+    try:
+        limit = _rate_limits.get(key)
+        if limit is None and len(_rate_limits) >= LOG_RATE_MAX_KEYS:
+            return True, 0
+
+        if limit is None or cur_time >= limit[0]:
+            _rate_limits[key] = [cur_time + LOG_RATE_WINDOW, 1, 0,
+                log_level, log_type]
+            return True, limit[2] if limit else 0
+
+        if limit[1] < LOG_RATE_LIMIT:
+            limit[1] += 1
+            return True, 0
+
+        limit[2] += 1
+        return False, 0
+    finally:
+        _rate_lock.release()
+
+def sweep_rate_limits():
+    # Called from error logs and the log runner to report suppressed
+    # counts for windows that have ended
+    global _rate_next_sweep
+
+    cur_time = time.time()
+    if cur_time < _rate_next_sweep:
+        return
+    suppressed = []
+
+    _rate_lock.acquire()
+    try:
+        if cur_time < _rate_next_sweep:
+            return
+        _rate_next_sweep = cur_time + LOG_RATE_WINDOW
+
+        for key, limit in _rate_limits.items():
+            if cur_time >= limit[0]:
+                _rate_limits.pop(key)
+                if limit[2]:
+                    suppressed.append((key[0], limit))
+    finally:
+        _rate_lock.release()
+
+    for log_msg, limit in suppressed:
+        _log_queue.put((
+            (limit[3], log_msg, limit[4]),
+            {'suppressed': limit[2]},
+        ))
+
+def _log_stack(log_level, log_msg, log_type, kwargs):
+    sweep_rate_limits()
+
+    # Stack includes the error or critical frame as format_stack did
+    frame = sys._getframe(1)
+
+    allowed, suppressed = _check_rate_limit(
+        log_level, log_msg, log_type, frame.f_back)
+    if not allowed:
+        return
+    if suppressed:
+        kwargs['suppressed'] = suppressed
+
+    kwargs['stack'] = _capture_stack(frame)
+    _log_queue.put((
+        (log_level, log_msg, log_type),
+        kwargs,
+    ))
+
 def _log(log_level, log_msg, log_type, exc_info=None, **kwargs):
     if not log_filter or not log_handler:
         raise TypeError('Logger not setup')
@@ -52,18 +152,10 @@ def warning(log_msg, log_type=None, **kwargs):
     ))
 
 def error(log_msg, log_type=None, **kwargs):
-    kwargs['traceback'] = traceback.format_stack()
-    _log_queue.put((
-        ('error', log_msg, log_type),
-        kwargs,
-    ))
+    _log_stack('error', log_msg, log_type, kwargs)
 
 def critical(log_msg, log_type=None, **kwargs):
-    kwargs['traceback'] = traceback.format_stack()
-    _log_queue.put((
-        ('critical', log_msg, log_type),
-        kwargs,
-    ))
+    _log_stack('critical', log_msg, log_type, kwargs)
 
 def exception(log_msg, log_type=None, **kwargs):
     # Fix for python #15541
@@ -3,12 +3,117 @@ from pritunl.logger.formatter import LogFormatter
 
 from pritunl.helpers import *
 from pritunl import settings
+from pritunl import utils
 
 import logging
 import collections
+import threading
 import os
 
-log_queue = collections.deque()
+class LogQueue(object):
+    # Byte bounded queue of log documents. Records below WARNING are held
+    # separately and the oldest of them are dropped first when the queue
+    # is full, sequence numbers keep the original order when draining.
+    def __init__(self):
+        self._low = collections.deque()
+        self._high = collections.deque()
+        self._lock = threading.Lock()
+        self._seq = 0
+        self._front_seq = 0
+        self.size = 0
+        self.dropped = collections.defaultdict(int)
+
+    def __len__(self):
+        return len(self._low) + len(self._high)
+
+    def _drop(self, queue):
+        _, levelno, doc = queue.popleft()
+        self.size -= len(doc['message'])
+        self.dropped[logging.getLevelName(levelno).lower()] += 1
+
+    def _push(self, levelno, doc, left=False):
+        high = levelno >= logging.WARNING
+        queue = self._high if high else self._low
+        capacity = settings.app.log_queue_size
+        msg_size = len(doc['message'])
+
+        while self.size + msg_size > capacity:
+            if self._low:
+                self._drop(self._low)
+            elif high and self._high:
+                self._drop(self._high)
+            else:
+                self.dropped[logging.getLevelName(levelno).lower()] += 1
+                return
+
+        if left:
+            self._front_seq -= 1
+            queue.appendleft((self._front_seq, levelno, doc))
+        else:
+            self._seq += 1
+            queue.append((self._seq, levelno, doc))
+        self.size += msg_size
+
+    def append(self, msg, levelno=logging.INFO, host=None):
+        self._lock.acquire()
+        try:
+            self._push(levelno, {
+                'timestamp': utils.now(),
+                'level': logging.getLevelName(levelno),
+                'host': host,
+                'message': msg,
+            })
+        finally:
+            self._lock.release()
+
+    def requeue(self, docs):
+        self._lock.acquire()
+        try:
+            for levelno, doc in reversed(docs):
+                self._push(levelno, doc, left=True)
+        finally:
+            self._lock.release()
+
+    def pop_batch(self, batch_size):
+        docs = []
+
+        self._lock.acquire()
+        try:
+            low = self._low
+            high = self._high
+            while len(docs) < batch_size and (low or high):
+                if not high or (low and low[0][0] < high[0][0]):
+                    _, levelno, doc = low.popleft()
+                else:
+                    _, levelno, doc = high.popleft()
+                self.size -= len(doc['message'])
+                docs.append((levelno, doc))
+        finally:
+            self._lock.release()
+
+        return docs
+
+    def add_dropped(self, name, count=1):
+        self._lock.acquire()
+        try:
+            self.dropped[name] += count
+        finally:
+            self._lock.release()
+
+    def get_stats(self):
+        self._lock.acquire()
+        try:
+            stats = {
+                'size': self.size,
+                'count': len(self),
+            }
+            for level_name, count in self.dropped.items():
+                stats['dropped_' + level_name] = count
+        finally:
+            self._lock.release()
+        return stats
+
+log_queue = LogQueue()
 
 class LogHandler(logging.Handler):
     @cached_property
@@ -34,7 +139,12 @@ class LogHandler(logging.Handler):
 
         if settings.conf.log_path:
             self.file_handler.emit(record)
-        log_queue.append(msg)
+        try:
+            host_name = settings.local.host.name
+        except AttributeError:
+            host_name = None
+
+        log_queue.append(msg, record.levelno, host_name)
 
         if not settings.local.quiet:
             print self.log_view.format_line(msg)
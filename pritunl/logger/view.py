@@ -2,11 +2,33 @@ from pritunl.constants import *
 from pritunl.helpers import *
 from pritunl import mongo
 from pritunl import utils
+from pritunl import settings
 
 import pymongo
 import tarfile
 import os
 import collections
+import datetime
+import time
+
+def parse_log_time(value):
+    if not value:
+        return None
+
+    try:
+        return datetime.datetime.utcfromtimestamp(float(value))
+    except ValueError:
+        pass
+
+    for time_format in ('%Y-%m-%d %H:%M:%S', '%Y-%m-%dT%H:%M:%S',
+            '%Y-%m-%d'):
+        try:
+            return datetime.datetime.utcfromtimestamp(time.mktime(
+                time.strptime(value, time_format)))
+        except ValueError:
+            pass
+
+    raise ValueError('Invalid log time')
 
 class LogView(object):
     def __init__(self):
@@ -65,74 +87,153 @@ class LogView(object):
                pass
         return line
 
-    def get_log_lines(self, natural=False, limit=None, formatted=True,
-            reverse=False):
+    def get_log_spec(self, since=None, until=None, level=None, host=None):
+        spec = {}
+
+        if since or until:
+            spec['timestamp'] = {}
+            if since:
+                spec['timestamp']['$gte'] = since
+            if until:
+                spec['timestamp']['$lt'] = until
+
+        if level:
+            level = level.upper()
+            if level not in LOG_LEVELS:
+                raise ValueError('Invalid log level')
+            spec['level'] = {
+                '$in': list(LOG_LEVELS[LOG_LEVELS.index(level):]),
+            }
+
+        if host:
+            spec['host'] = host
+
+        return spec
+
+    def iter_log_docs(self, spec, limit, reverse=False):
+        desc_sort = [
+            ('timestamp', pymongo.DESCENDING),
+            ('_id', pymongo.DESCENDING),
+        ]
+
+        if reverse:
+            cursor = self.collection.find(spec, {
+                'message': True,
+            }).sort(desc_sort).limit(limit)
+        else:
+            # Find the oldest of the newest limit documents then read
+            # forward from it to stream lines in order
+            cursor = self.collection.find(spec, {
+                '_id': True,
+                'timestamp': True,
+            }).sort(desc_sort).skip(limit - 1).limit(1)
+
+            first_doc = None
+            for first_doc in cursor:
+                break
+
+            if first_doc:
+                first_spec = {'$or': [
+                    {'timestamp': {'$gt': first_doc['timestamp']}},
+                    {
+                        'timestamp': first_doc['timestamp'],
+                        '_id': {'$gte': first_doc['_id']},
+                    },
+                ]}
+                if spec:
+                    spec = {'$and': [spec, first_spec]}
+                else:
+                    spec = first_spec
+
+            cursor = self.collection.find(spec, {
+                'message': True,
+            }).sort([
+                ('timestamp', pymongo.ASCENDING),
+                ('_id', pymongo.ASCENDING),
+            ]).limit(limit)
+
+        for doc in cursor:
+            yield doc
+
+    def iter_log_lines(self, since=None, until=None, level=None, host=None,
+            natural=False, limit=None, formatted=True, reverse=False):
         limit = limit or 1024
+        spec = self.get_log_spec(since, until, level, host)
 
         if natural:
-            cursor = self.collection.find({}).sort(
-                '$natural', pymongo.DESCENDING)
-            if limit:
-                cursor = cursor.limit(limit)
-
-            messages = []
-            for doc in cursor:
-                messages.append(doc['message'])
+            cursor = self.collection.find(spec, {
+                'message': True,
+            }).sort('$natural', pymongo.DESCENDING).limit(limit)
+            docs = list(cursor)
+            if not reverse:
+                docs.reverse()
         else:
-            response = self.collection.aggregate([
-                {'$sort': {
-                    'timestamp': pymongo.DESCENDING,
-                }},
-                {'$limit': limit},
-                {'$group': {
-                    '_id': None,
-                    'messages': {'$push': '$message'},
-                }},
-            ])
-
-            val = None
-            for val in response:
-                break
+            docs = self.iter_log_docs(spec, limit, reverse=reverse)
 
-            if val:
-                messages = val['messages']
+        for doc in docs:
+            if formatted:
+                yield self.format_line(doc['message'])
             else:
-                messages = []
+                yield doc['message']
 
-        if formatted:
-            output = ''
-            for i in xrange(len(messages) - 1, -1, -1):
-                output += self.format_line(messages[i]) + '\n'
-            return output.rstrip('\n')
-        else:
-            return '\n'.join(
-                messages[::-1] if reverse else messages).rstrip('\n')
+    def get_log_lines(self, natural=False, limit=None, formatted=True,
+            reverse=False, **kwargs):
+        return '\n'.join(self.iter_log_lines(
+            natural=natural,
+            limit=limit,
+            formatted=formatted,
+            reverse=not reverse and not formatted,
+            **kwargs
+        )).rstrip('\n')
 
-    def tail_log_lines(self, formatted=True):
-        cursor = self.collection.find().sort(
-            '$natural', pymongo.DESCENDING)
-        cursor_count = cursor.count()
+    def _get_new_docs(self, spec, last_id, limit):
+        # Capped collection natural order matches insert order across hosts
+        docs = []
+        cursor = self.collection.find(spec, {
+            'message': True,
+        }).sort('$natural', pymongo.DESCENDING).limit(limit)
 
-        if cursor_count > 127:
-            cursor_id = cursor[127]['_id']
-        else:
-            cursor_id = cursor[cursor_count - 1]['_id']
+        for doc in cursor:
+            if doc['_id'] == last_id:
+                break
+            docs.append(doc)
 
-        spec = {
-            '_id': {'$gt': cursor_id},
-        }
+        docs.reverse()
+        return docs
 
-        cursor = self.collection.find(spec,
-            cursor_type=pymongo.cursor.CursorType.TAILABLE_AWAIT).sort(
-            '$natural', pymongo.ASCENDING)
+    def follow_log_lines(self, level=None, host=None, limit=None,
+            formatted=True):
+        from pritunl import messenger
 
-        while cursor.alive:
-            for doc in cursor:
+        spec = self.get_log_spec(level=level, host=host)
+        cursor_id = messenger.get_cursor_id('events')
+        last_id = None
+        docs = self._get_new_docs(spec, None, limit or 128)
+
+        while True:
+            for doc in docs:
+                last_id = doc['_id']
                 if formatted:
                     yield self.format_line(doc['message'])
                 else:
                     yield doc['message']
 
+            # New lines are read after each log event and at least every
+            # timeout in case events are not received
+            for msg in messenger.subscribe('events', cursor_id=cursor_id,
+                    timeout=10):
+                cursor_id = msg['_id']
+                message = msg['message']
+                if message and isinstance(message[0], (list, tuple)):
+                    batch = message
+                else:
+                    batch = (message,)
+
+                if any(x[0] == SYSTEM_LOG_UPDATED for x in batch):
+                    break
+
+            docs = self._get_new_docs(spec, last_id, settings.app.log_limit)
+
     def archive_log(self, archive_path, natural, limit):
         temp_path = utils.get_temp_path()
         if os.path.isdir(archive_path):
@@ -1,10 +1,21 @@
+from pritunl.constants import *
 from pritunl.helpers import *
 from pritunl import mongo
 from pritunl import cache
 from pritunl import utils
+from pritunl import logger
 
 import pymongo
 import time
+import threading
+import collections
+
+_tail_lock = threading.Lock()
+_tail_cond = threading.Condition(_tail_lock)
+_tail_msgs = collections.deque()
+_tail_start = None
+_tail_count = 0
+_tail_thread = None
 
 def publish(channels, message, extra=None, transaction=None):
     if cache.has_cache:
@@ -84,6 +95,118 @@ def get_cursor_id(channels):
             else:
                 publish(channels, None)
 
+def _tail_append(doc):
+    global _tail_start
+    global _tail_count
+
+    doc.pop('nonce', None)
+
+    _tail_lock.acquire()
+    try:
+        _tail_msgs.append(doc)
+        _tail_count += 1
+        if len(_tail_msgs) > MONGO_SUB_BUFFER:
+            _tail_start = _tail_msgs.popleft()['_id']
+        _tail_cond.notify_all()
+    finally:
+        _tail_lock.release()
+
+def _tailer_thread(cursor_id):
+    collection = mongo.get_collection('messages')
+
+    while True:
+        try:
+            spec = {}
+            if cursor_id:
+                spec['_id'] = {'$gt': cursor_id}
+
+            cursor = collection.find(
+                spec,
+                cursor_type=pymongo.cursor.CursorType.TAILABLE_AWAIT,
+            ).sort('$natural', pymongo.ASCENDING)
+
+            found = False
+            while cursor.alive:
+                for doc in cursor:
+                    found = True
+                    cursor_id = doc['_id']
+                    _tail_append(doc)
+
+            if not found:
+                time.sleep(0.2)
+        except pymongo.errors.AutoReconnect:
+            time.sleep(0.2)
+        except:
+            logger.exception('Error in messenger tailer', 'messenger')
+            time.sleep(1)
+
+def _tail_init():
+    global _tail_start
+    global _tail_thread
+
+    _tail_lock.acquire()
+    try:
+        if _tail_thread:
+            return
+
+        collection = mongo.get_collection('messages')
+        try:
+            _tail_start = collection.find({}, {
+                '_id': True,
+            }).sort('$natural', pymongo.DESCENDING)[0]['_id']
+        except IndexError:
+            _tail_start = None
+
+        _tail_thread = threading.Thread(target=_tailer_thread,
+            args=(_tail_start,))
+        _tail_thread.daemon = True
+        _tail_thread.start()
+    finally:
+        _tail_lock.release()
+
+def _tail_get(channels, cursor_id):
+    # Returns the buffered messages after cursor_id or None if cursor_id is
+    # older than the buffer
+    docs = []
+
+    _tail_lock.acquire()
+    try:
+        count = _tail_count
+
+        if _tail_start and (not cursor_id or cursor_id < _tail_start):
+            if _tail_msgs:
+                return None, _tail_msgs[-1]['_id'], count
+            return None, _tail_start, count
+
+        for doc in reversed(_tail_msgs):
+            if cursor_id and doc['_id'] <= cursor_id:
+                break
+            if doc['channel'] in channels:
+                docs.append(doc)
+    finally:
+        _tail_lock.release()
+
+    docs.reverse()
+    return docs, None, count
+
+def _tail_wait(count, timeout):
+    _tail_lock.acquire()
+    try:
+        if _tail_count == count:
+            _tail_cond.wait(timeout)
+    finally:
+        _tail_lock.release()
+
+def _tail_fallback(channels, cursor_id):
+    collection = mongo.get_collection('messages')
+    spec = {
+        'channel': {'$in': list(channels)},
+    }
+    if cursor_id:
+        spec['_id'] = {'$gt': cursor_id}
+
+    return collection.find(spec).sort('$natural', pymongo.ASCENDING)
+
 @interrupter_generator
 def subscribe(channels, cursor_id=None, timeout=None, yield_delay=None,
         yield_app_server=False):
@@ -94,63 +217,65 @@ def subscribe(channels, cursor_id=None, timeout=None, yield_delay=None,
             yield msg
         return
 
-    collection = mongo.get_collection('messages')
     start_time = time.time()
     cursor_id = cursor_id or get_cursor_id(channels)
 
-    while True:
-        try:
-            spec = {}
+    if isinstance(channels, str):
+        channels = {channels}
+    else:
+        channels = set(channels)
 
-            if isinstance(channels, str):
-                spec['channel'] = channels
-            else:
-                spec['channel'] = {'$in': channels}
+    _tail_init()
+    yield
 
-            if cursor_id:
-                spec['_id'] = {'$gt': cursor_id}
+    while True:
+        docs, buffer_cursor_id, count = _tail_get(channels, cursor_id)
 
-            yield
+        if docs is None:
+            try:
+                docs = list(_tail_fallback(channels, cursor_id))
+            except pymongo.errors.AutoReconnect:
+                time.sleep(0.2)
+                continue
 
-            cursor = collection.find(
-                spec,
-                cursor_type=pymongo.cursor.CursorType.TAILABLE_AWAIT,
-            ).sort('$natural', pymongo.ASCENDING)
+        yield
 
-            yield
+        for doc in docs:
+            cursor_id = doc['_id']
+            if doc.get('message') is None:
+                continue
 
-            while cursor.alive:
-                for doc in cursor:
-                    cursor_id = doc['_id']
+            doc = doc.copy()
+            doc.pop('nonce', None)
+            yield doc
 
-                    yield
+            if yield_delay:
+                time.sleep(yield_delay)
 
+                docs, _, _ = _tail_get(channels, cursor_id)
+                if docs is None:
+                    docs = _tail_fallback(channels, cursor_id)
+
+                for doc in docs:
                     if doc.get('message') is not None:
+                        doc = doc.copy()
                         doc.pop('nonce', None)
                         yield doc
 
-                    if yield_delay:
-                        time.sleep(yield_delay)
-
-                        spec = spec.copy()
-                        spec['_id'] = {'$gt': cursor_id}
-                        cursor = collection.find(spec).sort(
-                            '$natural', pymongo.ASCENDING)
+                return
 
-                        for doc in cursor:
-                            if doc.get('message') is not None:
-                                doc.pop('nonce', None)
-                                yield doc
+        # Messages older than the buffered messages were read from the
+        # collection, continue from the buffer
+        if buffer_cursor_id and buffer_cursor_id > cursor_id:
+            cursor_id = buffer_cursor_id
 
-                        return
+        if yield_app_server and check_app_server_interrupt():
+            return
 
-                if yield_app_server and check_app_server_interrupt():
-                    return
+        if timeout and time.time() - start_time >= timeout:
+            return
 
-                if timeout and time.time() - start_time >= timeout:
-                    return
+        if not docs:
+            _tail_wait(count, 0.5)
 
-                yield
-
-        except pymongo.errors.AutoReconnect:
-            time.sleep(0.2)
+        yield
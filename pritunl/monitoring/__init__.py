@@ -4,13 +4,22 @@ from pritunl import influxdb
 from pritunl import utils
 from pritunl import settings
 from pritunl import logger
+from pritunl.influxdb.line_protocol import make_lines
 
 import threading
+import collections
+import gzip
+import io
+import time
 
-_queue = []
+_queue = collections.deque()
 _queue_lock = threading.Lock()
+_stats = collections.defaultdict(int)
 _client = None
+_database = None
 _cur_influxdb_uri = None
+_retry_time = 0
+_retry_delay = 0
 
 def insert_point(measurement, tags, fields):
     _queue_lock.acquire()
@@ -18,6 +27,10 @@ def insert_point(measurement, tags, fields):
         if not _client:
             return
 
+        if len(_queue) >= settings.app.influxdb_queue_size:
+            _queue.popleft()
+            _stats['dropped'] += 1
+
         _queue.append({
             'measurement': settings.app.influxdb_prefix + measurement,
             'tags': tags,
@@ -27,32 +40,137 @@ def insert_point(measurement, tags, fields):
     finally:
         _queue_lock.release()
 
-def write_queue():
-    global _queue
+def _requeue(points):
+    _queue_lock.acquire()
+    try:
+        free = settings.app.influxdb_queue_size - len(_queue)
+        if free < len(points):
+            # Oldest points are dropped first
+            _stats['dropped'] += len(points) - max(free, 0)
+            points = points[len(points) - max(free, 0):]
+        _queue.extendleft(reversed(points))
+    finally:
+        _queue_lock.release()
 
+def _write_points(client, points):
+    data = make_lines({
+        'points': points,
+    }).encode('utf-8')
+    headers = {
+        'Content-Type': 'application/octet-stream',
+    }
+
+    if settings.app.influxdb_gzip:
+        data_buf = io.BytesIO()
+        gzip_file = gzip.GzipFile(fileobj=data_buf, mode='wb')
+        try:
+            gzip_file.write(data)
+        finally:
+            gzip_file.close()
+        data = data_buf.getvalue()
+        headers['Content-Encoding'] = 'gzip'
+
+    client.request(
+        'write',
+        method='POST',
+        params={
+            'db': _database,
+        },
+        data=data,
+        expected_response_code=204,
+        headers=headers,
+    )
+
+def _insert_stats():
     _queue_lock.acquire()
     try:
-        if not _queue:
+        if not _stats:
             return
-        queue = _queue
-        _queue = []
-        client = _client
+        stats = dict(_stats)
+        _stats.clear()
     finally:
         _queue_lock.release()
 
-    if client:
+    batches = stats.pop('batches', 0)
+    latency = stats.pop('latency', 0)
+    fields = {
+        'sent': stats.get('sent', 0),
+        'dropped': stats.get('dropped', 0),
+        'errors': stats.get('errors', 0),
+        'batches': batches,
+        'latency_avg': latency / batches if batches else 0,
+        'latency_max': stats.get('latency_max', 0),
+    }
+
+    try:
+        host_name = settings.local.host.name
+    except AttributeError:
+        host_name = None
+
+    insert_point('monitoring', {
+        'host': host_name,
+    }, fields)
+
+def write_queue():
+    global _retry_time
+    global _retry_delay
+
+    if time.time() < _retry_time:
+        return
+
+    while True:
+        _queue_lock.acquire()
+        try:
+            client = _client
+            if not client or not _queue:
+                break
+
+            batch_size = settings.app.influxdb_batch_size
+            batch = []
+            while _queue and len(batch) < batch_size:
+                batch.append(_queue.popleft())
+        finally:
+            _queue_lock.release()
+
+        start = time.time()
         try:
-            client.write_points(queue)
+            _write_points(client, batch)
         except:
+            _requeue(batch)
+
+            _retry_delay = min(
+                max(_retry_delay * 2, settings.app.influxdb_interval),
+                settings.app.influxdb_backoff_max,
+            )
+            _retry_time = time.time() + _retry_delay
+
             _queue_lock.acquire()
             try:
-                _queue = queue + _queue
+                _stats['errors'] += 1
             finally:
                 _queue_lock.release()
             raise
 
+        latency = time.time() - start
+        _retry_delay = 0
+
+        _queue_lock.acquire()
+        try:
+            _stats['sent'] += len(batch)
+            _stats['batches'] += 1
+            _stats['latency'] += latency
+            _stats['latency_max'] = max(_stats['latency_max'], latency)
+        finally:
+            _queue_lock.release()
+
+        if len(batch) < batch_size:
+            break
+
+    _insert_stats()
+
 def connect():
     global _client
+    global _database
     global _cur_influxdb_uri
 
     influxdb_uri = settings.app.influxdb_uri
@@ -69,6 +187,7 @@ def connect():
         return
 
     hosts, username, password, database = get_servers(influxdb_uri)
+    _database = database
 
     logger.info('Connecting to InfluxDB', 'monitoring',
         influxdb_uri=influxdb_uri,
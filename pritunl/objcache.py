@@ -1,25 +1,145 @@
+from pritunl import expiry
+
+import collections
 import threading
+import time
+import sys
 
 class ObjCache(object):
-    def __init__(self, ttl=60):
+    # Thread safe cache bounded by entry count and optionally by the
+    # estimated size of the cached values. Entries are evicted least
+    # recently used first and expire after the ttl. Concurrent loads of
+    # the same missing key wait for the first load instead of repeating it.
+    def __init__(self, ttl=60, max_size=1024, max_bytes=None,
+            size_func=None):
         self._ttl = ttl
-        self._data = {}
-        self._timers = {}
+        self._max_size = max_size
+        self._max_bytes = max_bytes
+        self._size_func = size_func or sys.getsizeof
+        self._lock = threading.Lock()
+        self._data = collections.OrderedDict()
+        self._loading = {}
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def __len__(self):
+        return len(self._data)
+
+    def _pop(self, key):
+        entry = self._data.pop(key, None)
+        if entry:
+            expiry.cancel(entry[2])
+            self._bytes -= entry[3]
+        return entry
+
+    def _expire(self, key, expire_time):
+        self._lock.acquire()
+        try:
+            entry = self._data.get(key)
+            if entry and entry[1] == expire_time:
+                self._pop(key)
+                self.expirations += 1
+        finally:
+            self._lock.release()
 
     def remove(self, key):
-        self._data.pop(key, None)
+        self._lock.acquire()
+        try:
+            self._pop(key)
+        finally:
+            self._lock.release()
 
     def set(self, key, val):
-        cur_timer = self._timers.pop(key, None)
-        if cur_timer:
-            cur_timer.cancel()
+        size = self._size_func(val) if self._max_bytes else 0
+        expire_time = time.time() + self._ttl
+        timer = expiry.schedule(self._ttl, self._expire, key, expire_time)
 
-        timer = threading.Timer(self._ttl, self.remove, (key,))
-        timer.daemon = True
-        self._timers[key] = timer
-        timer.start()
+        self._lock.acquire()
+        try:
+            self._pop(key)
+            self._data[key] = (val, expire_time, timer, size)
+            self._bytes += size
 
-        self._data[key] = val
+            while self._data and (len(self._data) > self._max_size or (
+                    self._max_bytes and self._bytes > self._max_bytes)):
+                self._pop(next(iter(self._data)))
+                self.evictions += 1
+        finally:
+            self._lock.release()
 
     def get(self, key):
-        return self._data.get(key)
+        self._lock.acquire()
+        try:
+            entry = self._data.get(key)
+            if entry:
+                if entry[1] > time.time():
+                    del self._data[key]
+                    self._data[key] = entry
+                    self.hits += 1
+                    return entry[0]
+                self._pop(key)
+                self.expirations += 1
+            self.misses += 1
+        finally:
+            self._lock.release()
+
+    def load(self, key, func, *args, **kwargs):
+        val = self.get(key)
+        if val is not None:
+            return val
+
+        self._lock.acquire()
+        try:
+            event = self._loading.get(key)
+            if event:
+                leader = False
+            else:
+                leader = True
+                event = threading.Event()
+                self._loading[key] = event
+        finally:
+            self._lock.release()
+
+        if not leader:
+            event.wait()
+            val = self.get(key)
+            if val is not None:
+                return val
+            return func(*args, **kwargs)
+
+        try:
+            val = func(*args, **kwargs)
+            if val is not None:
+                self.set(key, val)
+        finally:
+            self._lock.acquire()
+            try:
+                self._loading.pop(key, None)
+            finally:
+                self._lock.release()
+            event.set()
+
+        return val
+
+    def get_stats(self):
+        self._lock.acquire()
+        try:
+            stats = {
+                'size': len(self._data),
+                'bytes': self._bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'expirations': self.expirations,
+            }
+            self.hits = 0
+            self.misses = 0
+            self.evictions = 0
+            self.expirations = 0
+        finally:
+            self._lock.release()
+
+        return stats
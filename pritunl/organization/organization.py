@@ -7,11 +7,92 @@ from pritunl import queue
 from pritunl import pooler
 from pritunl import user
 from pritunl import utils
+from pritunl import cachelocal
+from pritunl import logger
 
 import uuid
 import math
+import time
+import re
 import pymongo
 import threading
+import collections
+
+_search_lock = threading.Lock()
+_search_loaded = {}
+_search_loading = set()
+_search_gen = collections.defaultdict(int)
+
+def _get_user_tries(org_id):
+    return (
+        cachelocal.CacheTrie('users_name_%s' % org_id),
+        cachelocal.CacheTrie('users_email_%s' % org_id),
+    )
+
+def _load_user_search(org_id, gen):
+    name_trie, email_trie = _get_user_tries(org_id)
+    loaded = False
+
+    try:
+        for doc in user.User.collection.find({
+                    'org_id': org_id,
+                    'type': CERT_CLIENT,
+                }, {
+                    '_id': True,
+                    'name': True,
+                    'email': True,
+                }):
+            name_trie.add_key_terms(doc['name'], doc['_id'])
+            if doc.get('email'):
+                email_trie.add_key_terms(doc['email'], doc['_id'])
+        loaded = True
+    except:
+        logger.exception('Failed to load user search cache',
+            'organization',
+            org_id=org_id,
+        )
+    finally:
+        _search_lock.acquire()
+        try:
+            _search_loading.discard(str(org_id))
+            if loaded and _search_gen[str(org_id)] == gen:
+                _search_loaded[str(org_id)] = time.time()
+            else:
+                name_trie.clear_cache()
+                email_trie.clear_cache()
+        finally:
+            _search_lock.release()
+
+def update_user_search(org_id, user_id, remove=None, add=None):
+    # Updates are also applied while the tries are loading, a user read
+    # by the load before the update is corrected when the tries expire
+    org_key = str(org_id)
+    user_id = utils.ObjectId(user_id)
+
+    _search_lock.acquire()
+    try:
+        if org_key not in _search_loaded and \
+                org_key not in _search_loading:
+            return
+
+        for i, trie in enumerate(_get_user_tries(org_id)):
+            if remove and remove[i]:
+                trie.remove_key_terms(remove[i], user_id)
+            if add and add[i]:
+                trie.add_key_terms(add[i], user_id)
+    finally:
+        _search_lock.release()
+
+def clear_user_search(org_id):
+    _search_lock.acquire()
+    try:
+        _search_gen[str(org_id)] += 1
+        _search_loaded.pop(str(org_id), None)
+        if str(org_id) not in _search_loading:
+            for trie in _get_user_tries(org_id):
+                trie.clear_cache()
+    finally:
+        _search_lock.release()
 
 class Organization(mongo.MongoObject):
     fields = {
@@ -36,6 +117,7 @@ class Organization(mongo.MongoObject):
     def __init__(self, name=None, auth_api=None, type=None, **kwargs):
         mongo.MongoObject.__init__(self, **kwargs)
         self.last_search_count = None
+        self.next_page_cursor = None
         self.processes = []
         self.queue_com = queue.QueueCom()
 
@@ -157,12 +239,123 @@ class Organization(mongo.MongoObject):
             '_id': True,
         }).count()
 
+    def get_user_search(self):
+        # Search tries are loaded in the background, until loaded
+        # searches fall back to querying the database
+        org_key = str(self.id)
+
+        _search_lock.acquire()
+        try:
+            load_time = _search_loaded.get(org_key)
+            if load_time and time.time() - load_time < \
+                    settings.user.search_cache_ttl:
+                return _get_user_tries(self.id)
+
+            if org_key in _search_loading:
+                return
+
+            _search_loaded.pop(org_key, None)
+            _search_loading.add(org_key)
+            _search_gen[org_key] += 1
+            for trie in _get_user_tries(self.id):
+                trie.clear_cache()
+
+            thread = threading.Thread(target=_load_user_search,
+                args=(self.id, _search_gen[org_key]))
+            thread.daemon = True
+            thread.start()
+        finally:
+            _search_lock.release()
+
+    def search_user_ids(self, name=None, email=None):
+        tries = self.get_user_search()
+        if not tries:
+            return
+        name_trie, email_trie = tries
+        limit = settings.user.search_cache_limit
+        user_ids = None
+
+        for trie, search in ((name_trie, name), (email_trie, email)):
+            if not search:
+                continue
+
+            for term in cachelocal.split_search_terms(search):
+                term_ids = trie.get_prefix(term, limit=limit)
+                if len(term_ids) >= limit:
+                    return
+                if user_ids is None:
+                    user_ids = term_ids
+                else:
+                    user_ids &= term_ids
+
+        return user_ids
+
+    def _find_users_status(self, spec, status, fields, limit):
+        # Online users are found from the connected clients and offline
+        # users are found by joining each user to the clients collection,
+        # $lookup requires MongoDB 3.2 and $replaceRoot and $count 3.4
+        if status == ONLINE:
+            collection = self.clients_collection
+            pipeline = [
+                {'$match': {
+                    'org_id': self.id,
+                }},
+                {'$group': {
+                    '_id': '$user_id',
+                }},
+                {'$lookup': {
+                    'from': user.User.collection.name,
+                    'localField': '_id',
+                    'foreignField': '_id',
+                    'as': 'user',
+                }},
+                {'$unwind': '$user'},
+                {'$replaceRoot': {
+                    'newRoot': '$user',
+                }},
+                {'$match': spec},
+            ]
+        else:
+            collection = user.User.collection
+            pipeline = [
+                {'$match': spec},
+                {'$lookup': {
+                    'from': self.clients_collection.name,
+                    'localField': '_id',
+                    'foreignField': 'user_id',
+                    'as': 'clients',
+                }},
+                {'$match': {
+                    'clients': {'$size': 0},
+                }},
+            ]
+
+        response = collection.aggregate(pipeline + [
+            {'$count': 'count'},
+        ])
+        self.last_search_count = 0
+        for doc in response:
+            self.last_search_count = doc['count']
+
+        return collection.aggregate(pipeline + [
+            {'$sort': {
+                'name': pymongo.ASCENDING,
+            }},
+            {'$limit': limit + 1},
+            {'$project': fields or {
+                'clients': False,
+                'user': False,
+            }},
+        ])
+
     def iter_users(self, page=None, search=None, search_limit=None,
-            fields=None, include_pool=False):
+            fields=None, include_pool=False, page_cursor=None):
         spec = {
             'org_id': self.id,
             'type': CERT_CLIENT,
         }
+        client_spec = spec
+        status = None
         searched = False
         type_search = False
         limit = None
@@ -205,12 +398,9 @@ class Organization(mongo.MongoObject):
             if n != -1:
                 email = search[n + 6:].split(None, 1)
                 email = email[0] if email else ''
-                if email:
-                    spec['email'] = {
-                        '$regex': '.*%s.*' % email,
-                        '$options': 'i',
-                    }
                 search = search[:n] + search[n + 6 + len(email):].strip()
+            else:
+                email = None
 
             n = search.find('status:')
             if n != -1:
@@ -221,49 +411,79 @@ class Organization(mongo.MongoObject):
                 if status not in (ONLINE, OFFLINE):
                     return
 
-                user_ids = self.clients_collection.find(None, {
-                    '_id': True,
-                    'user_id': True,
-                }).distinct('user_id')
-
-                if status == ONLINE:
-                    spec['_id'] = {'$in': user_ids}
-                else:
-                    spec['_id'] = {'$nin': user_ids}
+            search = search.strip()
+            search_terms = [{
+                'name_tokens': {'$regex': '^' + re.escape(term)},
+            } for term in cachelocal.split_search_terms(search)]
+            if email:
+                search_terms += [{
+                    'email_tokens': {'$regex': '^' + re.escape(term)},
+                } for term in cachelocal.split_search_terms(email)]
+            search_spec = {'$and': search_terms} if search_terms else {}
+
+            user_ids = None
+            if settings.user.search_cache and spec['type'] == CERT_CLIENT \
+                    and (search or email):
+                user_ids = self.search_user_ids(search, email)
+
+            client_spec = spec.copy()
+            if user_ids is None:
+                client_spec.update(search_spec)
+            elif '_id' in client_spec:
+                client_spec['$and'] = [
+                    {'_id': client_spec.pop('_id')},
+                    {'_id': {'$in': list(user_ids)}},
+                ]
+            else:
+                client_spec['_id'] = {'$in': list(user_ids)}
 
-            spec['name'] = {
-                '$regex': '.*%s.*' % search.strip(),
-                '$options': 'i',
-            }
+            spec.update(search_spec)
 
             limit = search_limit or page_count
         elif page is not None:
             limit = page_count
             skip = page * page_count if page else 0
+        elif page_cursor is not None:
+            limit = page_count
+            if page_cursor:
+                client_spec = spec.copy()
+                client_spec.update(utils.get_page_cursor_spec(page_cursor))
 
-        cursor = user.User.collection.find(spec, fields).sort(
-            'name', pymongo.ASCENDING)
+        self.next_page_cursor = None
+
+        if status:
+            cursor = self._find_users_status(client_spec, status,
+                fields, limit)
+        else:
+            cursor = user.User.collection.find(client_spec, fields).sort([
+                ('name', pymongo.ASCENDING),
+                ('_id', pymongo.ASCENDING),
+            ])
 
-        if skip is not None:
-            cursor = cursor.skip(page * page_count if page else 0)
-        if limit is not None:
-            cursor = cursor.limit(limit + 1)
+            if skip is not None:
+                cursor = cursor.skip(page * page_count if page else 0)
+            if limit is not None:
+                cursor = cursor.limit(limit + 1)
 
-        if searched:
-            self.last_search_count = cursor.count()
+            if searched:
+                self.last_search_count = cursor.count()
 
         if limit is None:
             for doc in cursor:
                 yield user.User(self, doc=doc, fields=fields)
         else:
             count = 0
+            last_doc = None
             for doc in cursor:
                 count += 1
                 if count > limit:
+                    self.next_page_cursor = utils.get_page_cursor(
+                        last_doc.get('name'), last_doc['_id'])
                     return
+                last_doc = doc
                 yield user.User(self, doc=doc, fields=fields)
 
-        if type_search:
+        if type_search or status == ONLINE:
             return
 
         if include_pool:
@@ -385,5 +605,6 @@ class Organization(mongo.MongoObject):
         user_collection.remove({
             'org_id': self.id,
         })
+        clear_user_search(self.id)
 
         return server_ids
@@ -1,13 +1,16 @@
-from pritunl.organization.organization import Organization
+from pritunl.organization.organization import Organization, \
+    clear_user_search, update_user_search
 
 from pritunl.constants import *
 from pritunl import queue
 from pritunl import user
 from pritunl import mongo
 from pritunl import settings
+from pritunl import utils
 
 import threading
 import math
+import pymongo
 
 def new_pooled():
     thread = threading.Thread(target=new_org, kwargs={
@@ -78,7 +81,8 @@ def get_by_token(token, fields=None):
     if doc:
         return Organization(doc=doc, fields=fields)
 
-def iter_orgs(spec=None, type=ORG_DEFAULT, fields=None, page=None):
+def iter_orgs(spec=None, type=ORG_DEFAULT, fields=None, page=None,
+        page_cursor=None, page_state=None):
     limit = None
     skip = None
     page_count = settings.app.org_page_count
@@ -92,18 +96,37 @@ def iter_orgs(spec=None, type=ORG_DEFAULT, fields=None, page=None):
     if page is not None:
         limit = page_count
         skip = page * page_count if page else 0
+    elif page_cursor is not None:
+        limit = page_count
+        if page_cursor:
+            spec.update(utils.get_page_cursor_spec(page_cursor))
 
     if fields:
         fields = {key: True for key in fields}
 
-    cursor = Organization.collection.find(spec, fields).sort('name')
+    cursor = Organization.collection.find(spec, fields).sort([
+        ('name', pymongo.ASCENDING),
+        ('_id', pymongo.ASCENDING),
+    ])
 
     if skip is not None:
         cursor = cursor.skip(page * page_count if page else 0)
     if limit is not None:
-        cursor = cursor.limit(limit)
+        cursor = cursor.limit(limit + 1)
+
+    if page_state is not None:
+        page_state['next_page_cursor'] = None
 
+    count = 0
+    last_doc = None
     for doc in cursor:
+        count += 1
+        if limit is not None and count > limit:
+            if page_state is not None:
+                page_state['next_page_cursor'] = utils.get_page_cursor(
+                    last_doc.get('name'), last_doc['_id'])
+            return
+        last_doc = doc
         yield Organization(doc=doc, fields=fields)
 
 def get_org_page_total():
@@ -141,3 +164,11 @@ def get_user_count_multi(org_ids=None, type=CERT_CLIENT):
     return user.User.collection.find(spec, {
         '_id': True,
     }).count()
+
+def on_user_search(msg):
+    message = msg['message']
+    if isinstance(message, dict):
+        update_user_search(message['org_id'], message['user_id'],
+            remove=message.get('remove'), add=message.get('add'))
+    else:
+        clear_user_search(message)
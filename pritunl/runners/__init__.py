@@ -1,5 +1,6 @@
 from pritunl.runners.settings import start_settings
 from pritunl.runners.logger import start_logger
+from pritunl.runners.output import start_output
 from pritunl.runners.updates import start_updates
 from pritunl.runners.transaction import start_transaction
 from pritunl.runners.task import start_task
@@ -17,6 +18,7 @@ from pritunl.runners.listener import start_listener
 def start_all():
     start_settings()
     start_logger()
+    start_output()
     start_updates()
     start_transaction()
     start_task()
@@ -1,51 +1,46 @@
 from pritunl.helpers import *
+from pritunl.constants import *
 from pritunl import event
 from pritunl import logger
 
 import time
+import heapq
 import threading
 
 @interrupter
 def _event_runner_thread():
     evt_queue = event.event_queue
-    events = {}
-    del_evts = set()
+    events = set()
+    evt_heap = []
 
     while True:
         try:
-            evt = evt_queue.get(timeout=1)
-            if evt is None:
-                yield
-                continue
-            events[(evt[1], evt[2])] = evt[0]
-
-            while True:
-                cur_time = time.time()
-
-                for (evt_type, resource_id), evt_time in events.iteritems():
-                    if cur_time >= evt_time:
-                        event.Event(evt_type, resource_id)
-                        del_evts.add((evt_type, resource_id))
-
-                if del_evts:
-                    for evt_key in del_evts:
-                        try:
-                            del events[evt_key]
-                        except KeyError:
-                            pass
-                    del_evts = set()
-
-                if not events:
-                    break
-
-                time.sleep(0.025)
-                yield
-
+            if evt_heap:
+                timeout = min(1, max(0, evt_heap[0][0] - time.time()))
+            else:
+                timeout = 1
+
+            evt = evt_queue.get(timeout=timeout) if timeout else None
+            while evt is not None:
+                evt_key = (evt[1], evt[2])
+                if evt_key not in events:
+                    events.add(evt_key)
+                    heapq.heappush(evt_heap, evt)
                 evt = evt_queue.get_nowait()
-                if evt is not None:
-                    evt_key = (evt[1], evt[2])
-                    if evt_key not in events:
-                        events[evt_key] = evt[0]
+
+            # Send all events due within the next tick in one message
+            cur_time = time.time() + EVENT_BATCH_TICK
+            batch = []
+            while evt_heap and evt_heap[0][0] <= cur_time:
+                evt = heapq.heappop(evt_heap)
+                evt_key = (evt[1], evt[2])
+                events.discard(evt_key)
+                batch.append(evt_key)
+
+            if batch:
+                event.publish_events(batch)
+
+            yield
         except GeneratorExit:
             raise
         except:
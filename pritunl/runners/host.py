@@ -6,6 +6,7 @@ from pritunl import logger
 from pritunl import utils
 from pritunl import event
 from pritunl import monitoring
+from pritunl import listener
 
 import threading
 import time
@@ -150,6 +151,16 @@ def _keep_alive_thread():
                 'open_file_count': open_file_count,
             })
 
+            for channel, stats in listener.get_stats().items():
+                monitoring.insert_point('listener', {
+                    'host': settings.local.host.name,
+                    'channel': channel,
+                }, stats)
+
+            monitoring.insert_point('logger', {
+                'host': settings.local.host.name,
+            }, logger.log_queue.get_stats())
+
             settings.local.host_ping_timestamp = ping_timestamp
         except GeneratorExit:
             host.deinit()
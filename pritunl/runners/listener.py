@@ -1,4 +1,5 @@
 from pritunl.helpers import *
+from pritunl.constants import *
 from pritunl import listener
 from pritunl import logger
 from pritunl import messenger
@@ -9,27 +10,38 @@ import threading
 import time
 import datetime
 
+def _call(channel, lstnr, msg, timestamp):
+    try:
+        lstnr(msg)
+    finally:
+        listener.processed(channel, time.time() - timestamp)
+
 @interrupter
 def listener_thread():
-    queue = callqueue.CallQueue()
-    queue.start()
+    # Messages are queued by channel, messages on the same channel are
+    # handled in order and each channel runs on its own thread
+    queue = callqueue.KeyedCallQueue()
+    queue.start(len(listener.channels) or 1)
     lastlog = utils.now()
 
     while True:
         try:
             for msg in messenger.subscribe(listener.channels.keys()):
-                for lstnr in listener.channels[msg['channel']]:
+                channel = msg['channel']
+                for lstnr in listener.channels[channel]:
                     try:
-                        queue.put(lstnr, msg)
+                        size = listener.queued(channel)
+                        queue.put(channel, _call, channel, lstnr, msg,
+                            time.time())
 
-                        size = queue.size()
-                        if size >= 50:
+                        if size >= LISTENER_FLOOD_SIZE:
                             if utils.now() - lastlog > datetime.timedelta(
                                     minutes=3):
                                 lastlog = utils.now()
                                 logger.warning(
                                     'Message queue flood',
                                     'runners',
+                                    channel=channel,
                                     size=size,
                                 )
                     except:
@@ -8,6 +8,136 @@ from pritunl import event
 
 import time
 import threading
+import datetime
+import calendar
+import json
+import os
+import pymongo
+
+def _spool_write(docs):
+    spool_path = settings.conf.log_spool_path
+
+    try:
+        spool_size = os.path.getsize(spool_path)
+    except OSError:
+        spool_size = 0
+
+    with open(spool_path, 'a') as spool_file:
+        for _, doc in docs:
+            timestamp = doc['timestamp']
+            line = json.dumps({
+                'timestamp': calendar.timegm(timestamp.timetuple()) +
+                    timestamp.microsecond / 1000000.0,
+                'level': doc.get('level'),
+                'host': doc.get('host'),
+                'message': doc['message'],
+            }) + '\n'
+
+            spool_size += len(line)
+            if spool_size > settings.app.log_spool_size:
+                logger.log_queue.add_dropped('spool')
+                continue
+            spool_file.write(line)
+
+def _spool_set_offset(offset_path, offset):
+    temp_path = offset_path + '.tmp'
+    with open(temp_path, 'w') as offset_file:
+        offset_file.write(str(offset))
+    os.rename(temp_path, offset_path)
+
+def _spool_insert(collection, offset_path, msg_docs, offsets):
+    # Ordered insert so the replay offset can be moved past the documents
+    # that were inserted and the document that failed
+    try:
+        collection.insert_many(msg_docs)
+    except pymongo.errors.BulkWriteError as error:
+        inserted = error.details.get('nInserted') or 0
+        logger.log_queue.add_dropped('error')
+        _spool_set_offset(offset_path, offsets[inserted])
+        raise
+    _spool_set_offset(offset_path, offsets[-1])
+
+def _spool_replay(collection):
+    spool_path = settings.conf.log_spool_path
+    replay_path = spool_path + '.replay'
+    offset_path = replay_path + '.offset'
+    if not os.path.exists(spool_path) and not os.path.exists(replay_path):
+        return False
+
+    if not os.path.exists(replay_path):
+        try:
+            os.remove(offset_path)
+        except OSError:
+            pass
+        os.rename(spool_path, replay_path)
+
+    try:
+        with open(offset_path, 'r') as offset_file:
+            offset = int(offset_file.read())
+    except (IOError, ValueError):
+        offset = 0
+
+    msg_docs = []
+    offsets = []
+    with open(replay_path, 'r') as spool_file:
+        spool_file.seek(offset)
+        for line in iter(spool_file.readline, ''):
+            try:
+                doc = json.loads(line)
+            except ValueError:
+                continue
+
+            msg_docs.append({
+                'timestamp': datetime.datetime.utcfromtimestamp(
+                    doc['timestamp']),
+                'level': doc.get('level'),
+                'host': doc.get('host'),
+                'message': doc['message'],
+            })
+            offsets.append(spool_file.tell())
+
+            if len(msg_docs) >= settings.app.log_batch_size:
+                _spool_insert(collection, offset_path, msg_docs, offsets)
+                msg_docs = []
+                offsets = []
+
+    if msg_docs:
+        _spool_insert(collection, offset_path, msg_docs, offsets)
+
+    os.remove(replay_path)
+    try:
+        os.remove(offset_path)
+    except OSError:
+        pass
+    return True
+
+def _insert_batch(collection, docs):
+    log_queue = logger.log_queue
+
+    try:
+        collection.insert_many([x[1] for x in docs], ordered=False)
+    except pymongo.errors.BulkWriteError as error:
+        # Documents not in the write errors were inserted and duplicate
+        # keys are already stored, other write errors will not succeed
+        # on a retry
+        failed = len([x for x in error.details.get('writeErrors') or []
+            if x.get('code') != 11000])
+        if failed:
+            log_queue.add_dropped('error', failed)
+    except pymongo.errors.ConnectionFailure:
+        # insert_many sets _id on each document, a retry after a partial
+        # insert would fail every document that was already stored
+        for _, doc in docs:
+            doc.pop('_id', None)
+
+        if settings.conf.log_spool_path:
+            _spool_write(docs)
+        else:
+            log_queue.requeue(docs)
+        raise
+    except:
+        log_queue.add_dropped('error', len(docs))
+        raise
 
 @interrupter
 def _logger_runner_thread():
@@ -16,29 +146,33 @@ def _logger_runner_thread():
 
     while True:
         try:
-            msg_docs = []
+            updated = False
             while True:
-                try:
-                    msg = log_queue.popleft()
-                    msg_docs.append({
-                        'timestamp': utils.now(),
-                        'message': msg,
-                    })
-                except IndexError:
+                docs = log_queue.pop_batch(settings.app.log_batch_size)
+                if not docs:
                     break
 
-            if msg_docs:
-                yield
-                collection.insert(msg_docs)
+                _insert_batch(collection, docs)
+
+                updated = True
+                if len(docs) < settings.app.log_batch_size:
+                    break
+
+            if settings.conf.log_spool_path and _spool_replay(collection):
+                updated = True
+
+            if updated:
                 event.Event(type=SYSTEM_LOG_UPDATED)
 
+            logger.sweep_rate_limits()
+
             yield interrupter_sleep(settings.app.log_db_delay)
 
         except GeneratorExit:
             raise
         except:
             logger.exception('Error in log runner thread', 'runners')
-            time.sleep(0.5)
+            yield interrupter_sleep(settings.app.log_db_delay)
 
 def start_logger():
     threading.Thread(target=_logger_runner_thread).start()
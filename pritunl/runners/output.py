@@ -0,0 +1,26 @@
+from pritunl.helpers import *
+from pritunl import logger
+from pritunl import settings
+from pritunl import server
+
+import time
+import threading
+
+@interrupter
+def _output_runner_thread():
+    while True:
+        try:
+            server.flush_event.wait(settings.vpn.output_flush_interval)
+            server.flush_event.clear()
+            server.flush_output()
+
+            yield
+
+        except GeneratorExit:
+            raise
+        except:
+            logger.exception('Error in output runner thread', 'runners')
+            time.sleep(0.5)
+
+def start_output():
+    threading.Thread(target=_output_runner_thread).start()
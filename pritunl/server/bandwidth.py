@@ -82,6 +82,11 @@ class ServerBandwidth(object):
 
         bulk.execute()
 
+    def remove_data(self):
+        self.collection.remove({
+            'server_id': self.server_id,
+        })
+
     def get_period(self, period):
         date_end = self._get_period_timestamp(period, utils.now())
 
@@ -235,3 +240,116 @@ class ServerBandwidth(object):
         with open(path, 'w') as demo_file:
             demo_file.write(json.dumps(data))
         return data
+
+class ServerUserBandwidth(ServerBandwidth):
+    @cached_static_property
+    def collection(cls):
+        return mongo.get_collection('servers_user_bandwidth')
+
+    @cached_static_property
+    def user_collection(cls):
+        return mongo.get_collection('users')
+
+    def add_data(self, timestamp, devices):
+        bulk = self.collection.initialize_unordered_bulk_op()
+
+        for period in ('1m', '5m', '30m', '2h', '1d'):
+            period_timestamp = self._get_period_timestamp(period, timestamp)
+
+            for (org_id, user_id, device_id, device_name), (
+                    received, sent) in devices.items():
+                spec = {
+                    'server_id': self.server_id,
+                    'period': period,
+                    'timestamp': period_timestamp,
+                    'user_id': user_id,
+                    'device_id': device_id,
+                }
+                doc = {
+                    '$set': {
+                        'org_id': org_id,
+                        'device_name': device_name,
+                    },
+                    '$inc': {
+                        'received': received,
+                        'sent': sent,
+                    },
+                }
+                bulk.find(spec).upsert().update(doc)
+
+            bulk.find({
+                'server_id': self.server_id,
+                'period': period,
+                'timestamp': {
+                    '$lt': self._get_period_max_timestamp(period, timestamp),
+                },
+            }).remove()
+
+        bulk.execute()
+
+    def get_top(self, period, limit=10, devices=False):
+        date_start = self._get_period_max_timestamp(period, utils.now())
+
+        if devices:
+            group_id = {
+                'user_id': '$user_id',
+                'device_id': '$device_id',
+            }
+        else:
+            group_id = {
+                'user_id': '$user_id',
+            }
+
+        response = self.collection.aggregate([
+            {'$match': {
+                'server_id': self.server_id,
+                'period': period,
+                'timestamp': {'$gte': date_start},
+            }},
+            {'$group': {
+                '_id': group_id,
+                'org_id': {'$last': '$org_id'},
+                'device_name': {'$last': '$device_name'},
+                'received': {'$sum': '$received'},
+                'sent': {'$sum': '$sent'},
+            }},
+            {'$project': {
+                'org_id': True,
+                'device_name': True,
+                'received': True,
+                'sent': True,
+                'total': {'$add': ['$received', '$sent']},
+            }},
+            {'$sort': {
+                'total': -1,
+            }},
+            {'$limit': limit},
+        ])
+
+        top = []
+        user_ids = set()
+        for doc in response:
+            user_ids.add(doc['_id']['user_id'])
+            top.append({
+                'org_id': doc['org_id'],
+                'user_id': doc['_id']['user_id'],
+                'device_id': doc['_id'].get('device_id'),
+                'device_name': doc['device_name'] if devices else None,
+                'received': doc['received'],
+                'sent': doc['sent'],
+                'total': doc['total'],
+            })
+
+        user_names = {}
+        if user_ids:
+            for doc in self.user_collection.find({
+                        '_id': {'$in': list(user_ids)},
+                    }, {
+                        'name': True,
+                    }):
+                user_names[doc['_id']] = doc['name']
+
+        for item in top:
+            item['user_name'] = user_names.get(item['user_id'])
+
+        return top
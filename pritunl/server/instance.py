@@ -444,6 +444,9 @@ class ServerInstance(object):
         self.iptables.ipv6_firewall = ipv6_firewall
         self.iptables.inter_client = self.server.inter_client
         self.iptables.restrict_routes = self.server.restrict_routes
+        self.iptables.ipset = settings.vpn.iptables_ipset and \
+            not (settings.vpn.lib_iptables and iptables.LIB_IPTABLES) and \
+            iptables.ipset_available()
 
         try:
             routes_output = utils.check_output_logged(['route', '-n'])
@@ -26,14 +26,30 @@ class ServerInstanceCom(object):
         self.sock = None
         self.sock_lock = threading.Lock()
         self.socket_path = instance.management_socket_path
+        self.clients = clients.Clients(svr, instance, self)
+        self.bandwidth_rate = settings.vpn.bandwidth_update_rate
+        self._init_parser()
+
+    def _init_parser(self):
         self.bytes_lock = threading.Lock()
         self.bytes_recv = 0
         self.bytes_sent = 0
+        self.device_bytes = {}
+        self.user_bandwidth = settings.vpn.user_bandwidth
         self.client = None
-        self.clients = clients.Clients(svr, instance, self)
         self.client_bytes = {}
         self.cur_timestamp = utils.now()
-        self.bandwidth_rate = settings.vpn.bandwidth_update_rate
+        self._handlers = {
+            '>BYTECOUNT_CLI': self._on_bytecount,
+            '>CLIENT': self._on_client,
+            'SUCCESS': self._on_success,
+        }
+        self._client_handlers = {
+            'CONNECT': self._on_client_connect,
+            'REAUTH': self._on_client_reauth,
+            'ESTABLISHED': self._on_client_established,
+            'DISCONNECT': self._on_client_disconnect,
+        }
 
     @cached_static_property
     def users_ip_collection(cls):
@@ -63,109 +79,147 @@ class ServerInstanceCom(object):
         self.server.output.push_message(message)
 
     def parse_bytecount(self, client_id, bytes_recv, bytes_sent):
-        _, bytes_recv_prev, bytes_sent_prev = self.client_bytes.get(
-            client_id, (None, 0, 0))
-
-        self.client_bytes[client_id] = (
-            self.cur_timestamp, bytes_recv, bytes_sent)
+        counter = self.client_bytes.get(client_id)
+        if counter is None:
+            counter = [self.cur_timestamp, 0, 0, None]
+            self.client_bytes[client_id] = counter
+
+        bytes_recv_diff = bytes_recv - counter[1]
+        bytes_sent_diff = bytes_sent - counter[2]
+        counter[0] = self.cur_timestamp
+        counter[1] = bytes_recv
+        counter[2] = bytes_sent
+
+        device_key = counter[3]
+        if device_key is None and self.user_bandwidth:
+            client = self.clients.clients.find_id(client_id)
+            if client:
+                device_key = (
+                    client['org_id'],
+                    client['user_id'],
+                    client['device_id'] or client['mac_addr'] or
+                        client['doc_id'],
+                    client['device_name'],
+                )
+                counter[3] = device_key
 
         self.bytes_lock.acquire()
-        self.bytes_recv += bytes_recv - bytes_recv_prev
-        self.bytes_sent += bytes_sent - bytes_sent_prev
+        self.bytes_recv += bytes_recv_diff
+        self.bytes_sent += bytes_sent_diff
+        if device_key is not None and (bytes_recv_diff or bytes_sent_diff):
+            device_bytes = self.device_bytes.get(device_key)
+            if device_bytes is None:
+                self.device_bytes[device_key] = [
+                    bytes_recv_diff, bytes_sent_diff]
+            else:
+                device_bytes[0] += bytes_recv_diff
+                device_bytes[1] += bytes_sent_diff
         self.bytes_lock.release()
 
+    def _on_bytecount(self, data):
+        client_id, bytes_recv, bytes_sent = data.split(',')
+        self.parse_bytecount(client_id, int(bytes_recv), int(bytes_sent))
+
+    def _on_client(self, data):
+        cmd, _, data = data.partition(',')
+        handler = self._client_handlers.get(cmd)
+        if handler:
+            handler(data)
+
+    def _on_client_connect(self, data):
+        client_id, key_id = data.split(',')
+        self.client = {
+            'cmd': 'connect',
+            'client_id': client_id,
+            'key_id': key_id,
+        }
+
+    def _on_client_reauth(self, data):
+        client_id, key_id = data.split(',')
+        self.client = {
+            'cmd': 'reauth',
+            'client_id': client_id,
+            'key_id': key_id,
+        }
+
+    def _on_client_established(self, data):
+        self.client = {
+            'cmd': 'connected',
+            'client_id': data,
+        }
+
+    def _on_client_disconnect(self, data):
+        self.client = {
+            'cmd': 'disconnected',
+            'client_id': data,
+        }
+
+    def _on_success(self, data):
+        self.push_output('COM> SUCCESS:%s' % data)
+
+    def _on_client_end(self):
+        cmd = self.client['cmd']
+        if cmd == 'connect':
+            self.clients.connect(self.client)
+        elif cmd == 'reauth':
+            self.clients.connect(self.client, reauth=True)
+        elif cmd == 'connected':
+            self.clients.connected(self.client.get('client_id'))
+        elif cmd == 'disconnected':
+            self.clients.disconnected(self.client.get('client_id'))
+        self.client = None
+
+    def _on_client_env(self, env_key, env_val):
+        client_key = CLIENT_ENV_KEYS.get(env_key)
+        if client_key:
+            self.client[client_key] = env_val
+        elif env_key == 'tls_id_0':
+            tls_env = ''.join(x for x in env_val if x in VALID_CHARS)
+            o_index = tls_env.find('O=')
+            cn_index = tls_env.find('CN=')
+
+            if o_index < 0 or cn_index < 0:
+                self.send_client_deny(self.client,
+                    'Failed to parse org_id and user_id')
+                self.client = None
+                return
+
+            if o_index > cn_index:
+                org_id = tls_env[o_index + 2:]
+                user_id = tls_env[3:o_index]
+            else:
+                org_id = tls_env[2:cn_index]
+                user_id = tls_env[cn_index + 3:]
+
+            self.client['org_id'] = utils.ObjectId(org_id)
+            self.client['user_id'] = utils.ObjectId(user_id)
+        elif env_key == 'untrusted_ip6':
+            remote_ip = env_val
+            if remote_ip.startswith('::ffff:'):
+                remote_ip = remote_ip.split(':')[-1]
+            self.client['remote_ip'] = remote_ip
+        elif env_key == 'IV_PLAT' and not self.client.get('platform'):
+            if 'chrome' in env_val.lower():
+                env_val = 'chrome'
+                self.client['device_id'] = uuid.uuid4().hex
+                self.client['device_name'] = 'chrome-os'
+            self.client['platform'] = env_val
+
     def parse_line(self, line):
         if self.client:
             if line == '>CLIENT:ENV,END':
-                cmd = self.client['cmd']
-                if cmd == 'connect':
-                    self.clients.connect(self.client)
-                elif cmd == 'reauth':
-                    self.clients.connect(self.client, reauth=True)
-                elif cmd == 'connected':
-                    self.clients.connected(self.client.get('client_id'))
-                elif cmd == 'disconnected':
-                    self.clients.disconnected(self.client.get('client_id'))
-                self.client = None
-            elif line.startswith('>CLIENT:ENV'):
+                self._on_client_end()
+            elif line.startswith('>CLIENT:ENV,'):
                 env_key, env_val = line[12:].split('=', 1)
-                if env_key == 'tls_id_0':
-                    tls_env = ''.join(x for x in env_val if x in VALID_CHARS)
-                    o_index = tls_env.find('O=')
-                    cn_index = tls_env.find('CN=')
-
-                    if o_index < 0 or cn_index < 0:
-                        self.send_client_deny(self.client,
-                            'Failed to parse org_id and user_id')
-                        self.client = None
-                        return
-
-                    if o_index > cn_index:
-                        org_id = tls_env[o_index + 2:]
-                        user_id = tls_env[3:o_index]
-                    else:
-                        org_id = tls_env[2:cn_index]
-                        user_id = tls_env[cn_index + 3:]
-
-                    self.client['org_id'] = utils.ObjectId(org_id)
-                    self.client['user_id'] = utils.ObjectId(user_id)
-                elif env_key == 'IV_HWADDR':
-                    self.client['mac_addr'] = env_val
-                elif env_key == 'untrusted_ip':
-                    self.client['remote_ip'] = env_val
-                elif env_key == 'untrusted_ip6':
-                    remote_ip = env_val
-                    if remote_ip.startswith('::ffff:'):
-                        remote_ip = remote_ip.split(':')[-1]
-                    self.client['remote_ip'] = remote_ip
-                elif env_key == 'IV_PLAT' and not self.client.get('platform'):
-                    if 'chrome' in env_val.lower():
-                        env_val = 'chrome'
-                        self.client['device_id'] = uuid.uuid4().hex
-                        self.client['device_name'] = 'chrome-os'
-                    self.client['platform'] = env_val
-                elif env_key == 'UV_ID':
-                    self.client['device_id'] = env_val
-                elif env_key == 'UV_NAME':
-                    self.client['device_name'] = env_val
-                elif env_key == 'UV_PLATFORM':
-                    self.client['platform'] = env_val
-                elif env_key == 'password':
-                    self.client['password'] = env_val
+                self._on_client_env(env_key, env_val)
             else:
                 self.push_output('CCOM> %s' % line[1:])
-        elif line.startswith('>BYTECOUNT_CLI'):
-            client_id, bytes_recv, bytes_sent = line.split(',')
-            client_id = client_id.split(':')[1]
-            self.parse_bytecount(client_id, int(bytes_recv), int(bytes_sent))
-        elif line.startswith('>CLIENT:CONNECT'):
-            _, client_id, key_id = line.split(',')
-            self.client = {
-                'cmd': 'connect',
-                'client_id': client_id,
-                'key_id': key_id,
-            }
-        elif line.startswith('>CLIENT:REAUTH'):
-            _, client_id, key_id = line.split(',')
-            self.client = {
-                'cmd': 'reauth',
-                'client_id': client_id,
-                'key_id': key_id,
-            }
-        elif line.startswith('>CLIENT:ESTABLISHED'):
-            _, client_id = line.split(',')
-            self.client = {
-                'cmd': 'connected',
-                'client_id': client_id,
-            }
-        elif line.startswith('>CLIENT:DISCONNECT'):
-            _, client_id = line.split(',')
-            self.client = {
-                'cmd': 'disconnected',
-                'client_id': client_id,
-            }
-        elif line.startswith('SUCCESS:'):
-            self.push_output('COM> %s' % line)
+            return
+
+        prefix, _, data = line.partition(':')
+        handler = self._handlers.get(prefix)
+        if handler:
+            handler(data)
 
     def wait_for_socket(self):
         for _ in xrange(10000):
@@ -228,15 +282,17 @@ class ServerInstanceCom(object):
                 timestamp_ttl = self.cur_timestamp - datetime.timedelta(
                     seconds=180)
 
-                for client_id, (timestamp, _, _) in self.client_bytes.items():
-                    if timestamp < timestamp_ttl:
+                for client_id, counter in self.client_bytes.items():
+                    if counter[0] < timestamp_ttl:
                         self.client_bytes.pop(client_id, None)
 
                 self.bytes_lock.acquire()
                 bytes_recv = self.bytes_recv
                 bytes_sent = self.bytes_sent
+                device_bytes = self.device_bytes
                 self.bytes_recv = 0
                 self.bytes_sent = 0
+                self.device_bytes = {}
                 self.bytes_lock.release()
 
                 monitoring.insert_point('server_bandwidth', {
@@ -247,10 +303,32 @@ class ServerInstanceCom(object):
                     'bytes_recv': bytes_recv,
                 })
 
+                monitoring.insert_point('server_auth_queue', {
+                    'host': settings.local.host.name,
+                    'server': self.server.name,
+                }, self.clients.call_queue.get_stats())
+
+                monitoring.insert_point('server_obj_cache', {
+                    'host': settings.local.host.name,
+                    'server': self.server.name,
+                }, self.clients.obj_cache.get_stats())
+
                 if bytes_recv != 0 or bytes_sent != 0:
                     self.server.bandwidth.add_data(
                         utils.now(), bytes_recv, bytes_sent)
 
+                if device_bytes:
+                    try:
+                        self.server.user_bandwidth.add_data(
+                            utils.now(), device_bytes)
+                    except:
+                        logger.exception('Failed to update user bandwidth',
+                            'server',
+                            server_id=self.server.id,
+                            instance_id=self.instance.id,
+                            device_count=len(device_bytes),
+                        )
+
                 yield interrupter_sleep(self.bandwidth_rate)
                 if self.instance.sock_interrupt:
                     return
@@ -267,6 +345,30 @@ class ServerInstanceCom(object):
             )
             self.instance.stop_process()
 
+    def _read_lines(self):
+        buf = bytearray()
+        chunk = bytearray(SOCKET_BUFFER)
+        chunk_view = memoryview(chunk)
+
+        while True:
+            size = self.sock.recv_into(chunk)
+            if not size or self.instance.sock_interrupt:
+                return
+
+            buf += chunk_view[:size]
+            start = 0
+            while True:
+                end = buf.find('\n', start)
+                if end < 0:
+                    break
+                line = str(buf[start:end]).strip()
+                start = end + 1
+                if line:
+                    yield line
+
+            if start:
+                del buf[:start]
+
     def _socket_thread(self):
         try:
             self.connect()
@@ -275,32 +377,23 @@ class ServerInstanceCom(object):
 
             add_listener(self.instance.id, self.on_msg)
 
-            data = ''
-            while True:
-                data += self.sock.recv(SOCKET_BUFFER)
-                if not data or self.instance.sock_interrupt:
-                    if not self.instance.sock_interrupt and \
-                            not check_global_interrupt():
-                        self.instance.stop_process()
-                        self.push_output(
-                            'ERROR Management socket exited unexpectedly')
-                        logger.error('Management socket exited unexpectedly')
-                    return
-                lines = data.split('\n')
-                data = lines.pop()
-                for line in lines:
-                    line = line.strip()
-                    if not line:
-                        continue
-                    try:
-                        self.parse_line(line)
-                    except:
-                        logger.exception('Failed to parse line from vpn com',
-                            'server',
-                            server_id=self.server.id,
-                            instance_id=self.instance.id,
-                            line=line,
-                        )
+            for line in self._read_lines():
+                try:
+                    self.parse_line(line)
+                except:
+                    logger.exception('Failed to parse line from vpn com',
+                        'server',
+                        server_id=self.server.id,
+                        instance_id=self.instance.id,
+                        line=line,
+                    )
+
+            if not self.instance.sock_interrupt and \
+                    not check_global_interrupt():
+                self.instance.stop_process()
+                self.push_output(
+                    'ERROR Management socket exited unexpectedly')
+                logger.error('Management socket exited unexpectedly')
         except:
             if not self.instance.sock_interrupt:
                 self.push_output('ERROR Management socket exception')
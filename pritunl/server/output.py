@@ -5,10 +5,96 @@ from pritunl import mongo
 from pritunl import event
 from pritunl import utils
 
-import pymongo
 import datetime
+import sys
+import threading
+import collections
+
+_buffers = {}
+_buffers_lock = threading.Lock()
+_flush_lock = threading.Lock()
+flush_event = threading.Event()
+
+def _merge_buffers(buffers):
+    # Put lines from a failed flush back in front of lines buffered since,
+    # the newest lines are kept when the buffer is full
+    _buffers_lock.acquire()
+    try:
+        for key, lines in buffers.items():
+            cur_lines = _buffers.get(key)
+            if cur_lines:
+                lines.extend(cur_lines)
+            _buffers[key] = lines
+    finally:
+        _buffers_lock.release()
+
+def flush_output():
+    global _buffers
+
+    _flush_lock.acquire()
+    try:
+        _buffers_lock.acquire()
+        try:
+            buffers = _buffers
+            _buffers = {}
+        finally:
+            _buffers_lock.release()
+
+        if not buffers:
+            return
+
+        bulks = {}
+        timestamp = utils.now()
+        for (cls, server_id), lines in buffers.items():
+            bulk = bulks.get(cls)
+            if bulk is None:
+                bulk = cls.collection.initialize_unordered_bulk_op()
+                bulks[cls] = bulk
+
+            bulk.find({
+                '_id': server_id,
+            }).upsert().update_one({
+                '$push': {
+                    'output': {
+                        '$each': list(lines),
+                        '$slice': -settings.vpn.log_lines,
+                    },
+                },
+                '$set': {
+                    'timestamp': timestamp,
+                },
+            })
+
+        failed = set()
+        for cls, bulk in bulks.items():
+            try:
+                bulk.execute()
+            except:
+                failed.add(cls)
+                if len(failed) == 1:
+                    exc_info = sys.exc_info()
+
+        if failed:
+            _merge_buffers(dict((key, lines)
+                for key, lines in buffers.items() if key[0] in failed))
+    finally:
+        _flush_lock.release()
+
+    for cls, server_id in buffers:
+        if cls in failed:
+            continue
+        event.Event(
+            type=cls.event_type,
+            resource_id=server_id,
+            delay=SERVER_OUTPUT_DELAY,
+        )
+
+    if failed:
+        raise exc_info[0], exc_info[1], exc_info[2]
 
 class ServerOutput(object):
+    event_type = SERVER_OUTPUT_UPDATED
+
     def __init__(self, server_id):
         self.server_id = server_id
 
@@ -23,33 +109,50 @@ class ServerOutput(object):
             delay = None
 
         event.Event(
-            type=SERVER_OUTPUT_UPDATED,
+            type=self.event_type,
             resource_id=self.server_id,
             delay=delay,
         )
 
-    def clear_output(self):
-        self.collection.remove({
-            'server_id': self.server_id,
-        })
-        self.send_event(delay=False)
-
-    def prune_output(self):
-        cursor = self.collection.find({
-            'server_id': self.server_id,
-        }, {
-            '_id': True,
-            'timestamp': True,
-        }).sort('timestamp', pymongo.DESCENDING).skip(settings.vpn.log_lines)
-
-        doc_ids = []
-        for doc in cursor:
-            doc_ids.append(doc['_id'])
-
-        if doc_ids:
+    def buffer_output(self, server_id, output):
+        # Lines are held in a ring buffer per server until the output
+        # runner flushes them, only the newest log_lines are kept
+        key = (self.__class__, server_id)
+
+        _buffers_lock.acquire()
+        try:
+            lines = _buffers.get(key)
+            if lines is None:
+                lines = collections.deque(maxlen=settings.vpn.log_lines)
+                _buffers[key] = lines
+            lines.append(output)
+            full = len(lines) >= settings.vpn.output_batch_size
+        finally:
+            _buffers_lock.release()
+
+        if full:
+            flush_event.set()
+
+    def discard_output(self, server_id):
+        _buffers_lock.acquire()
+        try:
+            _buffers.pop((self.__class__, server_id), None)
+        finally:
+            _buffers_lock.release()
+
+    def remove_output(self):
+        _flush_lock.acquire()
+        try:
+            self.discard_output(self.server_id)
             self.collection.remove({
-                '_id': {'$in': doc_ids},
+                '_id': self.server_id,
             })
+        finally:
+            _flush_lock.release()
+
+    def clear_output(self):
+        self.remove_output()
+        self.send_event(delay=False)
 
     def push_output(self, output, label=None):
         if '--keepalive' in output:
@@ -57,14 +160,8 @@ class ServerOutput(object):
 
         label = label or settings.local.host.name
 
-        self.collection.insert({
-            'server_id': self.server_id,
-            'timestamp': utils.now(),
-            'output': '[%s] %s' % (label, output.rstrip('\n')),
-        })
-
-        self.prune_output()
-        self.send_event()
+        self.buffer_output(self.server_id,
+            '[%s] %s' % (label, output.rstrip('\n')))
 
     def push_message(self, message, *args, **kwargs):
         timestamp = datetime.datetime.now().strftime(
@@ -76,31 +173,13 @@ class ServerOutput(object):
         if settings.app.demo_mode:
             return DEMO_OUTPUT
 
-        response = self.collection.aggregate([
-            {'$match': {
-                'server_id': self.server_id,
-            }},
-            {'$project': {
-                '_id': False,
-                'timestamp': True,
-                'output': True,
-            }},
-            {'$sort': {
-                'timestamp': pymongo.ASCENDING,
-            }},
-            {'$group': {
-                '_id': None,
-                'output': {'$push': '$output'},
-            }},
-        ])
-
-        val = None
-        for val in response:
-            break
-
-        if val:
-            output = val['output']
-        else:
-            output = []
+        doc = self.collection.find_one({
+            '_id': self.server_id,
+        }, {
+            '_id': False,
+            'output': True,
+        })
 
-        return output
+        if doc:
+            return doc.get('output') or []
+        return []
@@ -1,12 +1,16 @@
 from pritunl.server.output import ServerOutput
+from pritunl.server import output as server_output
 
 from pritunl.constants import *
 from pritunl.helpers import *
+from pritunl import settings
 from pritunl import mongo
 from pritunl import event
 from pritunl import utils
 
 class ServerOutputLink(ServerOutput):
+    event_type = SERVER_LINK_OUTPUT_UPDATED
+
     @cached_static_property
     def collection(cls):
         return mongo.get_collection('servers_output_link')
@@ -30,10 +34,46 @@ class ServerOutputLink(ServerOutput):
                     delay=delay,
                 )
 
+    def remove_output(self, link_server_ids=None):
+        # Lines are stored with the ids of both servers in the link, lines
+        # shared with this server are also removed from the linked servers
+        link_server_ids = [x for x in link_server_ids or []
+            if x != self.server_id]
+
+        server_output._flush_lock.acquire()
+        try:
+            self.discard_output(self.server_id)
+
+            server_output._buffers_lock.acquire()
+            try:
+                for link_server_id in link_server_ids:
+                    lines = server_output._buffers.get(
+                        (self.__class__, link_server_id))
+                    if not lines:
+                        continue
+
+                    for line in list(lines):
+                        if self.server_id in line['server_ids']:
+                            lines.remove(line)
+            finally:
+                server_output._buffers_lock.release()
+
+            self.collection.remove({
+                '_id': self.server_id,
+            })
+            if link_server_ids:
+                self.collection.update_many({
+                    '_id': {'$in': link_server_ids},
+                }, {'$pull': {
+                    'output': {
+                        'server_ids': self.server_id,
+                    },
+                }})
+        finally:
+            server_output._flush_lock.release()
+
     def clear_output(self, link_server_ids):
-        self.collection.remove({
-            'server_id': self.server_id,
-        })
+        self.remove_output(link_server_ids)
         self.send_event(link_server_ids, delay=False)
 
     def push_output(self, output, label, link_server_id):
@@ -42,11 +82,15 @@ class ServerOutputLink(ServerOutput):
         else:
             server_ids = [self.server_id]
 
-        self.collection.insert({
-            'server_id': server_ids,
-            'timestamp': utils.now(),
+        line = {
+            'server_ids': server_ids,
             'output': '[%s] %s' % (label, output.rstrip('\n')),
-        })
+        }
+        for server_id in server_ids:
+            self.buffer_output(server_id, line)
+
+    def get_output(self):
+        if settings.app.demo_mode:
+            return DEMO_OUTPUT
 
-        self.prune_output()
-        self.send_event((link_server_id,))
+        return [x['output'] for x in ServerOutput.get_output(self)]
@@ -1,6 +1,6 @@
 from pritunl.server.output import ServerOutput
 from pritunl.server.output_link import ServerOutputLink
-from pritunl.server.bandwidth import ServerBandwidth
+from pritunl.server.bandwidth import ServerBandwidth, ServerUserBandwidth
 from pritunl.server.ip_pool import ServerIpPool
 from pritunl.server.instance import ServerInstance
 
@@ -411,6 +411,10 @@ class Server(mongo.MongoObject):
     def bandwidth(self):
         return ServerBandwidth(self.id)
 
+    @cached_property
+    def user_bandwidth(self):
+        return ServerUserBandwidth(self.id)
+
     @cached_property
     def ip_pool(self):
         return ServerIpPool(self)
@@ -983,6 +987,8 @@ class Server(mongo.MongoObject):
             'server_id': self.id,
         })
         self.remove_primary_user()
+        self.bandwidth.remove_data()
+        self.user_bandwidth.remove_data()
         mongo.MongoObject.remove(self)
 
     def iter_links(self, fields=None):
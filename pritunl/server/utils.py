@@ -1,6 +1,6 @@
 from pritunl.server.output import ServerOutput
 from pritunl.server.output_link import ServerOutputLink
-from pritunl.server.bandwidth import ServerBandwidth
+from pritunl.server.bandwidth import ServerBandwidth, ServerUserBandwidth
 from pritunl.server.server import Server, dict_fields
 
 from pritunl.constants import *
@@ -9,8 +9,10 @@ from pritunl import transaction
 from pritunl import mongo
 from pritunl import ipaddress
 from pritunl import settings
+from pritunl import utils
 
 import math
+import pymongo
 
 def new_server(**kwargs):
     server = Server(**kwargs)
@@ -71,7 +73,8 @@ def get_used_resources(ignore_server_id):
         'ports': set(used_resources['ports']),
     }
 
-def iter_servers(spec=None, fields=None, page=None):
+def iter_servers(spec=None, fields=None, page=None, page_cursor=None,
+        page_state=None):
     limit = None
     skip = None
     page_count = settings.app.server_page_count
@@ -85,21 +88,41 @@ def iter_servers(spec=None, fields=None, page=None):
     if page is not None:
         limit = page_count
         skip = page * page_count if page else 0
+    elif page_cursor is not None:
+        limit = page_count
+        if page_cursor:
+            spec.update(utils.get_page_cursor_spec(page_cursor))
 
-    cursor = Server.collection.find(spec, fields).sort('name')
+    cursor = Server.collection.find(spec, fields).sort([
+        ('name', pymongo.ASCENDING),
+        ('_id', pymongo.ASCENDING),
+    ])
 
     if skip is not None:
         cursor = cursor.skip(page * page_count if page else 0)
     if limit is not None:
-        cursor = cursor.limit(limit)
+        cursor = cursor.limit(limit + 1)
 
+    if page_state is not None:
+        page_state['next_page_cursor'] = None
+
+    count = 0
+    last_doc = None
     for doc in cursor:
+        count += 1
+        if limit is not None and count > limit:
+            if page_state is not None:
+                page_state['next_page_cursor'] = utils.get_page_cursor(
+                    last_doc.get('name'), last_doc['_id'])
+            return
+        last_doc = doc
         yield Server(doc=doc, fields=fields)
 
-def iter_servers_dict(page=None):
+def iter_servers_dict(page=None, page_cursor=None, page_state=None):
     fields = {key: True for key in dict_fields}
 
-    for svr in iter_servers(fields=fields, page=page):
+    for svr in iter_servers(fields=fields, page=page,
+            page_cursor=page_cursor, page_state=page_state):
         yield svr.dict()
 
 def get_server_page_total():
@@ -132,6 +155,9 @@ def bandwidth_get(server_id, period):
 def bandwidth_random_get(server_id, period):
     return ServerBandwidth(server_id).get_period_random(period)
 
+def bandwidth_top_get(server_id, period, limit=10, devices=False):
+    return ServerUserBandwidth(server_id).get_top(period, limit, devices)
+
 def link_servers(server_id, link_server_id, use_local_address=False):
     if server_id == link_server_id:
         raise TypeError('Server id must be different then link server id')
@@ -26,6 +26,10 @@ class SettingsApp(SettingsGroupMongo):
         'influxdb_uri': None,
         'influxdb_prefix': 'pritunl_',
         'influxdb_interval': 3,
+        'influxdb_batch_size': 1000,
+        'influxdb_queue_size': 50000,
+        'influxdb_backoff_max': 300,
+        'influxdb_gzip': True,
         'prometheus_port': 9780,
         'datadog_api_key': None,
         'settings_check_interval': 60,
@@ -42,6 +46,9 @@ class SettingsApp(SettingsGroupMongo):
         'log_limit': 10000,
         'log_entry_limit': 50,
         'log_db_delay': 1,
+        'log_batch_size': 500,
+        'log_queue_size': 8388608,
+        'log_spool_size': 67108864,
         'log_web_errors': False,
         'rate_limit_sleep': 0.5,
         'short_url_length': 8,
@@ -15,6 +15,9 @@ class SettingsUser(SettingsGroupMongo):
         'cert_key_bits': 4096,
         'cert_message_digest': 'sha256',
         'page_count': 10,
+        'search_cache': True,
+        'search_cache_ttl': 300,
+        'search_cache_limit': 5000,
         'skip_remote_sso_check': False,
         'conf_sync': True,
     }
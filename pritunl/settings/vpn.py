@@ -8,12 +8,18 @@ class SettingsVpn(SettingsGroupMongo):
         'lib_iptables': False,
         'call_queue_threads': 32,
         'client_ttl': 300,
+        'client_ping_batch_size': 500,
+        'client_ping_flush_interval': 5,
+        'pool_lease_size': 32,
+        'pool_lease_ttl': 120,
         'peer_limit': 300,
         'peer_limit_timeout': 10,
         'default_dh_param_bits': 1536,
         'otp_cache': True,
         'otp_cache_timeout': 28800,
         'log_lines': 5000,
+        'output_batch_size': 100,
+        'output_flush_interval': 0.5,
         'server_ping': 10,
         'server_ping_ttl': 30,
         'route_ping': 10,
@@ -24,7 +30,11 @@ class SettingsVpn(SettingsGroupMongo):
         'link_timeout': 30,
         'iptables_update': False,
         'iptables_update_rate': 900,
+        'iptables_restore': True,
+        'iptables_restore_delay': 0.1,
+        'iptables_ipset': False,
         'bandwidth_update_rate': 15,
+        'user_bandwidth': True,
         'nat_routes': True,
         'ipv6_prefix': 'fd00',
         'stress_test': False,
@@ -78,6 +78,7 @@ def setup_demo():
 
                     doc = {
                         '_id': utils.ObjectId(),
+                        'org_id': org.id,
                         'user_id': usr.id,
                         'server_id': svr.id,
                         'host_id': settings.local.host_id,
@@ -176,6 +176,8 @@ def setup_mongo():
         'servers_output_link': getattr(database,
             prefix + 'servers_output_link'),
         'servers_bandwidth': getattr(database, prefix + 'servers_bandwidth'),
+        'servers_user_bandwidth': getattr(database,
+            prefix + 'servers_user_bandwidth'),
         'servers_ip_pool': getattr(database, prefix + 'servers_ip_pool'),
         'links': getattr(database, prefix + 'links'),
         'links_locations': getattr(database, prefix + 'links_locations'),
@@ -235,7 +237,20 @@ def setup_mongo():
     mongo.collections['logs'].name_str = 'logs'
     mongo.collections['log_entries'].name_str = 'log_entries'
 
-    upsert_index('logs', 'timestamp', background=True)
+    upsert_index('logs', [
+        ('timestamp', pymongo.ASCENDING),
+        ('_id', pymongo.ASCENDING),
+    ], background=True)
+    upsert_index('logs', [
+        ('level', pymongo.ASCENDING),
+        ('timestamp', pymongo.ASCENDING),
+        ('_id', pymongo.ASCENDING),
+    ], background=True)
+    upsert_index('logs', [
+        ('host', pymongo.ASCENDING),
+        ('timestamp', pymongo.ASCENDING),
+        ('_id', pymongo.ASCENDING),
+    ], background=True)
     upsert_index('transaction', 'lock_id',
         background=True, unique=True)
     upsert_index('transaction', [
@@ -275,6 +290,22 @@ def setup_mongo():
         ('name', pymongo.ASCENDING),
         ('auth_type', pymongo.ASCENDING),
     ], background=True)
+    upsert_index('users', [
+        ('org_id', pymongo.ASCENDING),
+        ('type', pymongo.ASCENDING),
+        ('name', pymongo.ASCENDING),
+        ('_id', pymongo.ASCENDING),
+    ], background=True)
+    upsert_index('users', [
+        ('org_id', pymongo.ASCENDING),
+        ('type', pymongo.ASCENDING),
+        ('name_tokens', pymongo.ASCENDING),
+    ], background=True)
+    upsert_index('users', [
+        ('org_id', pymongo.ASCENDING),
+        ('type', pymongo.ASCENDING),
+        ('email_tokens', pymongo.ASCENDING),
+    ], background=True)
     upsert_index('users_audit', [
         ('org_id', pymongo.ASCENDING),
         ('user_id', pymongo.ASCENDING),
@@ -293,6 +324,10 @@ def setup_mongo():
     upsert_index('users_net_link', 'network',
         background=True)
     upsert_index('clients', 'user_id', background=True)
+    upsert_index('clients', [
+        ('org_id', pymongo.ASCENDING),
+        ('user_id', pymongo.ASCENDING),
+    ], background=True)
     upsert_index('clients', 'domain', background=True)
     upsert_index('clients', 'virt_address_num',
         background=True)
@@ -323,18 +358,17 @@ def setup_mongo():
     upsert_index('servers', 'name', background=True)
     upsert_index('servers', 'ping_timestamp',
         background=True)
-    upsert_index('servers_output', [
-        ('server_id', pymongo.ASCENDING),
-        ('timestamp', pymongo.ASCENDING),
-    ], background=True)
-    upsert_index('servers_output_link', [
+    upsert_index('servers_bandwidth', [
         ('server_id', pymongo.ASCENDING),
+        ('period', pymongo.ASCENDING),
         ('timestamp', pymongo.ASCENDING),
     ], background=True)
-    upsert_index('servers_bandwidth', [
+    upsert_index('servers_user_bandwidth', [
         ('server_id', pymongo.ASCENDING),
         ('period', pymongo.ASCENDING),
         ('timestamp', pymongo.ASCENDING),
+        ('user_id', pymongo.ASCENDING),
+        ('device_id', pymongo.ASCENDING),
     ], background=True)
     upsert_index('servers_ip_pool', [
         ('server_id', pymongo.ASCENDING),
@@ -432,6 +466,11 @@ def setup_mongo():
     upsert_index('sso_passcode_cache', 'timestamp',
         background=True, expireAfterSeconds=settings.app.sso_cache_timeout)
 
+    for coll_name in ('servers_output', 'servers_output_link'):
+        mongo.collections[coll_name].remove({
+            'server_id': {'$exists': True},
+        })
+
     try:
         clean_indexes()
     except:
@@ -3,6 +3,8 @@ from pritunl import listener
 def setup_server_listeners():
     from pritunl import clients
     from pritunl import vxlan
+    from pritunl import organization
     listener.add_listener('port_forwarding', clients.on_port_forwarding)
     listener.add_listener('client', clients.on_client)
     listener.add_listener('vxlan', vxlan.on_vxlan)
+    listener.add_listener('user_search', organization.on_user_search)
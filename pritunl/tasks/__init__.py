@@ -10,3 +10,4 @@ import pritunl.tasks.host
 import pritunl.tasks.link
 import pritunl.tasks.clean_servers
 import pritunl.tasks.clean_vxlans
+import pritunl.tasks.user_search
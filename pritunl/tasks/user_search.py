@@ -0,0 +1,44 @@
+from pritunl.helpers import *
+from pritunl import mongo
+from pritunl import task
+from pritunl import cachelocal
+
+class TaskUserSearch(task.Task):
+    type = 'user_search'
+
+    @cached_static_property
+    def user_collection(cls):
+        return mongo.get_collection('users')
+
+    def task(self):
+        # Add search tokens to users created before the tokens were
+        # maintained on user writes
+        bulk = self.user_collection.initialize_unordered_bulk_op()
+        bulk_count = 0
+
+        for doc in self.user_collection.find({
+                    'name_tokens': {'$exists': False},
+                }, {
+                    '_id': True,
+                    'name': True,
+                    'email': True,
+                }):
+            bulk.find({
+                '_id': doc['_id'],
+            }).update({'$set': {
+                'name_tokens': cachelocal.split_search_terms(
+                    doc.get('name') or ''),
+                'email_tokens': cachelocal.split_search_terms(
+                    doc.get('email') or ''),
+            }})
+            bulk_count += 1
+
+            if bulk_count >= 1000:
+                bulk.execute()
+                bulk = self.user_collection.initialize_unordered_bulk_op()
+                bulk_count = 0
+
+        if bulk_count:
+            bulk.execute()
+
+task.add_task(TaskUserSearch, hours=5, minutes=37, run_on_start=True)
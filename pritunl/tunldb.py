@@ -1,4 +1,5 @@
-import Queue
+from pritunl import expiry
+
 import time
 import collections
 import threading
@@ -7,6 +8,8 @@ import copy
 import itertools
 import json
 import os
+import glob
+import mmap
 
 TRANSACTION_METHODS = {
     'set',
@@ -28,11 +31,71 @@ TRANSACTION_METHODS = {
 }
 CHANNEL_TTL = 120
 CHANNEL_BUFFER = 128
+WAL_METHODS = {
+    'set',
+    'increment',
+    'decrement',
+    'remove',
+    'rename',
+    '_expire_at',
+    'set_add',
+    'set_remove',
+    'list_lpush',
+    'list_rpush',
+    'list_lpop',
+    'list_rpop',
+    'list_remove',
+    'dict_set',
+    'dict_remove',
+    '_apply_trans',
+}
+WAL_COMPACT_SIZE = 8388608
+WAL_COMPACT_INTERVAL = 5
+
+def _wal_op(func):
+    name = func.__name__
+
+    def wrapper(self, *args, **kwargs):
+        if self._wal_file is None:
+            return func(self, *args, **kwargs)
+
+        depth = getattr(self._wal_local, 'depth', 0)
+        if depth:
+            self._wal_local.depth = depth + 1
+            try:
+                value = func(self, *args, **kwargs)
+            finally:
+                self._wal_local.depth = depth
+
+            # Operations run by a transaction are logged with resolved
+            # arguments such as the absolute expire time or popped element
+            calls = self._wal_local.calls
+            if calls is not None and depth == 1:
+                calls.append((name, args, kwargs))
+            return value
+
+        self._wal_lock.acquire()
+        self._wal_local.depth = 1
+        self._wal_local.calls = [] if name == '_apply_trans' else None
+        try:
+            value = func(self, *args, **kwargs)
+            if self._wal_local.calls is not None:
+                self._wal_write(name, ((args[0][0],
+                    self._wal_local.calls),), {})
+            else:
+                self._wal_write(name, args, kwargs)
+            return value
+        finally:
+            self._wal_local.depth = 0
+            self._wal_local.calls = None
+            self._wal_lock.release()
+
+    wrapper.__name__ = name
+    return wrapper
 
 class TunlDB(object):
     def __init__(self):
         self._path = None
-        self._set_queue = Queue.Queue()
         self._data = collections.defaultdict(
             lambda: {'ttl': None, 'val': None})
         self._timers = {}
@@ -40,24 +103,60 @@ class TunlDB(object):
             lambda: {'subs': set(), 'msgs': collections.deque(
                 maxlen=CHANNEL_BUFFER), 'timer': None})
         self._commit_log = []
-
-    def _put_queue(self):
-        if self._path:
-            self._set_queue.put('set')
+        self._wal_lock = threading.Lock()
+        self._wal_local = threading.local()
+        self._wal_file = None
+        self._wal_gen = 0
+        self._wal_size = 0
 
     def _export_thread(self):
         while True:
+            time.sleep(WAL_COMPACT_INTERVAL)
+            if self._wal_size >= WAL_COMPACT_SIZE:
+                self.export_data()
+
+    def _wal_path(self, gen):
+        return '%s.wal.%d' % (self._path, gen)
+
+    def _wal_paths(self):
+        paths = []
+        for path in glob.glob(self._path + '.wal.*'):
             try:
-                self._set_queue.get(timeout=5)
-            except Queue.Empty:
-                continue
-            # Attempt to get more db sets form queue to reduce export calls
-            for _ in xrange(50):
+                paths.append((int(path.rsplit('.', 1)[1]), path))
+            except ValueError:
+                pass
+        paths.sort()
+        return paths
+
+    def _wal_open(self, gen):
+        if self._wal_file:
+            self._wal_file.close()
+
+        path = self._wal_path(gen)
+        self._wal_file = open(path, 'a')
+        os.chmod(path, 0600)
+        self._wal_gen = gen
+        self._wal_size = 0
+
+    def _wal_write(self, name, args, kwargs):
+        line = json.dumps([name, args, kwargs]) + '\n'
+        self._wal_file.write(line)
+        self._wal_file.flush()
+        self._wal_size += len(line)
+
+    def _wal_replay(self, path):
+        with open(path, 'r') as wal_file:
+            for line in wal_file:
                 try:
-                    self._set_queue.get(timeout=0.01)
-                except Queue.Empty:
-                    pass
-            self.export_data()
+                    name, args, kwargs = json.loads(line)
+                except ValueError:
+                    # Incomplete write from a crash, nothing after it was
+                    # acknowledged
+                    break
+
+                if name not in WAL_METHODS:
+                    continue
+                getattr(self, name)(*args, **kwargs)
 
     def _validate(self, value):
         if value is not None and not isinstance(value, basestring):
@@ -68,52 +167,63 @@ class TunlDB(object):
             raise ValueError('Persist is already set')
         self._path = path
         self.import_data()
+        self.export_data()
         if auto_export:
             export_thread = threading.Thread(target=self._export_thread)
             export_thread.daemon = True
             export_thread.start()
 
+    def _get(self, key):
+        data = self._data.get(key)
+        if data and data['ttl'] and data['ttl'] <= int(time.time() * 1000):
+            self.remove(key)
+            return
+        return data
+
+    @_wal_op
     def set(self, key, value):
         self._validate(value)
         self._data[key]['val'] = value
-        self._put_queue()
 
     def get(self, key):
-        data = self._data.get(key)
+        data = self._get(key)
         if data:
             return data['val']
 
     def exists(self, key):
-        return key in self._data
+        return self._get(key) is not None
 
+    @_wal_op
     def rename(self, key, new_key):
-        data = self._data.get(key)
+        data = self._get(key)
         if data:
             self._data[new_key]['val'] = data['val']
             self.remove(key)
-            self._put_queue()
 
+    @_wal_op
     def remove(self, key):
+        expiry.cancel(self._timers.pop(key, None))
         self._data.pop(key, None)
-        self._put_queue()
 
     def expire(self, key, ttl):
-        ttl_time = int(time.time() * 1000) + int(ttl * 1000)
+        self._expire_at(key, int(time.time() * 1000) + int(ttl * 1000))
 
-        cur_timer = self._timers.pop(key, None)
-        if cur_timer:
-            cur_timer.cancel()
-        timer = threading.Timer(ttl, self.remove, (key,))
-        timer.daemon = True
-        self._timers[key] = timer
-        timer.start()
+    @_wal_op
+    def _expire_at(self, key, ttl_time):
+        expiry.cancel(self._timers.pop(key, None))
 
+        ttl = (ttl_time - int(time.time() * 1000)) / 1000.0
+        if ttl <= 0:
+            self.remove(key)
+            return
+
+        self._timers[key] = expiry.schedule(ttl, self.remove, key)
         self._data[key]['ttl'] = ttl_time
-        self._put_queue()
 
+    @_wal_op
     def increment(self, key):
         value = '1'
-        data = self._data.get(key)
+        data = self._get(key)
         if data:
             try:
                 value = str(int(data['val']) + 1)
@@ -122,12 +232,12 @@ class TunlDB(object):
                 data['val'] = value
         else:
             self._data[key]['val'] = value
-        self._put_queue()
         return value
 
+    @_wal_op
     def decrement(self, key):
         value = '-1'
-        data = self._data.get(key)
+        data = self._get(key)
         if data:
             try:
                 value = str(int(data['val']) - 1)
@@ -136,15 +246,17 @@ class TunlDB(object):
                 data['val'] = value
         else:
             self._data[key]['val'] = value
-        self._put_queue()
         return value
 
     def keys(self):
-        return set(self._data)
+        cur_time = int(time.time() * 1000)
+        return set(key for key, data in self._data.items()
+            if not data['ttl'] or data['ttl'] > cur_time)
 
+    @_wal_op
     def set_add(self, key, element):
         self._validate(element)
-        data = self._data.get(key)
+        data = self._get(key)
         if data:
             try:
                 data['val'].add(element)
@@ -152,30 +264,25 @@ class TunlDB(object):
                 data['val'] = {element}
         else:
             self._data[key]['val'] = {element}
-        self._put_queue()
 
+    @_wal_op
     def set_remove(self, key, element):
-        data = self._data.get(key)
+        data = self._get(key)
         if data:
             try:
                 data['val'].remove(element)
-                self._put_queue()
             except (KeyError, AttributeError):
                 pass
 
     def set_pop(self, key):
-        value = None
-        data = self._data.get(key)
-        if data:
-            try:
-                value = data['val'].pop()
-                self._put_queue()
-            except (KeyError, AttributeError):
-                pass
-        return value
+        data = self._get(key)
+        if data and isinstance(data['val'], set):
+            for value in data['val']:
+                self.set_remove(key, value)
+                return value
 
     def set_exists(self, key, element):
-        data = self._data.get(key)
+        data = self._get(key)
         if data:
             try:
                 return element in data['val']
@@ -184,7 +291,7 @@ class TunlDB(object):
         return False
 
     def set_elements(self, key):
-        data = self._data.get(key)
+        data = self._get(key)
         if data:
             try:
                 return data['val'].copy()
@@ -193,7 +300,7 @@ class TunlDB(object):
         return set()
 
     def set_iter(self, key):
-        data = self._data.get(key)
+        data = self._get(key)
         if data:
             try:
                 for value in data['val'].copy():
@@ -202,7 +309,7 @@ class TunlDB(object):
                 pass
 
     def set_length(self, key):
-        data = self._data.get(key)
+        data = self._get(key)
         if data:
             try:
                 return len(data['val'])
@@ -210,9 +317,10 @@ class TunlDB(object):
                 pass
         return 0
 
+    @_wal_op
     def list_lpush(self, key, value):
         self._validate(value)
-        data = self._data.get(key)
+        data = self._get(key)
         if data:
             try:
                 data['val'].appendleft(value)
@@ -220,11 +328,11 @@ class TunlDB(object):
                 data['val'] = collections.deque([value])
         else:
             self._data[key]['val'] = collections.deque([value])
-        self._put_queue()
 
+    @_wal_op
     def list_rpush(self, key, value):
         self._validate(value)
-        data = self._data.get(key)
+        data = self._get(key)
         if data:
             try:
                 data['val'].append(value)
@@ -232,32 +340,31 @@ class TunlDB(object):
                 data['val'] = collections.deque([value])
         else:
             self._data[key]['val'] = collections.deque([value])
-        self._put_queue()
 
+    @_wal_op
     def list_lpop(self, key):
         value = None
-        data = self._data.get(key)
+        data = self._get(key)
         if data:
             try:
                 value = data['val'].popleft()
-                self._put_queue()
             except (AttributeError, IndexError):
                 pass
         return value
 
+    @_wal_op
     def list_rpop(self, key):
         value = None
-        data = self._data.get(key)
+        data = self._get(key)
         if data:
             try:
                 value = data['val'].pop()
-                self._put_queue()
             except (AttributeError, IndexError):
                 pass
         return value
 
     def list_index(self, key, index):
-        data = self._data.get(key)
+        data = self._get(key)
         if data:
             try:
                 return data['val'][index]
@@ -265,7 +372,7 @@ class TunlDB(object):
                 pass
 
     def list_elements(self, key):
-        data = self._data.get(key)
+        data = self._get(key)
         if data:
             try:
                 return list(data['val'])
@@ -274,7 +381,7 @@ class TunlDB(object):
         return []
 
     def list_iter(self, key):
-        data = self._data.get(key)
+        data = self._get(key)
         if data:
             try:
                 for value in copy.copy(data['val']):
@@ -283,7 +390,7 @@ class TunlDB(object):
                 pass
 
     def list_iter_range(self, key, start, stop=None):
-        data = self._data.get(key)
+        data = self._get(key)
         if data:
             try:
                 for value in itertools.islice(
@@ -292,9 +399,10 @@ class TunlDB(object):
             except TypeError:
                 pass
 
+    @_wal_op
     def list_remove(self, key, value, count=1):
         self._validate(value)
-        data = self._data.get(key)
+        data = self._get(key)
         if data:
             if count:
                 try:
@@ -307,10 +415,9 @@ class TunlDB(object):
                         data['val'].remove(value)
                 except (AttributeError, ValueError):
                     pass
-            self._put_queue()
 
     def list_length(self, key):
-        data = self._data.get(key)
+        data = self._get(key)
         if data:
             try:
                 return len(data['val'])
@@ -318,9 +425,10 @@ class TunlDB(object):
                 pass
         return 0
 
+    @_wal_op
     def dict_set(self, key, field, value):
         self._validate(value)
-        data = self._data.get(key)
+        data = self._get(key)
         if data:
             try:
                 data['val'][field] = value
@@ -328,27 +436,26 @@ class TunlDB(object):
                 data['val'] = {field: value}
         else:
             self._data[key]['val'] = {field: value}
-        self._put_queue()
 
     def dict_get(self, key, field):
-        data = self._data.get(key)
+        data = self._get(key)
         if data:
             try:
                 return data['val'].get(field)
             except TypeError:
                 pass
 
+    @_wal_op
     def dict_remove(self, key, field):
-        data = self._data.get(key)
+        data = self._get(key)
         if data:
             try:
                 data['val'].pop(field, None)
             except AttributeError:
                 pass
-            self._put_queue()
 
     def dict_keys(self, key):
-        data = self._data.get(key)
+        data = self._get(key)
         if data:
             try:
                 return set(data['val'])
@@ -357,7 +464,7 @@ class TunlDB(object):
         return set()
 
     def dict_values(self, key):
-        data = self._data.get(key)
+        data = self._get(key)
         if data:
             try:
                 return set(data['val'].values())
@@ -366,7 +473,7 @@ class TunlDB(object):
         return set()
 
     def dict_iter(self, key):
-        data = self._data.get(key)
+        data = self._get(key)
         if data:
             data_copy = data['val'].copy()
             try:
@@ -376,7 +483,7 @@ class TunlDB(object):
                 pass
 
     def dict_get_all(self, key):
-        data = self._data.get(key)
+        data = self._get(key)
         if data:
             try:
                 return data['val'].copy()
@@ -428,13 +535,9 @@ class TunlDB(object):
                 pass
 
     def publish(self, channel, message):
-        cur_timer = self._channels[channel]['timer']
-        if cur_timer:
-            cur_timer.cancel()
-        timer = threading.Timer(CHANNEL_TTL, self._clear_channel, (channel,))
-        timer.daemon = True
-        self._channels[channel]['timer'] = timer
-        timer.start()
+        expiry.cancel(self._channels[channel]['timer'])
+        self._channels[channel]['timer'] = expiry.schedule(
+            CHANNEL_TTL, self._clear_channel, channel)
 
         self._channels[channel]['msgs'].append((uuid.uuid4().hex, message))
         for subscriber in self._channels[channel]['subs'].copy():
@@ -443,6 +546,7 @@ class TunlDB(object):
     def transaction(self):
         return TunlDBTransaction(self)
 
+    @_wal_op
     def _apply_trans(self, trans):
         for call in trans[1]:
             getattr(self, call[0])(*call[1], **call[2])
@@ -450,35 +554,43 @@ class TunlDB(object):
             self._commit_log.remove(trans)
         except ValueError:
             pass
-        self._put_queue()
 
     def export_data(self):
         if not self._path:
             return
-        temp_path = self._path + '_%s.tmp' % uuid.uuid4().hex
+
+        self._wal_lock.acquire()
         try:
-            data = self._data.copy()
-            timers = self._timers.keys()
-            commit_log = copy.copy(self._commit_log)
+            export_data = []
+            for key, data in self._data.items():
+                key_ttl = data['ttl']
+                key_val = data['val']
+                key_type = type(key_val).__name__
+                if key_type == 'set' or key_type == 'deque':
+                    key_val = list(key_val)
+                elif key_type == 'dict':
+                    key_val = key_val.copy()
+                export_data.append((key, key_type, key_ttl, key_val))
+
+            # Operations after this point go to the next log which is
+            # replayed on top of this snapshot
+            wal_gen = self._wal_gen + 1
+            self._wal_open(wal_gen)
+        finally:
+            self._wal_lock.release()
 
+        temp_path = self._path + '_%s.tmp' % uuid.uuid4().hex
+        try:
             with open(temp_path, 'w') as db_file:
                 os.chmod(temp_path, 0600)
-                export_data = []
-
-                for key in data:
-                    key_ttl = data[key]['ttl']
-                    key_val = data[key]['val']
-                    key_type = type(key_val).__name__
-                    if key_type == 'set' or key_type == 'deque':
-                        key_val = list(key_val)
-                    export_data.append((key, key_type, key_ttl, key_val))
-
                 db_file.write(json.dumps({
-                    'ver': 1,
-                    'data': export_data,
-                    'timers': timers,
-                    'commit_log': commit_log,
-                }))
+                    'ver': 2,
+                    'wal': wal_gen,
+                }) + '\n')
+                for key_data in export_data:
+                    db_file.write(json.dumps(key_data) + '\n')
+                db_file.flush()
+                os.fsync(db_file.fileno())
             os.rename(temp_path, self._path)
         except:
             try:
@@ -487,48 +599,62 @@ class TunlDB(object):
                 pass
             raise
 
+        for gen, path in self._wal_paths():
+            if gen < wal_gen:
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+
+    def _import_key(self, key_data):
+        key = key_data[0]
+        key_type = key_data[1]
+        key_ttl = key_data[2]
+        key_val = key_data[3]
+
+        if key_type == 'set':
+            key_val = set(key_val)
+        elif key_type == 'deque':
+            key_val = collections.deque(key_val)
+
+        self._data[key] = {
+            'ttl': None,
+            'val': key_val,
+        }
+
+        if key_ttl:
+            self._expire_at(key, key_ttl)
+
     def import_data(self):
-        if os.path.isfile(self._path):
+        wal_gen = 0
+        commit_log = []
+
+        if os.path.isfile(self._path) and os.path.getsize(self._path):
             with open(self._path, 'r') as db_file:
-                import_data = json.loads(db_file.read())
-                data = import_data['data']
-
-                for key_data in data:
-                    key = key_data[0]
-                    key_type = key_data[1]
-                    key_ttl = key_data[2]
-                    key_val = key_data[3]
-
-                    if key_type == 'set':
-                        key_val = set(key_val)
-                    elif key_type == 'deque':
-                        key_val = collections.deque(key_val)
-
-                    self._data[key] = {
-                        'ttl': key_ttl,
-                        'val': key_val,
-                    }
-
-                if 'timers' in import_data:
-                    for key in import_data['timers']:
-                        if key not in self._data:
-                            continue
-                        ttl = self._data[key]['ttl']
-                        if not ttl:
-                            continue
-                        ttl -= int(time.time() * 1000)
-                        ttl /= 1000.0
-                        if ttl >= 0:
-                            timer = threading.Timer(ttl, self.remove, (key,))
-                            timer.daemon = True
-                            self._timers[key] = timer
-                            timer.start()
-                        else:
-                            self.remove(key)
-
-                if 'commit_log' in import_data:
-                    for tran in import_data['commit_log']:
-                        self._apply_trans(tran)
+                db_map = mmap.mmap(db_file.fileno(), 0,
+                    access=mmap.ACCESS_READ)
+                try:
+                    header = json.loads(db_map.readline())
+
+                    if header['ver'] == 1:
+                        for key_data in header['data']:
+                            self._import_key(key_data)
+                        commit_log = header.get('commit_log') or []
+                    else:
+                        wal_gen = header['wal']
+                        for line in iter(db_map.readline, ''):
+                            self._import_key(json.loads(line))
+                finally:
+                    db_map.close()
+
+        for tran in commit_log:
+            self._apply_trans(tran)
+
+        self._wal_gen = wal_gen
+        for gen, path in self._wal_paths():
+            if gen >= wal_gen:
+                self._wal_replay(path)
+            self._wal_gen = max(self._wal_gen, gen)
 
 class TunlDBTransaction(object):
     def __init__(self, cache):
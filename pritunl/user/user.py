@@ -11,6 +11,7 @@ from pritunl import ipaddress
 from pritunl import sso
 from pritunl import auth
 from pritunl import plugins
+from pritunl import cachelocal
 
 import tarfile
 import zipfile
@@ -49,6 +50,8 @@ class User(mongo.MongoObject):
         'dns_servers',
         'dns_suffix',
         'port_forwarding',
+        'name_tokens',
+        'email_tokens',
     }
     fields_default = {
         'name': 'undefined',
@@ -104,6 +107,36 @@ class User(mongo.MongoObject):
     def collection(cls):
         return mongo.get_collection('users')
 
+    def load(self, *args, **kwargs):
+        mongo.MongoObject.load(self, *args, **kwargs)
+        self.search_doc = self._get_search_doc()
+
+    def _get_search_doc(self):
+        # Returns False when the search fields are not loaded
+        for field in ('name', 'email', 'type'):
+            if field not in self.loaded_fields:
+                return False
+
+        if self.type != CERT_CLIENT:
+            return
+        return self.name, self.email
+
+    def _publish_search(self, old_doc, new_doc, transaction=None):
+        if old_doc == new_doc:
+            return
+
+        if old_doc is False or new_doc is False:
+            message = self.org_id
+        else:
+            message = {
+                'org_id': self.org_id,
+                'user_id': self.id,
+                'remove': old_doc,
+                'add': new_doc,
+            }
+
+        messenger.publish('user_search', message, transaction=transaction)
+
     @cached_static_property
     def audit_collection(cls):
         return mongo.get_collection('users_audit')
@@ -277,6 +310,38 @@ class User(mongo.MongoObject):
         if block:
             self.load()
 
+    def commit(self, fields=None, transaction=None, spec=None):
+        if self.exists:
+            old_search_doc = self.__dict__.get('search_doc', False)
+        else:
+            old_search_doc = None
+
+        if fields is not None:
+            if isinstance(fields, basestring):
+                fields = (fields,)
+            fields = set(fields)
+
+        if fields is None or 'name' in fields:
+            self.name_tokens = cachelocal.split_search_terms(
+                self.name or '')
+            if fields is not None:
+                fields.add('name_tokens')
+
+        if fields is None or 'email' in fields:
+            self.email_tokens = cachelocal.split_search_terms(
+                self.email or '')
+            if fields is not None:
+                fields.add('email_tokens')
+
+        response = mongo.MongoObject.commit(self, fields=fields,
+            transaction=transaction, spec=spec)
+
+        self.search_doc = self._get_search_doc()
+        self._publish_search(old_search_doc, self.search_doc,
+            transaction=transaction)
+
+        return response
+
     def remove(self):
         self.audit_collection.remove({
             'user_id': self.id,
@@ -288,6 +353,7 @@ class User(mongo.MongoObject):
         })
         self.unassign_ip_addr()
         mongo.MongoObject.remove(self)
+        self._publish_search(self.__dict__.get('search_doc', False), None)
 
     def disconnect(self):
         messenger.publish('instance', ['user_disconnect', self.id])
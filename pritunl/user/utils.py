@@ -1,6 +1,8 @@
 from pritunl.user.user import User
 
 from pritunl.constants import *
+from pritunl import messenger
+from pritunl import cachelocal
 
 import threading
 
@@ -25,8 +27,10 @@ def reserve_pooled_user(org, name=None, email=None, pin=None, type=CERT_CLIENT,
 
     if name is not None:
         doc['name'] = name
+        doc['name_tokens'] = cachelocal.split_search_terms(name)
     if email is not None:
         doc['email'] = email
+        doc['email_tokens'] = cachelocal.split_search_terms(email)
     if pin is not None:
         doc['pin'] = pin
     if type is not None:
@@ -63,6 +67,13 @@ def reserve_pooled_user(org, name=None, email=None, pin=None, type=CERT_CLIENT,
     }, new=True)
 
     if doc:
+        if doc['type'] == CERT_CLIENT:
+            messenger.publish('user_search', {
+                'org_id': org.id,
+                'user_id': doc['_id'],
+                'remove': None,
+                'add': (doc.get('name'), doc.get('email')),
+            })
         return User(org=org, doc=doc)
 
 def get_user(org, id, fields=None):
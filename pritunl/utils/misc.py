@@ -51,6 +51,28 @@ def ObjectId(oid=None):
             )
     return oid
 
+def get_page_cursor(name, doc_id):
+    return base64.urlsafe_b64encode(bson.BSON.encode({
+        'name': name,
+        'id': doc_id,
+    })).rstrip('=')
+
+def get_page_cursor_spec(page_cursor):
+    # Matches documents after the cursor when sorted by name and id
+    try:
+        page_cursor = str(page_cursor)
+        doc = bson.BSON(base64.urlsafe_b64decode(
+            page_cursor + '=' * (-len(page_cursor) % 4))).decode()
+        name = doc['name']
+        doc_id = doc['id']
+    except:
+        raise ValueError('Invalid page cursor')
+
+    return {'$or': [
+        {'name': {'$gt': name}},
+        {'name': name, '_id': {'$gt': doc_id}},
+    ]}
+
 def _now(ntp_time):
     start_time, sync_time = ntp_time
     return sync_time + (time.time() - start_time)
@@ -0,0 +1,87 @@
+# Loads generated user names and emails into a CacheTrie and reports the
+# memory used, load time and prefix lookup times. A smaller run storing
+# every prefix of every term as a string key shows the cost of the
+# previous implementation.
+USERS = 500000
+PREFIX_USERS = 50000
+LOOKUPS = 10000
+LIMIT = 5000
+
+import os
+import sys
+import time
+import random
+import collections
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..'))
+
+from pritunl.cachelocal import cache_trie
+
+FIRST = ['james', 'mary', 'john', 'patricia', 'robert', 'jennifer',
+    'michael', 'linda', 'william', 'elizabeth', 'david', 'barbara',
+    'richard', 'susan', 'joseph', 'jessica', 'thomas', 'sarah']
+LAST = ['smith', 'johnson', 'williams', 'brown', 'jones', 'garcia',
+    'miller', 'davis', 'rodriguez', 'martinez', 'hernandez', 'lopez',
+    'gonzalez', 'wilson', 'anderson', 'taylor', 'moore', 'jackson']
+
+def rss():
+    with open('/proc/self/statm', 'r') as statm_file:
+        return int(statm_file.read().split()[1]) * \
+            os.sysconf('SC_PAGE_SIZE') / 1048576.0
+
+def generate_users(count):
+    rand = random.Random(1)
+    for i in xrange(count):
+        first = rand.choice(FIRST)
+        last = rand.choice(LAST)
+        yield i, '%s.%s%d' % (first, last, rand.randint(0, 99999)), \
+            '%s.%s%d@example.com' % (first[0], last, i)
+
+def bench_prefix_keys():
+    keys = collections.defaultdict(collections.Counter)
+    rss_start = rss()
+    start = time.time()
+    for user_id, name, email in generate_users(PREFIX_USERS):
+        for key in (name, email):
+            for term in cache_trie.split_search_terms(key) + [key]:
+                cur_key = ''
+                for char in term:
+                    keys[cur_key][cur_key + char] += 1
+                    cur_key += char
+    print '%-12s users=%-7d rss=+%.1fMB time=%.3fs' % (
+        'prefix keys', PREFIX_USERS, rss() - rss_start,
+        time.time() - start)
+
+def bench_trie():
+    name_trie = cache_trie.CacheTrie('bench_name')
+    email_trie = cache_trie.CacheTrie('bench_email')
+    rss_start = rss()
+    start = time.time()
+    for user_id, name, email in generate_users(USERS):
+        name_trie.add_key_terms(name, user_id)
+        email_trie.add_key_terms(email, user_id)
+    print '%-12s users=%-7d rss=+%.1fMB time=%.3fs' % (
+        'trie', USERS, rss() - rss_start, time.time() - start)
+
+    rand = random.Random(2)
+    for prefix_len in (1, 3, 6):
+        prefixes = [rand.choice(FIRST + LAST)[:prefix_len]
+            for _ in xrange(LOOKUPS)]
+        results = 0
+        start = time.time()
+        for prefix in prefixes:
+            results += len(name_trie.get_prefix(prefix, limit=LIMIT))
+        duration = time.time() - start
+        print '%-12s prefix=%d limit=%d avg=%.3fms results=%d' % (
+            'lookup', prefix_len, LIMIT, duration / LOOKUPS * 1000,
+            results / LOOKUPS)
+
+    start = time.time()
+    for user_id, name, email in generate_users(USERS):
+        name_trie.remove_key_terms(name, user_id)
+    print '%-12s users=%-7d time=%.3fs' % (
+        'remove', USERS, time.time() - start)
+
+if __name__ == '__main__':
+    bench_trie()
+    bench_prefix_keys()
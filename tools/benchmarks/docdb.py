@@ -0,0 +1,69 @@
+# Compares DocDb lookups in the default copy mode, which deep copies
+# every returned document, against readonly mode, which returns views
+# of the stored documents.
+SIZES = [1000, 10000, 100000]
+LOOKUPS = 100000
+
+import os
+import sys
+import time
+import random
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..'))
+
+from pritunl import docdb
+
+def create_db(size, readonly):
+    db = docdb.DocDb(
+        'user_id',
+        'virt_address',
+        ('user_id', 'mac_addr'),
+        readonly=readonly,
+    )
+
+    for i in xrange(size):
+        db.insert({
+            'id': i,
+            'user_id': 'user_%d' % (i // 2),
+            'mac_addr': 'mac_%d' % i,
+            'virt_address': '10.%d.%d.%d/8' % (
+                (i >> 16) & 0xff, (i >> 8) & 0xff, i & 0xff),
+            'dns_servers': ['8.8.8.8', '8.8.4.4'],
+            'iptables_rules': [['FORWARD', '-d', 'addr', '-j', 'DROP']] * 4,
+            'timestamp': time.time(),
+        })
+
+    return db
+
+def bench(name, func, size):
+    keys = [random.randrange(size) for _ in xrange(LOOKUPS)]
+    start = time.time()
+    for key in keys:
+        func(key)
+    elapsed = time.time() - start
+
+    print '%-10s %-10s %8d %10.2fus' % (
+        name, func.__name__, size, elapsed / LOOKUPS * 1000000)
+
+print '%-10s %-10s %8s %12s' % ('mode', 'query', 'docs', 'per op')
+for size in SIZES:
+    for name, readonly in (('copy', False), ('readonly', True)):
+        db = create_db(size, readonly)
+
+        def find_id(key):
+            db.find_id(key)
+
+        def find_user(key):
+            db.find({'user_id': 'user_%d' % (key // 2)})
+
+        def find_mac(key):
+            db.find({
+                'user_id': 'user_%d' % (key // 2),
+                'mac_addr': 'mac_%d' % key,
+            })
+
+        def update_id(key):
+            db.update_id(key, {'timestamp': time.time()})
+
+        for func in (find_id, find_user, find_mac, update_id):
+            bench(name, func, size)
@@ -0,0 +1,87 @@
+# Sets TTL keys on TunlDB and ObjCache and reports the thread count,
+# memory and time taken. A smaller run with one threading.Timer per key
+# shows the cost of the previous expiry implementation.
+KEYS = 100000
+TIMER_KEYS = 1000
+TTL = 30
+
+import os
+import sys
+import time
+import resource
+import threading
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..'))
+
+from pritunl import tunldb
+from pritunl import objcache
+from pritunl import expiry
+
+def max_rss():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+def report(name, count, start, rss_start):
+    print '%-16s keys=%-7d threads=%-5d scheduled=%-7d ' \
+        'rss=+%.1fMB time=%.3fs' % (
+            name, count, threading.active_count(), expiry.count(),
+            max_rss() - rss_start, time.time() - start)
+
+def bench_timers():
+    rss_start = max_rss()
+    start = time.time()
+    timers = []
+    for i in xrange(TIMER_KEYS):
+        timer = threading.Timer(TTL, lambda: None)
+        timer.daemon = True
+        timer.start()
+        timers.append(timer)
+    report('threading.Timer', TIMER_KEYS, start, rss_start)
+
+    for timer in timers:
+        timer.cancel()
+
+def bench_tunldb():
+    cache_db = tunldb.TunlDB()
+    rss_start = max_rss()
+    start = time.time()
+    for i in xrange(KEYS):
+        key = 'key_%d' % i
+        cache_db.set(key, 'val')
+        cache_db.expire(key, TTL)
+    report('TunlDB', KEYS, start, rss_start)
+
+    start = time.time()
+    for i in xrange(KEYS):
+        cache_db.get('key_%d' % i)
+    print '%-16s get time=%.3fs' % ('TunlDB', time.time() - start)
+
+def bench_objcache():
+    cache = objcache.ObjCache(TTL, KEYS)
+    rss_start = max_rss()
+    start = time.time()
+    for i in xrange(KEYS):
+        cache.set('key_%d' % i, i)
+    report('ObjCache', KEYS, start, rss_start)
+
+    start = time.time()
+    for i in xrange(KEYS):
+        cache.set('key_%d' % i, i)
+    print '%-16s reset time=%.3fs scheduled=%d' % (
+        'ObjCache', time.time() - start, expiry.count())
+
+def bench_expire():
+    cache = objcache.ObjCache(0.5, KEYS)
+    for i in xrange(KEYS):
+        cache.set('key_%d' % i, i)
+
+    start = time.time()
+    while expiry.count():
+        time.sleep(0.05)
+    print '%-16s expired=%d time=%.3fs threads=%d' % (
+        'ObjCache', KEYS, time.time() - start, threading.active_count())
+
+if __name__ == '__main__':
+    bench_expire()
+    bench_timers()
+    bench_tunldb()
+    bench_objcache()
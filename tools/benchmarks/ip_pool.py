@@ -0,0 +1,73 @@
+# Compares startup time and memory of the dynamic client address pool
+# against the previous pre-expanded string list. Each network size is
+# measured in a forked child so peak RSS is isolated per run.
+NETWORKS = [
+    '10.0.0.0/24',
+    '10.0.0.0/20',
+    '10.0.0.0/16',
+    '10.0.0.0/12',
+    '10.0.0.0/10',
+    '10.0.0.0/8',
+]
+LEGACY_MAX_PREFIX = 12
+
+import os
+import sys
+import time
+import resource
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..'))
+
+from pritunl import ipaddress
+from pritunl.clients.addr_pool import AddrPool
+
+def get_rss():
+    with open('/proc/self/status') as status_file:
+        for line in status_file:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1])
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+def legacy_pool(network):
+    skip = True
+    ip_pool = []
+    for ip_addr in ipaddress.IPv4Network(network).iterhosts():
+        if skip:
+            skip = False
+            continue
+        ip_pool.append(str(ip_addr))
+    ip_pool.pop()
+    return ip_pool
+
+def addr_pool(network):
+    pool = AddrPool(network)
+    addrs = [pool.get() for _ in xrange(200)]
+    for addr in addrs[::2]:
+        pool.put(addr)
+    return pool
+
+def measure(name, func, network):
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if not pid:
+        os.close(read_fd)
+        start_rss = get_rss()
+        start = time.time()
+        pool = func(network)
+        elapsed = time.time() - start
+        os.write(write_fd, '%f %d' % (elapsed, get_rss() - start_rss))
+        os._exit(0)
+
+    os.close(write_fd)
+    result = os.read(read_fd, 128)
+    os.waitpid(pid, 0)
+    elapsed, rss = result.split()
+
+    print '%-8s %-14s %10.3fs %10.1fMB' % (
+        name, network, float(elapsed), int(rss) / 1024.0)
+
+print '%-8s %-14s %11s %12s' % ('pool', 'network', 'startup', 'rss')
+for network in NETWORKS:
+    measure('addr', addr_pool, network)
+    if ipaddress.IPv4Network(network).prefixlen >= LEGACY_MAX_PREFIX:
+        measure('legacy', legacy_pool, network)
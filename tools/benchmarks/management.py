@@ -0,0 +1,122 @@
+# Replays an openvpn management interface transcript through the server
+# instance management socket reader and line parser. A captured
+# transcript can be passed as the first argument, otherwise a transcript
+# of bytecount updates with client connect events is generated.
+CLIENTS = 5000
+ROUNDS = 20
+CONNECT_EVERY = 50
+RECV_SIZES = [512, 4096, 16384]
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..'))
+
+from pritunl.server import instance_com
+from pritunl import docdb
+from pritunl import utils
+
+class ReplaySocket(object):
+    def __init__(self, data, recv_size):
+        self.data = data
+        self.offset = 0
+        self.recv_size = recv_size
+
+    def recv_into(self, buf):
+        size = min(len(buf), self.recv_size, len(self.data) - self.offset)
+        buf[:size] = self.data[self.offset:self.offset + size]
+        self.offset += size
+        return size
+
+class ReplayInstance(object):
+    sock_interrupt = False
+
+class ReplayClients(object):
+    def __init__(self):
+        self.count = 0
+        self.clients = docdb.DocDb('user_id', readonly=True)
+
+        org_id = utils.ObjectId()
+        for client_id in xrange(CLIENTS):
+            self.clients.insert({
+                'id': str(client_id),
+                'doc_id': utils.ObjectId(),
+                'org_id': org_id,
+                'user_id': utils.ObjectId(),
+                'device_id': None,
+                'device_name': None,
+                'mac_addr': '00:00:00:00:%02x:%02x' % (
+                    client_id >> 8 & 0xff, client_id & 0xff),
+            })
+
+    def connect(self, client, reauth=False):
+        self.count += 1
+
+    def connected(self, client_id):
+        pass
+
+    def disconnected(self, client_id):
+        pass
+
+def generate_transcript():
+    lines = []
+    org_id = utils.ObjectId()
+    user_id = utils.ObjectId()
+
+    for i in xrange(ROUNDS):
+        for client_id in xrange(CLIENTS):
+            lines.append('>BYTECOUNT_CLI:%d,%d,%d' % (
+                client_id, i * 1024, i * 2048))
+
+            if client_id % CONNECT_EVERY == 0:
+                lines += [
+                    '>CLIENT:REAUTH,%d,%d' % (client_id, i),
+                    '>CLIENT:ENV,untrusted_ip=10.%d.%d.1' % (
+                        client_id >> 8 & 0xff, client_id & 0xff),
+                    '>CLIENT:ENV,IV_HWADDR=00:00:00:00:%02x:%02x' % (
+                        client_id >> 8 & 0xff, client_id & 0xff),
+                    '>CLIENT:ENV,IV_PLAT=linux',
+                    '>CLIENT:ENV,tls_id_0=O=%s, CN=%s' % (org_id, user_id),
+                    '>CLIENT:ENV,END',
+                ]
+
+    return '\r\n'.join(lines) + '\r\n'
+
+def replay(data, recv_size):
+    com = instance_com.ServerInstanceCom.__new__(
+        instance_com.ServerInstanceCom)
+    com.sock = ReplaySocket(data, recv_size)
+    com.instance = ReplayInstance()
+    com.clients = ReplayClients()
+    com.push_output = lambda message: None
+    com._init_parser()
+
+    line_count = 0
+    start = time.time()
+    for line in com._read_lines():
+        com.parse_line(line)
+        line_count += 1
+    duration = time.time() - start
+
+    return line_count, duration, com
+
+def main():
+    if len(sys.argv) > 1:
+        with open(sys.argv[1], 'r') as transcript_file:
+            data = transcript_file.read()
+    else:
+        data = generate_transcript()
+
+    print '%d bytes' % len(data)
+
+    for recv_size in RECV_SIZES:
+        line_count, duration, com = replay(data, recv_size)
+        print 'recv=%-6d lines=%d clients=%d devices=%d connects=%d ' \
+            'time=%.3fs rate=%d lines/s' % (
+                recv_size, line_count, len(com.client_bytes),
+                len(com.device_bytes), com.clients.count, duration,
+                line_count / duration)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,95 @@
+# Inserts generated users into a scratch database and compares the latency
+# of skip based pages against keyset pages on (name, _id) at increasing
+# page depths. Usage: pagination.py [mongodb_uri]
+SIZES = [10000, 100000, 1000000]
+DEPTHS = [0.0, 0.25, 0.5, 0.9, 0.999]
+PAGE_COUNT = 10
+LOOKUPS = 20
+BATCH_SIZE = 5000
+
+import os
+import sys
+import time
+import random
+import bson
+import pymongo
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..'))
+
+from pritunl import utils
+
+mongodb_uri = sys.argv[1] if len(sys.argv) > 1 else \
+    'mongodb://localhost:27017/pritunl_bench'
+client = pymongo.MongoClient(mongodb_uri)
+collection = client.get_default_database().users_bench
+org_id = bson.ObjectId()
+spec = {
+    'org_id': org_id,
+    'type': 'client',
+}
+sort = [
+    ('name', pymongo.ASCENDING),
+    ('_id', pymongo.ASCENDING),
+]
+
+def fill(size):
+    rand = random.Random(size)
+    count = collection.count(spec)
+    docs = []
+    for i in xrange(count, size):
+        docs.append({
+            'org_id': org_id,
+            'type': 'client',
+            'name': 'user%08d' % rand.randint(0, size),
+            'email': 'user%d@example.com' % i,
+        })
+        if len(docs) >= BATCH_SIZE:
+            collection.insert_many(docs, ordered=False)
+            docs = []
+    if docs:
+        collection.insert_many(docs, ordered=False)
+
+def page_skip(page):
+    return list(collection.find(spec).sort(sort).skip(
+        page * PAGE_COUNT).limit(PAGE_COUNT))
+
+def page_keyset(page_cursor):
+    page_spec = spec.copy()
+    page_spec.update(utils.get_page_cursor_spec(page_cursor))
+    return list(collection.find(page_spec).sort(sort).limit(PAGE_COUNT))
+
+def bench(size):
+    for depth in DEPTHS:
+        page = int(size * depth) // PAGE_COUNT
+        doc = collection.find(spec).sort(sort).skip(
+            max(page * PAGE_COUNT - 1, 0)).limit(1).next()
+        page_cursor = utils.get_page_cursor(doc['name'], doc['_id'])
+
+        start = time.time()
+        for _ in xrange(LOOKUPS):
+            page_skip(page)
+        skip_time = (time.time() - start) / LOOKUPS
+
+        start = time.time()
+        for _ in xrange(LOOKUPS):
+            page_keyset(page_cursor)
+        keyset_time = (time.time() - start) / LOOKUPS
+
+        print '%8d %8d %10.2fms %10.2fms' % (
+            size, page, skip_time * 1000, keyset_time * 1000)
+
+collection.drop()
+collection.create_index([
+    ('org_id', pymongo.ASCENDING),
+    ('type', pymongo.ASCENDING),
+    ('name', pymongo.ASCENDING),
+    ('_id', pymongo.ASCENDING),
+])
+
+print '%8s %8s %12s %12s' % ('users', 'page', 'skip', 'keyset')
+try:
+    for size in SIZES:
+        fill(size)
+        bench(size)
+finally:
+    collection.drop()
@@ -0,0 +1,61 @@
+import unittest
+import shlex
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from pritunl import iptables
+
+COMMENT = 'pritunl-5a1b2c3d4e5f6a7b8c9d0e1f'
+
+def save_key(table, line):
+    line = shlex.split(line)
+    return iptables._rule_key(table, line[1], line[2:])
+
+class RuleKey(unittest.TestCase):
+    def test_default_route(self):
+        self.assertEqual(
+            iptables._rule_key('filter', 'FORWARD', [
+                '-d', '0.0.0.0/0', '-o', 'tun0',
+                '-m', 'comment', '--comment', COMMENT,
+                '-j', 'ACCEPT',
+            ]),
+            save_key('filter', '-A FORWARD -o tun0 -m comment ' +
+                '--comment %s -j ACCEPT' % COMMENT),
+        )
+
+    def test_default_route_nat(self):
+        self.assertEqual(
+            iptables._rule_key('nat', 'POSTROUTING', [
+                '-s', '10.0.0.5/24', '-d', '0.0.0.0/0', '-o', 'eth0',
+                '-m', 'comment', '--comment', COMMENT,
+                '-j', 'MASQUERADE',
+            ]),
+            save_key('nat', '-A POSTROUTING -s 10.0.0.0/24 -o eth0 ' +
+                '-m comment --comment %s -j MASQUERADE' % COMMENT),
+        )
+
+    def test_default_route6(self):
+        self.assertEqual(
+            iptables._rule_key('filter', 'FORWARD', [
+                '-s', '::/0', '-i', 'tun0',
+                '-m', 'comment', '--comment', COMMENT,
+                '-j', 'ACCEPT',
+            ]),
+            save_key('filter', '-A FORWARD -i tun0 -m comment ' +
+                '--comment %s -j ACCEPT' % COMMENT),
+        )
+
+    def test_negated_default_route(self):
+        self.assertNotEqual(
+            iptables._rule_key('filter', 'FORWARD', [
+                '!', '-d', '0.0.0.0/0', '-j', 'DROP',
+            ]),
+            iptables._rule_key('filter', 'FORWARD', [
+                '-j', 'DROP',
+            ]),
+        )
+
+if __name__ == '__main__':
+    unittest.main()